@@ -0,0 +1,94 @@
+"""Microbenchmark: per-message cost of trigger matching on unmatched chat traffic
+
+Compares the original if/regex chain of handle_text with the compiled
+TriggerDispatcher, and times a full handle_text call for messages that
+match nothing (the >99% case in busy groups).
+
+    python benchmarks/bench_dispatch.py --messages 20000 --repeat 5
+"""
+import argparse
+import asyncio
+import re
+import time
+
+from harness import cleanup, generate_chatter, load_plugin_module, quiet_logging
+
+
+def legacy_match(plugin, content):
+    """The trigger checks handle_text performed before the dispatcher, in the same order"""
+    if re.match(plugin.news_pattern, content) or content == "新闻":
+        return "news"
+    if content == plugin.hitokoto_trigger:
+        return "hitokoto"
+    if re.match(plugin.horoscope_pattern, content):
+        return "horoscope"
+    if re.match(plugin.weather_pattern, content):
+        return "weather"
+    if content == plugin.dujitang_trigger:
+        return "dujitang"
+    if content == plugin.dog_diary_trigger:
+        return "dog_diary"
+    if content == "历史上的今天" or re.match(plugin.history_pattern, content):
+        return "history"
+    for trigger in (plugin.morning_news_trigger, plugin.moyu_trigger, plugin.moyu_video_trigger,
+                    plugin.bagua_trigger, plugin.bstp_trigger, plugin.hstp_trigger, plugin.xjjsp_trigger,
+                    plugin.yzsp_trigger, plugin.hssp_trigger, plugin.cos_trigger, plugin.ddsp_trigger,
+                    plugin.jksp_trigger, plugin.llsp_trigger):
+        if content == trigger:
+            return trigger
+    if re.match(plugin.hot_trend_pattern, content):
+        return "hot_trend"
+    return None
+
+
+def time_per_message(func, messages, repeat):
+    """Return the best-of-repeat cost in nanoseconds per message"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for message in messages:
+            func(message)
+        best = min(best, (time.perf_counter_ns() - start) / len(messages))
+    return best
+
+
+async def time_handle_text(plugin, messages, repeat):
+    """Return the best-of-repeat cost of an unmatched handle_text call in nanoseconds per message"""
+    wrapped = [{"Content": message, "FromWxid": "bench@chatroom"} for message in messages]
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for message in wrapped:
+            await plugin.handle_text(None, message)
+        best = min(best, (time.perf_counter_ns() - start) / len(wrapped))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000, help="number of chat lines per pass")
+    parser.add_argument("--repeat", type=int, default=5, help="passes; the best one is reported")
+    args = parser.parse_args()
+
+    module = load_plugin_module()
+    quiet_logging("ERROR")
+    try:
+        plugin = module.Apilot()
+        messages = generate_chatter(args.messages)
+        unmatched = [message for message in messages if legacy_match(plugin, message) is None]
+        assert all(plugin.dispatcher.match(message) is None for message in unmatched)
+
+        legacy_ns = time_per_message(lambda message: legacy_match(plugin, message), unmatched, args.repeat)
+        dispatcher_ns = time_per_message(plugin.dispatcher.match, unmatched, args.repeat)
+        handle_text_ns = asyncio.run(time_handle_text(plugin, unmatched, args.repeat))
+
+        print(f"unmatched messages:      {len(unmatched)}")
+        print(f"legacy if/regex chain:   {legacy_ns:8.0f} ns/msg")
+        print(f"compiled dispatcher:     {dispatcher_ns:8.0f} ns/msg  ({legacy_ns / dispatcher_ns:.1f}x faster)")
+        print(f"handle_text (unmatched): {handle_text_ns:8.0f} ns/msg")
+    finally:
+        cleanup(module)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""End-to-end benchmark: handle_text against local upstream stand-ins, per trigger type
+
+Runs the real plugin (dispatch, rate limiting, cache, retries, breakers,
+media handling) against the stub servers in stubs.py and a FakeBot, with no
+network access. For every scenario it reports throughput, latency
+percentiles, RSS and event-loop lag.
+
+    python benchmarks/bench_e2e.py --messages 200 --concurrency 20
+    python benchmarks/bench_e2e.py --scenarios weather,hot_trends --latency 0.2 --error-rate 0.1
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+
+from harness import (FakeBot, LoopLagMonitor, build_config, cleanup, current_rss_mb, generate_chatter,
+                     load_plugin_module, peak_rss_mb, percentile, quiet_logging)
+from stubs import StubUpstreams, UpstreamProfile
+
+CITIES = ["北京", "上海", "广州", "深圳", "杭州", "成都", "武汉", "西安", "南京", "重庆"]
+ZODIACS = ["白羊座", "金牛座", "双子座", "巨蟹座", "狮子座", "处女座", "天秤座", "天蝎座", "射手座", "摩羯座", "水瓶座", "双鱼座"]
+
+# Scenario name -> generator of message texts
+SCENARIOS = {
+    "chatter": lambda rng, chatter: rng.choice(chatter),
+    "weather": lambda rng, chatter: f"{rng.choice(CITIES)}天气",
+    "weather_seven": lambda rng, chatter: f"{rng.choice(CITIES)}七天天气",
+    "horoscope": lambda rng, chatter: rng.choice(ZODIACS),
+    "hot_trends": lambda rng, chatter: rng.choice(["微博热榜", "知乎热榜", "百度热榜", "抖音热榜"]),
+    "news": lambda rng, chatter: "新闻",
+    "history": lambda rng, chatter: "历史上的今天",
+    "hitokoto": lambda rng, chatter: "一言",
+    "dujitang": lambda rng, chatter: "毒鸡汤",
+    "dog_diary": lambda rng, chatter: "舔狗",
+    "morning_news": lambda rng, chatter: "早报",
+    "moyu": lambda rng, chatter: "摸鱼",
+    "bagua": lambda rng, chatter: "八卦",
+    "bstp": lambda rng, chatter: "白丝图片",
+    "video": lambda rng, chatter: "小姐姐视频",
+}
+
+
+async def run_scenario(plugin, bot, name, messages, concurrency, seed):
+    rng = random.Random(seed)
+    chatter = generate_chatter(200, seed)
+    texts = [SCENARIOS[name](rng, chatter) for _ in range(messages)]
+    groups = itertools.count()
+    latencies = []
+    failures = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(text):
+        nonlocal failures
+        # Each message comes from its own group so the per-chat rate limiter stays out of the way
+        message = {"Content": text, "FromWxid": f"bench{next(groups)}@chatroom", "SenderWxid": "wxid_bench"}
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await plugin.handle_text(bot, message)
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - start)
+
+    rss_before = current_rss_mb()
+    async with LoopLagMonitor() as lag:
+        start = time.perf_counter()
+        await asyncio.gather(*(send(text) for text in texts))
+        elapsed = time.perf_counter() - start
+    return {
+        "name": name,
+        "throughput": messages / elapsed,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies, default=0.0),
+        "failures": failures,
+        "rss_delta": current_rss_mb() - rss_before,
+        "peak_rss": peak_rss_mb(),
+        "lag_p99": lag.percentile(99),
+        "lag_max": lag.max(),
+    }
+
+
+async def run(args):
+    profile = UpstreamProfile(
+        latency=args.latency, jitter=args.latency / 2, error_rate=args.error_rate,
+        payload_bytes=args.payload_bytes, media_bytes=int(args.media_kb * 1024)
+    )
+    stubs = StubUpstreams(default_profile=profile, port=args.port, seed=args.seed)
+    await stubs.start()
+
+    overrides = {
+        "rate_limit": {"enable": False},
+        "prefetch": {"enable": args.prefetch},
+        "video_pool": {"enable": args.prefetch},
+        "text_buffer": {"enable": args.prefetch},
+        "cache": {"enable": not args.no_cache},
+        "weather": {"city_index_enable": False},
+    }
+    module = load_plugin_module(build_config(overrides))
+    quiet_logging("CRITICAL")
+    bot = FakeBot(send_latency=args.send_latency)
+    try:
+        plugin = module.Apilot()
+        stubs.install(plugin, module)
+        await plugin.on_enable(bot)
+
+        names = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+        print(f"{'scenario':<14}{'msg/s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+              f"{'fail':>6}{'dRSS MB':>9}{'peak MB':>9}{'lag p99':>9}{'lag max':>9}")
+        for index, name in enumerate(names):
+            result = await run_scenario(plugin, bot, name, args.messages, args.concurrency, args.seed + index)
+            print(f"{result['name']:<14}{result['throughput']:>10.1f}{result['p50'] * 1000:>9.1f}"
+                  f"{result['p95'] * 1000:>9.1f}{result['p99'] * 1000:>9.1f}{result['max'] * 1000:>9.1f}"
+                  f"{result['failures']:>6}{result['rss_delta']:>9.1f}{result['peak_rss']:>9.1f}"
+                  f"{result['lag_p99'] * 1000:>8.1f}m{result['lag_max'] * 1000:>8.1f}m")
+        print(f"\nupstream requests: {dict((host, count) for host, count in stubs.requests.items() if count)}")
+        print(f"bot sends: {bot.sent}")
+        await plugin.on_disable()
+    finally:
+        await stubs.stop()
+        cleanup(module)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="", help=f"comma-separated subset of: {','.join(SCENARIOS)}")
+    parser.add_argument("--messages", type=int, default=200, help="messages per scenario")
+    parser.add_argument("--concurrency", type=int, default=20, help="messages in flight at once")
+    parser.add_argument("--latency", type=float, default=0.02, help="mean upstream latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of upstream requests answered with 502")
+    parser.add_argument("--payload-bytes", type=int, default=2048, help="minimum JSON response size")
+    parser.add_argument("--media-kb", type=float, default=200, help="size of stub images and videos")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="simulated bot send latency in seconds")
+    parser.add_argument("--no-cache", action="store_true", help="disable the ALAPI response cache")
+    parser.add_argument("--prefetch", action="store_true", help="keep daily media prefetch, the video pool and the text buffers enabled")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Microbenchmark: peak Python heap used to prepare one video for sending
+
+Compares the original path (download into bytes, then base64-encode while the
+raw bytes are still referenced) with MediaHandle, which keeps the video on
+disk and, only when the send API is called, encodes it in chunks to a sidecar
+file that is decoded into the final str through mmap.
+
+    python benchmarks/bench_media.py --size-mb 20
+"""
+import argparse
+import base64
+import os
+import time
+import tracemalloc
+
+from harness import cleanup, load_plugin_module, quiet_logging
+
+
+def legacy_prepare(path):
+    """What _download_video_directly did originally: raw bytes kept alive while encoding"""
+    with open(path, "rb") as f:
+        video_data = f.read()
+    video_base64 = base64.b64encode(video_data).decode("utf-8")
+    return video_data, video_base64
+
+
+def handle_prepare(module, path):
+    handle = module.MediaHandle.from_file(path, owned=False)
+    return handle, handle.encode()
+
+
+def measure(func):
+    """Return (peak traced bytes, seconds) for one call, releasing the result afterwards"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return peak, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=20, help="size of the synthetic video file")
+    args = parser.parse_args()
+
+    module = load_plugin_module()
+    quiet_logging("ERROR")
+    try:
+        path = module.BENCH_WORKDIR / "clip.mp4"
+        size = int(args.size_mb * 1024 * 1024)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+
+        legacy_peak, legacy_s = measure(lambda: legacy_prepare(path))
+        handle_peak, handle_s = measure(lambda: handle_prepare(module, path))
+        handle = module.MediaHandle.from_file(path, owned=False)
+        handle.encode()
+
+        mb = 1024 * 1024
+        print(f"video size:               {size / mb:8.1f} MB")
+        print(f"legacy bytes + base64:    {legacy_peak / mb:8.1f} MB peak  ({legacy_s * 1000:.0f} ms)")
+        print(f"MediaHandle (mmap):       {handle_peak / mb:8.1f} MB peak  ({handle_s * 1000:.0f} ms)")
+        print(f"MediaHandle.peak_bytes:   {handle.peak_bytes / mb:8.1f} MB reported")
+        print(f"saved per send:           {(legacy_peak - handle_peak) / mb:8.1f} MB")
+        handle.close()
+    finally:
+        cleanup(module)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""Shared helpers for running the Apilot plugin outside of XXXBot
+
+The plugin imports ``WechatAPI`` and ``utils.*`` from the bot framework. When
+those are not importable (a plain checkout), minimal stand-ins are registered
+so that ``main.py`` can be loaded with a generated ``config.toml``.
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import tomllib
+import types
+from pathlib import Path
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+
+
+def install_framework_stubs():
+    """Register stand-ins for the XXXBot modules the plugin imports, if they are missing"""
+    try:
+        import WechatAPI  # noqa: F401
+        import utils.decorators  # noqa: F401
+        import utils.plugin_base  # noqa: F401
+        return
+    except ImportError:
+        pass
+
+    wechat_api = types.ModuleType("WechatAPI")
+
+    class WechatAPIClient:
+        pass
+
+    wechat_api.WechatAPIClient = WechatAPIClient
+
+    utils = types.ModuleType("utils")
+    decorators = types.ModuleType("utils.decorators")
+
+    def on_text_message(priority=50):
+        def decorator(func):
+            return func
+        return decorator
+
+    decorators.on_text_message = on_text_message
+    decorators.__all__ = ["on_text_message"]
+
+    plugin_base = types.ModuleType("utils.plugin_base")
+
+    class PluginBase:
+        def __init__(self):
+            self.enabled = False
+
+        async def on_enable(self, bot=None):
+            self.enabled = True
+
+        async def on_disable(self):
+            self.enabled = False
+
+    plugin_base.PluginBase = PluginBase
+
+    sys.modules.setdefault("WechatAPI", wechat_api)
+    sys.modules.setdefault("utils", utils)
+    sys.modules.setdefault("utils.decorators", decorators)
+    sys.modules.setdefault("utils.plugin_base", plugin_base)
+
+
+def _toml_value(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, list):
+        return "[" + ", ".join(_toml_value(item) for item in value) + "]"
+    return json.dumps(str(value), ensure_ascii=False)
+
+
+def dump_toml(config, prefix=""):
+    """Serialize a config dict of tables (as read by tomllib) back to TOML text"""
+    lines = []
+    scalars = {key: value for key, value in config.items() if not isinstance(value, dict)}
+    tables = {key: value for key, value in config.items() if isinstance(value, dict)}
+    if prefix:
+        lines.append(f"[{prefix}]")
+    lines.extend(f"{json.dumps(key, ensure_ascii=False)} = {_toml_value(value)}" for key, value in scalars.items())
+    for key, table in tables.items():
+        name = f"{prefix}.{json.dumps(key, ensure_ascii=False)}" if prefix else key
+        lines.append("")
+        lines.append(dump_toml(table, name))
+    return "\n".join(lines)
+
+
+def build_config(overrides=None, alapi_token="bench-token"):
+    """Return config.toml text: the template with overrides merged in, table by table"""
+    with open(PLUGIN_DIR / "config.toml.template", "rb") as f:
+        config = tomllib.load(f)
+    config["basic"]["alapi_token"] = alapi_token
+    for section, values in (overrides or {}).items():
+        config.setdefault(section, {}).update(values)
+    return dump_toml(config) + "\n"
+
+
+def load_plugin_module(config_text=None, alapi_token="bench-token"):
+    """Load a private copy of main.py next to a generated config.toml and return the module
+
+    The copy lives in a temporary directory so on-disk caches written during a
+    run never touch the real plugin directory.
+    """
+    install_framework_stubs()
+    workdir = Path(tempfile.mkdtemp(prefix="apilot-bench-"))
+    shutil.copy(PLUGIN_DIR / "main.py", workdir / "main.py")
+    if config_text is None:
+        config_text = build_config(alapi_token=alapi_token)
+    (workdir / "config.toml").write_text(config_text, encoding="utf-8")
+
+    spec = importlib.util.spec_from_file_location(f"apilot_bench_{os.getpid()}_{id(workdir)}", workdir / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.BENCH_WORKDIR = workdir
+    return module
+
+
+def quiet_logging(level="WARNING"):
+    """Drop loguru's default sink so benchmark output is not dominated by plugin logs"""
+    from loguru import logger
+    logger.remove()
+    logger.add(sys.stderr, level=level)
+
+
+def generate_chatter(count, seed=42):
+    """Generate ordinary group chat lines that match no trigger"""
+    import random
+
+    rng = random.Random(seed)
+    openers = ["哈哈", "今天", "明天", "大家", "有人", "刚才", "说真的", "笑死", "话说", "老板", "@张三 ", "ok", "好的"]
+    middles = ["一起吃饭吗", "的会议改到下午了", "天气真不错", "这个视频太好笑了", "谁知道怎么报销", "周末去哪玩",
+               "新闻里说的那个事", "热榜上那个瓜", "我先下了", "收到", "在吗", "下班了没", "这座城市好美"]
+    endings = ["", "。", "！", "？", "~", "哈哈哈", "[捂脸]", "[图片]", " 😂", "..."]
+    lines = []
+    for _ in range(count):
+        line = rng.choice(openers) + rng.choice(middles) + rng.choice(endings)
+        if rng.random() < 0.1:
+            line = line * rng.randint(2, 6)
+        lines.append(line)
+    return lines
+
+
+def cleanup(module):
+    """Remove the temporary plugin directory created by load_plugin_module"""
+    shutil.rmtree(getattr(module, "BENCH_WORKDIR", ""), ignore_errors=True)
+
+
+class FakeBot:
+    """Stand-in for WechatAPIClient that counts what the plugin sends"""
+
+    def __init__(self, send_latency=0.0):
+        self.send_latency = send_latency
+        self.sent = {"text": 0, "image": 0, "video": 0}
+        self.bytes_sent = 0
+
+    async def _send(self, kind, payload):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.sent[kind] += 1
+        self.bytes_sent += len(payload) if isinstance(payload, (str, bytes)) else 0
+
+    async def send_text_message(self, wxid, content, at=None):
+        await self._send("text", content)
+        return 0, 0, 0
+
+    async def send_image_message(self, wxid, image):
+        await self._send("image", image)
+        return 0, 0, 0
+
+    async def send_video_message(self, wxid, video, image=None):
+        await self._send("video", video)
+        return 0, 0
+
+
+class LoopLagMonitor:
+    """Measure event-loop lag as the overshoot of a periodic short sleep
+
+    Use as ``async with LoopLagMonitor() as monitor:`` around the measured code.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval))
+
+    async def __aenter__(self):
+        self._task = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, *exc):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    def max(self):
+        return max(self.samples, default=0.0)
+
+    def percentile(self, q):
+        return percentile(self.samples, q)
+
+    def blocked(self, threshold):
+        """Number of samples where the loop was stalled for longer than threshold seconds"""
+        return sum(1 for sample in self.samples if sample > threshold)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of values (q in 0..100), or 0.0 for no values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB (Linux reports ru_maxrss in KB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb():
+    """Current resident set size in MB, read from /proc on Linux"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except OSError:
+        return 0.0
+
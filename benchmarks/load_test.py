@@ -0,0 +1,157 @@
+"""Load test: many chat groups sending a realistic traffic mix into handle_text
+
+Messages arrive open-loop (Poisson arrivals at --rate msg/s for --duration
+seconds) from --groups groups with several members each, so a slow plugin
+builds up a backlog instead of quietly slowing the generator down. Upstreams
+are the local stand-ins from stubs.py and rate limiting stays enabled, as it is
+in production.
+
+Reports sustained throughput, per-command latency percentiles and event-loop
+blocking incidents (stalls longer than --block-threshold).
+
+    python benchmarks/load_test.py --groups 3000 --rate 500 --duration 60
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from harness import (FakeBot, LoopLagMonitor, build_config, cleanup, generate_chatter, load_plugin_module,
+                     peak_rss_mb, percentile, quiet_logging)
+from stubs import StubUpstreams, UpstreamProfile
+
+CITIES = ["北京", "上海", "广州", "深圳", "杭州", "成都", "武汉", "西安", "南京", "重庆", "天津", "苏州"]
+
+# (command, weight, message generator); weights are relative
+TRAFFIC_MIX = [
+    ("chatter", 930, lambda rng, chatter: rng.choice(chatter)),
+    ("weather", 25, lambda rng, chatter: f"{rng.choice(CITIES)}天气"),
+    ("hot_trends", 12, lambda rng, chatter: rng.choice(["微博热榜", "知乎热榜", "百度热榜"])),
+    ("morning_news", 10, lambda rng, chatter: "早报"),
+    ("horoscope", 6, lambda rng, chatter: rng.choice(["白羊座", "狮子座", "天蝎座", "双鱼座"])),
+    ("moyu", 5, lambda rng, chatter: "摸鱼"),
+    ("hitokoto", 4, lambda rng, chatter: "一言"),
+    ("news", 3, lambda rng, chatter: "新闻"),
+    ("dujitang", 2, lambda rng, chatter: "毒鸡汤"),
+    ("video", 2, lambda rng, chatter: rng.choice(["小姐姐视频", "cos视频"])),
+    ("bstp", 1, lambda rng, chatter: "白丝图片"),
+]
+
+
+async def generate_load(plugin, bot, args, rng):
+    commands = [command for command, _, _ in TRAFFIC_MIX]
+    weights = [weight for _, weight, _ in TRAFFIC_MIX]
+    makers = {command: maker for command, _, maker in TRAFFIC_MIX}
+    chatter = generate_chatter(2000, args.seed)
+    latencies = {command: [] for command in commands}
+    errors = {command: 0 for command in commands}
+    tasks = set()
+    stats = {"sent": 0, "done": 0, "in_flight_max": 0}
+
+    async def deliver(command, message):
+        start = time.perf_counter()
+        try:
+            await plugin.handle_text(bot, message)
+        except Exception:
+            errors[command] += 1
+        latencies[command].append(time.perf_counter() - start)
+        stats["done"] += 1
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    next_arrival = start
+    next_report = start + args.report_every
+    while True:
+        now = loop.time()
+        if now - start >= args.duration:
+            break
+        # Release every arrival that is due, then sleep until the next one
+        while next_arrival <= now:
+            command = rng.choices(commands, weights)[0]
+            group = rng.randrange(args.groups)
+            message = {
+                "Content": makers[command](rng, chatter),
+                "FromWxid": f"group{group}@chatroom",
+                "SenderWxid": f"wxid_g{group}_m{rng.randrange(args.members)}",
+            }
+            task = asyncio.ensure_future(deliver(command, message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            stats["sent"] += 1
+            stats["in_flight_max"] = max(stats["in_flight_max"], len(tasks))
+            next_arrival += rng.expovariate(args.rate)
+        if now >= next_report:
+            print(f"  t={now - start:5.1f}s sent={stats['sent']} done={stats['done']} in_flight={len(tasks)}")
+            next_report += args.report_every
+        await asyncio.sleep(max(0.0, min(next_arrival, next_report) - loop.time()))
+
+    generation_time = loop.time() - start
+    if tasks:
+        await asyncio.wait(tasks, timeout=args.drain_timeout)
+    return latencies, errors, stats, generation_time, len([task for task in tasks if not task.done()])
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    profile = UpstreamProfile(
+        latency=args.latency, jitter=args.latency / 2, error_rate=args.error_rate, media_bytes=int(args.media_kb * 1024)
+    )
+    stubs = StubUpstreams(default_profile=profile, port=args.port, seed=args.seed)
+    await stubs.start()
+    module = load_plugin_module(build_config({"prefetch": {"enable": True}, "weather": {"city_index_enable": False}}))
+    quiet_logging("CRITICAL")
+    bot = FakeBot(send_latency=args.send_latency)
+    try:
+        plugin = module.Apilot()
+        stubs.install(plugin, module)
+        await plugin.on_enable(bot)
+        # Let the daily media prefetch settle, as it would have before the morning peak
+        await asyncio.sleep(1)
+
+        print(f"load: {args.rate} msg/s for {args.duration}s across {args.groups} groups x {args.members} members")
+        async with LoopLagMonitor(interval=args.lag_interval) as lag:
+            latencies, errors, stats, generation_time, unfinished = await generate_load(plugin, bot, args, rng)
+
+        total = sum(len(values) for values in latencies.values())
+        print(f"\nsent {stats['sent']} messages, completed {total}, unfinished after drain: {unfinished}")
+        print(f"sustained throughput: {total / generation_time:.1f} msg/s (target {args.rate})")
+        print(f"max in flight: {stats['in_flight_max']}, peak RSS: {peak_rss_mb():.1f} MB")
+        print(f"event loop: lag p99 {lag.percentile(99) * 1000:.1f} ms, max {lag.max() * 1000:.1f} ms, "
+              f"blocking incidents > {args.block_threshold * 1000:.0f} ms: {lag.blocked(args.block_threshold)}")
+        print(f"\n{'command':<14}{'count':>8}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'p99.9 ms':>10}{'max ms':>9}")
+        for command, values in latencies.items():
+            if not values:
+                continue
+            print(f"{command:<14}{len(values):>8}{errors[command]:>8}{percentile(values, 50) * 1000:>9.1f}"
+                  f"{percentile(values, 95) * 1000:>9.1f}{percentile(values, 99) * 1000:>9.1f}"
+                  f"{percentile(values, 99.9) * 1000:>10.1f}{max(values) * 1000:>9.1f}")
+        print(f"\nrate limited: chat={plugin.chat_limiter.limited} user={plugin.user_limiter.limited}")
+        print(f"upstream requests: {dict((host, count) for host, count in stubs.requests.items() if count)}")
+        print(f"bot sends: {bot.sent}")
+        await plugin.on_disable()
+    finally:
+        await stubs.stop()
+        cleanup(module)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=3000, help="number of simulated chat groups")
+    parser.add_argument("--members", type=int, default=50, help="members per group that may send messages")
+    parser.add_argument("--rate", type=float, default=500, help="mean arrival rate in messages per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of traffic to generate")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean upstream latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.01, help="fraction of upstream requests answered with 502")
+    parser.add_argument("--media-kb", type=float, default=300, help="size of stub images and videos")
+    parser.add_argument("--send-latency", type=float, default=0.02, help="simulated bot send latency in seconds")
+    parser.add_argument("--block-threshold", type=float, default=0.1, help="loop stall counted as a blocking incident")
+    parser.add_argument("--lag-interval", type=float, default=0.01, help="event-loop lag sampling interval")
+    parser.add_argument("--report-every", type=float, default=5, help="progress line interval in seconds")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="seconds to wait for in-flight messages")
+    parser.add_argument("--port", type=int, default=18081)
+    parser.add_argument("--seed", type=int, default=7)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
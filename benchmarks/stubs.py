@@ -0,0 +1,198 @@
+"""Local aiohttp stand-ins for the upstream APIs the plugin talks to
+
+Every upstream host gets its own loopback address (127.0.0.2, 127.0.0.3, ...)
+on a shared port, so per-host state in the plugin (circuit breakers, outbound
+rate limits, metrics) behaves as it would against the real hosts. Requests are
+redirected by rewriting URLs in the plugin's ``_open``: ``https://v3.alapi.cn/api/star``
+becomes ``http://127.0.0.2:<port>/api/star``. Loopback aliases beyond 127.0.0.1
+work out of the box on Linux.
+
+Each host has an UpstreamProfile with latency, jitter, error rate and payload
+size, so scenarios can model slow, flaky or heavy upstreams.
+"""
+import asyncio
+import json
+import os
+import random
+from urllib.parse import urlsplit
+
+from aiohttp import web
+
+# Upstream hosts the plugin contacts, plus one generic host for image/video URLs handed out by the stubs
+UPSTREAM_HOSTS = [
+    "v3.alapi.cn",
+    "api.vvhan.com",
+    "api.yujn.cn",
+    "www.yujn.cn",
+    "api.xlb.one",
+    "dayu.qqsuu.cn",
+    "api.03c3.cn",
+    "api.pearktrue.cn",
+    "media.stub",
+]
+
+# Smallest valid-looking payloads; padded up to the profile's payload size
+JPEG_HEADER = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00"
+MP4_HEADER = b"\x00\x00\x00\x18ftypmp42\x00\x00\x00\x00mp42isom"
+
+
+class UpstreamProfile:
+    """Behaviour of one stub upstream"""
+
+    def __init__(self, latency=0.02, jitter=0.01, error_rate=0.0, payload_bytes=2048, media_bytes=200 * 1024):
+        # latency/jitter in seconds; payload_bytes pads JSON bodies, media_bytes sizes images and videos
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.payload_bytes = payload_bytes
+        self.media_bytes = media_bytes
+
+
+class StubUpstreams:
+    """Run the stand-in servers and route the plugin's requests to them"""
+
+    def __init__(self, profiles=None, default_profile=None, port=18080, seed=1):
+        self.port = port
+        self.default_profile = default_profile or UpstreamProfile()
+        self.profiles = dict(profiles or {})
+        self.addresses = {host: f"127.0.0.{index + 2}" for index, host in enumerate(UPSTREAM_HOSTS)}
+        self._hosts_by_address = {address: host for host, address in self.addresses.items()}
+        self._rng = random.Random(seed)
+        self._runner = None
+        self.requests = {host: 0 for host in UPSTREAM_HOSTS}
+        self.errors = {host: 0 for host in UPSTREAM_HOSTS}
+
+    def profile(self, host):
+        return self.profiles.get(host, self.default_profile)
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        for address in self.addresses.values():
+            await web.TCPSite(self._runner, address, self.port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def rewrite(self, url):
+        """Map an upstream URL onto its stub address; unknown hosts go to the generic media stub"""
+        parts = urlsplit(url)
+        address = self.addresses.get(parts.hostname, self.addresses["media.stub"])
+        rewritten = f"http://{address}:{self.port}{parts.path or '/'}"
+        if parts.hostname not in self.addresses:
+            # Keep the original host in the path so the media stub can tell images from videos
+            rewritten = f"http://{address}:{self.port}/{parts.hostname}{parts.path}"
+        if parts.query:
+            rewritten += f"?{parts.query}"
+        return rewritten
+
+    def install(self, plugin, module):
+        """Route the plugin's HTTP traffic to the stubs"""
+        module.BASE_URL_ALAPI = "https://v3.alapi.cn/api/"
+        original_open = plugin._open
+
+        def rewritten_open(method, url, *args, **kwargs):
+            return original_open(method, self.rewrite(url), *args, **kwargs)
+
+        plugin._open = rewritten_open
+
+    def media_url(self, name):
+        return f"https://media.stub/{name}"
+
+    async def _handle(self, request):
+        host = self._hosts_by_address.get(request.host.split(":")[0], "media.stub")
+        profile = self.profile(host)
+        self.requests[host] += 1
+        delay = max(0.0, profile.latency + self._rng.uniform(-profile.jitter, profile.jitter))
+        if delay:
+            await asyncio.sleep(delay)
+        if self._rng.random() < profile.error_rate:
+            self.errors[host] += 1
+            return web.Response(status=502, text="Bad Gateway")
+
+        path = request.path
+        if host == "v3.alapi.cn":
+            return self._json(self._alapi(path.removeprefix("/api/")), profile)
+        if host in ("api.yujn.cn", "www.yujn.cn"):
+            if request.method == "POST":
+                return self._json({"code": 200, "data": self.media_url(f"video/{self._rng.randrange(10 ** 6)}.mp4")}, profile)
+            return self._media(MP4_HEADER, "video/mp4", profile)
+        if host == "dayu.qqsuu.cn":
+            return self._json({"code": 200, "data": self.media_url("bagua.jpg")}, profile)
+        if host == "api.03c3.cn":
+            return self._json({"code": 200, "data": {"imageurl": self.media_url("zb.jpg"), "news": self._headlines(15)}}, profile)
+        if host == "api.vvhan.com" and path.endswith("/60s"):
+            return self._json({"success": True, "imgUrl": self.media_url("60s.jpg")}, profile)
+        if host == "api.vvhan.com" and "wallpaper" in path:
+            return self._media(MP4_HEADER, "video/mp4", profile)
+        if host == "media.stub" and path.endswith(".mp4"):
+            return self._media(MP4_HEADER, "video/mp4", profile)
+        # vvhan moyu, xlb images, pearktrue and media URLs are plain images
+        return self._media(JPEG_HEADER, "image/jpeg", profile)
+
+    def _json(self, payload, profile):
+        body = json.dumps(payload, ensure_ascii=False)
+        if len(body) < profile.payload_bytes:
+            payload["padding"] = "x" * (profile.payload_bytes - len(body))
+            body = json.dumps(payload, ensure_ascii=False)
+        return web.Response(text=body, content_type="application/json")
+
+    def _media(self, header, content_type, profile):
+        size = max(len(header), profile.media_bytes)
+        return web.Response(body=header + os.urandom(size - len(header)), content_type=content_type)
+
+    def _headlines(self, count):
+        return [f"新闻标题{index}：某地举办活动，吸引大量市民参与" for index in range(count)]
+
+    def _alapi(self, endpoint):
+        rng = self._rng
+        if endpoint == "tianqi":
+            data = {
+                "city": "北京", "province": "北京", "date": "2024-05-20", "weather": "晴", "temp": 25,
+                "min_temp": 15, "max_temp": 28, "sunrise": "05:00", "sunset": "19:30", "weather_code": "qing",
+                "aqi": {"air": 50, "air_level": "优", "air_tips": "空气很好", "pm25": 20},
+                "index": [
+                    {"type": "xiche", "content": "适宜洗车"},
+                    {"type": "yundong", "content": "适宜运动"},
+                    {"type": "ziwanxian", "content": "紫外线强"}
+                ]
+            }
+        elif endpoint == "tianqi/seven":
+            data = [
+                {"city": "北京", "date": f"2024-05-{20 + day}", "wea_day": "晴", "wea_night": "多云", "temp_day": 28,
+                 "temp_night": 15, "wind_day": "南风", "wind_day_level": "3级", "wind_night": "北风",
+                 "wind_night_level": "2级", "humidity": "40%", "visibility": "20km", "sunrise": "05:00",
+                 "sunset": "19:30", "air_level": "优", "index": []}
+                for day in range(7)
+            ]
+        elif endpoint == "tianqi/citylist":
+            data = [{"city_id": str(101010100 + rng.randrange(100)), "city": "北京", "province": "北京", "leader": "北京"}]
+        elif endpoint == "star":
+            # Flat shape, as read by get_horoscope
+            data = {"date": "2024-05-20", "all": "80%", "love": "70%", "work": "90%", "money": "60%", "health": "85%",
+                    "lucky_color": "红色", "lucky_number": "7", "lucky_star": "天秤座", "notice": "注意休息",
+                    "yi": "学习", "ji": "熬夜", "all_text": "今天整体运势不错。", "love_text": "感情稳定。",
+                    "work_text": "工作顺利。", "money_text": "收支平衡。", "health_text": "注意作息。"}
+        elif endpoint == "tophub":
+            data = {"success": True, "update_time": "2024-05-20 08:00:00",
+                    "data": [{"title": f"热搜话题{index}", "hot": 10000 - index, "url": f"https://example.com/{index}"}
+                             for index in range(30)]}
+        elif endpoint == "new/toutiao":
+            data = [{"title": title, "source": "新闻网", "time": "2024-05-20 08:00"} for title in self._headlines(10)]
+        elif endpoint == "eventHistory":
+            data = [{"year": str(1900 + index * 7), "title": f"历史事件{index}"} for index in range(15)]
+        elif endpoint == "zaobao":
+            data = {"date": "2024-05-20", "image": self.media_url("zaobao.jpg"), "news": self._headlines(15)}
+        elif endpoint == "zaobao/news":
+            data = {"date": "2024-05-20", "news": self._headlines(15), "weiyu": "早安"}
+        elif endpoint == "hitokoto":
+            data = {"hitokoto": "生活不止眼前的苟且。", "type": "a", "from": "网络", "creator": "stub"}
+        elif endpoint in ("soul", "dog"):
+            data = {"content": f"第{rng.randrange(10 ** 6)}条语录：今天也要加油。"}
+        else:
+            return {"code": 404, "msg": f"unknown endpoint {endpoint}"}
+        return {"code": 200, "msg": "success", "data": data}
@@ -1,18 +1,26 @@
-import requests
 import re
 import json
 import os
 import tomllib
 import traceback
-import subprocess
 import base64
-import shutil
+import bisect
 import random
+import shutil
+import asyncio
+import contextlib
+import copy
+import functools
+import hashlib
+import mmap
+import sqlite3
+from collections import OrderedDict, deque
 from pathlib import Path
 from urllib.parse import urlparse
 import time
+import uuid
 import aiohttp
-from datetime import datetime
+from datetime import datetime, timedelta
 from loguru import logger
 
 from WechatAPI import WechatAPIClient
@@ -55,6 +63,1585 @@ hitokoto_type_dict = {
     'l': '抖机灵'
 }
 
+# Video categories served by _get_video_with_cover, in trigger priority order
+VIDEO_TYPES = ["xjjsp", "yzsp", "hssp", "cos", "ddsp", "jksp", "llsp"]
+
+# Random text features that can be served from a refill buffer -> method fetching one item
+TEXT_BUFFER_FEATURES = {
+    "hitokoto": "_fetch_hitokoto",
+    "dujitang": "_fetch_soul_dujitang",
+    "dog_diary": "_fetch_dog_diary"
+}
+
+# Cities resolved into the local city index when the plugin first starts
+DEFAULT_SEED_CITIES = [
+    "北京", "上海", "广州", "深圳", "天津", "重庆", "成都", "杭州", "武汉", "西安",
+    "南京", "苏州", "长沙", "郑州", "沈阳", "青岛", "宁波", "东莞", "无锡", "合肥",
+    "昆明", "大连", "福州", "厦门", "哈尔滨", "济南", "温州", "南宁", "长春", "泉州",
+    "石家庄", "贵阳", "南昌", "太原", "兰州", "海口", "乌鲁木齐", "呼和浩特", "银川", "西宁", "拉萨"
+]
+
+# Default daily refresh times (HH:MM) for prefetched media: name -> (config key, default)
+DEFAULT_PREFETCH_TIMES = {
+    "morning_news": ("morning_news_time", "07:30"),
+    "moyu_calendar": ("moyu_time", "07:30"),
+    "bagua": ("bagua_time", "10:00")
+}
+
+# Returned by the gossip API in place of an image URL, since it is not updated on weekends
+BAGUA_WEEKEND_NOTICE = "周末不更新，请微博吃瓜"
+
+# Default response cache TTLs (seconds) per ALAPI endpoint
+DEFAULT_CACHE_TTLS = {
+    "star": 3600,
+    "tianqi": 600,
+    "tianqi/seven": 1800,
+    "tophub": 300,
+    "new/toutiao": 600,
+    "eventHistory": 43200,
+    "zaobao": 1800,
+    "zaobao/news": 1800
+}
+
+
+def _parse_clock(value):
+    """Parse an "HH:MM" time of day into (hour, minute); raises ValueError if malformed"""
+    match = re.fullmatch(r"(\d{1,2}):(\d{2})", str(value).strip())
+    if match is None:
+        raise ValueError(f"expected HH:MM, got {value!r}")
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if hour > 23 or minute > 59:
+        raise ValueError(f"time out of range: {value!r}")
+    return hour, minute
+
+
+def _write_atomic(path, data):
+    """Write bytes to path via a temporary file so readers never see a partial file"""
+    tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries expire after a per-entry TTL"""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the cached value, or None if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        """Store a value for ttl seconds, evicting the least recently used entries"""
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        """Return hit/miss counters for introspection"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key into one in-flight task"""
+
+    def __init__(self):
+        self._inflight = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key, func):
+        """Run func() once per key at a time; concurrent callers await the same result"""
+        task = self._inflight.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.followers += 1
+        # Shield so that one cancelled caller does not cancel the shared task
+        return await asyncio.shield(task)
+
+    def stats(self):
+        """Return coalescing counters for introspection"""
+        return {
+            "in_flight": len(self._inflight),
+            "leaders": self.leaders,
+            "followers": self.followers
+        }
+
+
+class UpstreamUnavailable(aiohttp.ClientError):
+    """Raised instead of contacting a host whose circuit breaker is open"""
+
+    def __init__(self, host):
+        super().__init__(f"{host} is temporarily unavailable (circuit open)")
+        self.host = host
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker for one upstream host, driven by a rolling error rate"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, window=60, min_requests=5, error_rate=0.5, open_seconds=30):
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate_threshold = error_rate
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.trips = 0
+        self.rejected = 0
+        # (monotonic timestamp, succeeded) for calls inside the rolling window
+        self._events = deque()
+        self._probe_in_flight = False
+
+    def _trim(self, now):
+        while self._events and now - self._events[0][0] > self.window:
+            self._events.popleft()
+
+    def error_rate(self):
+        self._trim(time.monotonic())
+        if not self._events:
+            return 0.0
+        return sum(1 for _, ok in self._events if not ok) / len(self._events)
+
+    def allow(self):
+        """Return True if a call may go out now; in half-open state only one probe is let through"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                self.rejected += 1
+                return False
+            self._probe_in_flight = True
+        return True
+
+    def record(self, ok):
+        """Record the outcome of an allowed call"""
+        now = time.monotonic()
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+            if ok:
+                self.state = self.CLOSED
+                self._events.clear()
+            else:
+                self._trip(now)
+            return
+        self._events.append((now, ok))
+        self._trim(now)
+        if len(self._events) >= self.min_requests and self.error_rate() >= self.error_rate_threshold:
+            self._trip(now)
+
+    def abandon(self):
+        """Release an allowed call that ended without an outcome (e.g. it was cancelled)"""
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+
+    def _trip(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.trips += 1
+        self._events.clear()
+
+    def snapshot(self):
+        """Return the breaker state for introspection"""
+        retry_in = None
+        if self.state == self.OPEN:
+            retry_in = max(0.0, round(self.open_seconds - (time.monotonic() - self.opened_at), 1))
+        return {
+            "state": self.state,
+            "error_rate": round(self.error_rate(), 3),
+            "calls_in_window": len(self._events),
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "retry_in": retry_in
+        }
+
+
+class RetryPolicy:
+    """Attempt limits and exponential backoff with full jitter for upstream requests"""
+
+    def __init__(self, max_attempts=2, base_delay=0.2, max_delay=2.0, retry_statuses=(429, 500, 502, 503, 504)):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def backoff(self, attempt):
+        """Return the delay before retrying after the given (1-based) failed attempt"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class RetryBudget:
+    """Cap retries to a fraction of first attempts so an outage cannot become a retry storm"""
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(max_tokens)
+        self.retries = 0
+        self.exhausted = 0
+
+    def deposit(self):
+        """Credit the budget for a first attempt"""
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Spend one retry if the budget allows it"""
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self.retries += 1
+            return True
+        self.exhausted += 1
+        return False
+
+    def stats(self):
+        return {"tokens": round(self._tokens, 2), "retries": self.retries, "exhausted": self.exhausted}
+
+
+# Policy for requests that must not be repeated
+NO_RETRY = RetryPolicy(max_attempts=1)
+
+
+class RateLimiter:
+    """Token buckets keyed by an arbitrary string, with LRU-bounded memory and idle-key eviction"""
+
+    def __init__(self, rate, burst, max_keys=10000, idle_seconds=600):
+        # rate: tokens refilled per second; burst: bucket capacity
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.idle_seconds = idle_seconds
+        # key -> [tokens, last refill timestamp], least recently used first
+        self._buckets = OrderedDict()
+        self.allowed = 0
+        self.limited = 0
+
+    def _take(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [float(self.burst), now]
+            self._buckets[key] = bucket
+            self._evict(now)
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self, now):
+        # Only the least recently used end is inspected, so each check stays O(1) amortized
+        while self._buckets:
+            key, (_, last) = next(iter(self._buckets.items()))
+            if len(self._buckets) <= self.max_keys and now - last < self.idle_seconds:
+                break
+            del self._buckets[key]
+
+    def allow(self, key):
+        """Spend one token for key if available; return False when the key is over its limit"""
+        bucket = self._take(key, time.monotonic())
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            self.allowed += 1
+            return True
+        self.limited += 1
+        return False
+
+    def reserve(self, key):
+        """Spend one token for key and return how long to wait (seconds) before using it"""
+        bucket = self._take(key, time.monotonic())
+        bucket[0] -= 1
+        if bucket[0] >= 0:
+            self.allowed += 1
+            return 0.0
+        self.limited += 1
+        return -bucket[0] / self.rate
+
+    def stats(self):
+        return {"keys": len(self._buckets), "allowed": self.allowed, "limited": self.limited}
+
+
+class TokenPool:
+    """Spread ALAPI calls over several tokens, tracking usage and cooling down exhausted ones"""
+
+    def __init__(self, tokens, strategy="round_robin", cooldown=300, max_cooldown=86400):
+        self.tokens = list(dict.fromkeys(tokens))
+        self._positions = {token: index for index, token in enumerate(self.tokens)}
+        self.strategy = strategy
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._next = 0
+        self._usage = {
+            token: {"calls": 0, "errors": 0, "quota_errors": 0, "cooldown_until": 0.0, "strikes": 0}
+            for token in self.tokens
+        }
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def acquire(self, exclude=()):
+        """Pick a token that is not cooling down; if all are, the one that recovers first"""
+        now = time.monotonic()
+        candidates = [
+            token for token in self.tokens
+            if token not in exclude and self._usage[token]["cooldown_until"] <= now
+        ]
+        if not candidates:
+            candidates = [token for token in self.tokens if token not in exclude]
+            if not candidates:
+                return None
+            token = min(candidates, key=lambda t: self._usage[t]["cooldown_until"])
+        elif self.strategy == "least_used":
+            token = min(candidates, key=lambda t: self._usage[t]["calls"])
+        else:
+            # Round robin: the first available token at or after the cursor
+            index = self._positions
+            token = min(candidates, key=lambda t: (index[t] - self._next) % len(self.tokens))
+            self._next = (index[token] + 1) % len(self.tokens)
+        self._usage[token]["calls"] += 1
+        return token
+
+    def report(self, token, ok, quota_exceeded=False):
+        """Record a call outcome; quota errors cool the token down, doubling on repeats"""
+        usage = self._usage.get(token)
+        if usage is None:
+            return
+        if quota_exceeded:
+            usage["quota_errors"] += 1
+            usage["strikes"] += 1
+            delay = min(self.max_cooldown, self.cooldown * 2 ** (usage["strikes"] - 1))
+            usage["cooldown_until"] = time.monotonic() + delay
+            logger.warning(f"[Apilot] ALAPI token {self.mask(token)} hit its quota, cooling down for {delay}s")
+        elif ok:
+            usage["strikes"] = 0
+        else:
+            usage["errors"] += 1
+
+    def mask(self, token):
+        """Return the display form of a pooled token, made unique by its position in the pool"""
+        # 只用于日志和指标标签，统计数据本身以完整 token 为键
+        shown = f"{token[:4]}…{token[-4:]}" if token and len(token) > 8 else "***"
+        return f"{self._positions.get(token, '?')}:{shown}"
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            self.mask(token): {
+                "calls": usage["calls"],
+                "errors": usage["errors"],
+                "quota_errors": usage["quota_errors"],
+                "cooling_down_for": max(0, round(usage["cooldown_until"] - now))
+            }
+            for token, usage in self._usage.items()
+        }
+
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key):
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in key) + "}"
+
+
+class Counter:
+    """Monotonic counter with labels, or one read from a callback at export time
+
+    The callback returns a number or a dict of {tuple of (label, value) pairs: number}.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, callback=None):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        if self.callback is None:
+            for key, value in self._values.items():
+                yield self.name, key, value
+            return
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.error(f"[Apilot] Metric callback for {self.name} failed: {str(e)}")
+            return
+        if isinstance(values, dict):
+            for key, value in values.items():
+                yield self.name, key, value
+        elif values is not None:
+            yield self.name, (), values
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self._values[_label_key(labels)] = value
+
+
+class Histogram:
+    """Cumulative bucket histogram with labels"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [per-bucket counts..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = [0] * (len(self.buckets) + 1) + [0.0]
+            self._series[key] = series
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def quantile(self, q, **labels):
+        """Estimate a quantile from the buckets (upper bound of the bucket holding it), or None"""
+        series = self._series.get(_label_key(labels))
+        if series is None:
+            return None
+        total = sum(series[:-1])
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), series[:-1]):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self):
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f"{self.name}_bucket", key + (("le", repr(float(bound))),), cumulative
+            cumulative += series[len(self.buckets)]
+            yield f"{self.name}_bucket", key + (("le", "+Inf"),), cumulative
+            yield f"{self.name}_sum", key, series[-1]
+            yield f"{self.name}_count", key, cumulative
+
+
+class MetricsRegistry:
+    """In-process metrics, exported in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        self._metrics.setdefault(metric.name, metric)
+        return self._metrics[metric.name]
+
+    def counter(self, name, help_text, callback=None):
+        return self._register(Counter(name, help_text, callback))
+
+    def gauge(self, name, help_text, callback=None):
+        return self._register(Gauge(name, help_text, callback))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _truncate(value, limit):
+    """Return str(value), cut to limit characters with a note of the original length"""
+    text = str(value)
+    if limit and len(text) > limit:
+        return f"{text[:limit]}... ({len(text)} chars)"
+    return text
+
+
+def _parse_log_level(level, key):
+    """Return the loguru level number for a configured level name, falling back to INFO if it is unknown"""
+    try:
+        return logger.level(str(level).upper()).no
+    except ValueError:
+        logger.warning(f"[Apilot] Invalid {key} ({level!r}), using INFO")
+        return logger.level("INFO").no
+
+
+class LogPolicy:
+    """Per-feature log levels plus lazy, truncated and sampled payload logging for hot paths"""
+
+    def __init__(self, level="INFO", feature_levels=None, max_payload_chars=200, payload_sample_rate=0.0):
+        self.level_no = _parse_log_level(level, "[logging].level")
+        self.feature_levels = {
+            feature: _parse_log_level(feature_level, f"[logging.levels].{feature}")
+            for feature, feature_level in (feature_levels or {}).items()
+        }
+        self.max_payload_chars = max_payload_chars
+        self.payload_sample_rate = payload_sample_rate
+        self._level_nos = {}
+
+    def enabled(self, feature, level):
+        """Return True if a record of this level should be emitted for the feature"""
+        level_no = self._level_nos.get(level)
+        if level_no is None:
+            level_no = self._level_nos[level] = logger.level(level).no
+        return level_no >= self.feature_levels.get(feature, self.level_no)
+
+    def log(self, feature, level, message, *args):
+        """Log through loguru's lazy mode: args are callables evaluated only if the record is emitted"""
+        if self.enabled(feature, level):
+            logger.opt(lazy=True, depth=1).log(level, message, *args)
+
+    def payload(self, feature, label, payload):
+        """Log an upstream payload at DEBUG, truncated unless this call is sampled for a full dump"""
+        if not self.enabled(feature, "DEBUG"):
+            return
+        full = self.payload_sample_rate > 0 and random.random() < self.payload_sample_rate
+        logger.opt(lazy=True, depth=1).debug(
+            "[Apilot] {}: {}", lambda: label, lambda: payload if full else _truncate(payload, self.max_payload_chars)
+        )
+
+
+def _scan_regex(pattern):
+    """Map closing parens to their opening parens and collect alternations with their enclosing group"""
+    pairs, pipes, stack = {}, [], []
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == "\\":
+            i += 2
+            continue
+        if in_class:
+            if ch == "]":
+                in_class = False
+        elif ch == "[":
+            in_class = True
+            # A "]" right after "[" or "[^" is a literal member of the class
+            if pattern[i + 1:i + 2] == "^":
+                i += 1
+            if pattern[i + 1:i + 2] == "]":
+                i += 1
+        elif ch == "(":
+            stack.append(i)
+        elif ch == ")":
+            if stack:
+                pairs[i] = stack.pop()
+        elif ch == "|":
+            pipes.append(stack[-1] if stack else None)
+        i += 1
+    return pairs, pipes
+
+
+def _literal_affixes(pattern):
+    """Return the literal CJK prefix and suffix that every re.match of pattern must have
+
+    Either part is "" when it cannot be derived safely, in which case the
+    pattern is simply never pre-filtered on that side.
+    """
+    pairs, pipes = _scan_regex(pattern)
+    if None in pipes:
+        return "", ""
+
+    prefix = ""
+    prefix_match = re.match(r"\^?([\u4e00-\u9fff]+)", pattern)
+    if prefix_match:
+        prefix = prefix_match.group(1)
+        if pattern[prefix_match.end():prefix_match.end() + 1] in ("?", "*", "+", "{"):
+            # The last character is quantified and may be absent
+            prefix = prefix[:-1]
+
+    suffix = ""
+    if pattern.endswith("$") and not pattern.endswith("\\$"):
+        end = len(pattern) - 1
+        # Step into trailing groups that are neither alternations nor lookarounds
+        while pattern[end - 1:end] == ")" and (end - 1) in pairs:
+            opening = pairs[end - 1]
+            if opening in pipes or pattern[opening + 1:opening + 3] in ("?=", "?!", "?<"):
+                end = 0
+                break
+            end -= 1
+        suffix_match = re.search(r"[\u4e00-\u9fff]+$", pattern[:end])
+        if suffix_match:
+            suffix = suffix_match.group(0)
+    return prefix, suffix
+
+
+class TriggerDispatcher:
+    """Route message text to handlers, built once from an ordered route list
+
+    Exact triggers are resolved with a single dict lookup. Regex triggers are
+    precompiled and skipped unless the message carries their literal prefix or
+    suffix, so unmatched chat traffic costs a lookup and a couple of string
+    comparisons. Earlier routes keep priority over later ones, as in the
+    original if-chain.
+    """
+
+    def __init__(self, routes):
+        self._exact = {}
+        self._patterns = []
+        gate_prefixes, gate_suffixes = [], []
+        self._ungated = False
+        self._route_count = len(routes)
+        for order, (kind, trigger, handler) in enumerate(routes):
+            if kind == "exact":
+                self._exact.setdefault(trigger, (order, handler))
+                continue
+            prefix, suffix = _literal_affixes(trigger)
+            if prefix:
+                gate_prefixes.append(prefix)
+            if suffix:
+                gate_suffixes.append(suffix)
+            if not prefix and not suffix:
+                self._ungated = True
+            self._patterns.append((order, prefix, suffix, re.compile(trigger), handler))
+        self._gate_prefixes = tuple(gate_prefixes)
+        self._gate_suffixes = tuple(gate_suffixes)
+
+    def match(self, content):
+        """Return (handler, match object or None) for the first matching route, or None"""
+        exact = self._exact.get(content)
+        if exact is None:
+            if not (self._ungated or content.endswith(self._gate_suffixes) or content.startswith(self._gate_prefixes)):
+                return None
+            limit = self._route_count
+        else:
+            limit = exact[0]
+
+        for order, prefix, suffix, pattern, handler in self._patterns:
+            if order > limit:
+                break
+            if prefix and not content.startswith(prefix):
+                continue
+            if suffix and not content.endswith(suffix):
+                continue
+            match = pattern.match(content)
+            if match:
+                return handler, match
+
+        if exact is not None:
+            return exact[1], None
+        return None
+
+
+def _handler_name(handler):
+    """Short feature name for a route handler, e.g. weather or video_xjjsp"""
+    if isinstance(handler, functools.partial):
+        return "_".join([handler.func.__name__.removeprefix("_handle_")] + [str(arg) for arg in handler.args])
+    return handler.__name__.removeprefix("_handle_")
+
+
+class MediaDiskCache:
+    """Persistent content-addressed media cache with a total size cap and LRU eviction"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.blob_dir = self.directory / "blobs"
+        self.index_path = self.directory / "index.json"
+        self.max_bytes = max_bytes
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._write_lock = asyncio.Lock()
+        # url -> {hash, size, content_type, etag, last_modified, fetched_at, last_access}, least recently used first
+        self._index = OrderedDict()
+        # hash -> number of URLs sharing the blob; bytes counts each unique blob once
+        self._refs = {}
+        self.bytes = 0
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            for url, entry in sorted(entries.items(), key=lambda item: item[1]["last_access"]):
+                self._index[url] = entry
+                self._ref(entry)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"[Apilot] Failed to load media cache index, starting empty: {str(e)}")
+            self._index.clear()
+            self._refs.clear()
+            self.bytes = 0
+        self._sweep_orphans()
+
+    def _ref(self, entry):
+        count = self._refs.get(entry["hash"], 0)
+        if count == 0:
+            self.bytes += entry["size"]
+        self._refs[entry["hash"]] = count + 1
+
+    def _unref(self, entry):
+        """Drop one reference to the entry's blob; returns the blob path if nothing references it any more"""
+        count = self._refs[entry["hash"]] - 1
+        if count:
+            self._refs[entry["hash"]] = count
+            return None
+        del self._refs[entry["hash"]]
+        self.bytes -= entry["size"]
+        return self.blob_dir / entry["hash"]
+
+    def _sweep_orphans(self):
+        """Remove blobs (and partial writes) left behind by a crash or a failed index write"""
+        removed = 0
+        for path in self.blob_dir.iterdir():
+            if path.name not in self._refs:
+                try:
+                    path.unlink()
+                    removed += 1
+                except OSError:
+                    pass
+        if removed:
+            logger.info(f"[Apilot] Removed {removed} unreferenced file(s) from the media cache")
+
+    def lookup(self, url):
+        """Return the metadata for a cached URL, or None"""
+        return self._index.get(url)
+
+    async def read(self, url):
+        """Read the cached bytes for a URL, dropping the entry if its blob is gone"""
+        entry = self._index.get(url)
+        if entry is None:
+            self.misses += 1
+            return None
+        try:
+            data = await asyncio.to_thread((self.blob_dir / entry["hash"]).read_bytes)
+        except OSError:
+            self._drop(url)
+            self.misses += 1
+            return None
+        entry["last_access"] = time.time()
+        self._index.move_to_end(url)
+        self.hits += 1
+        return data
+
+    async def put(self, url, data, content_type="", etag=None, last_modified=None):
+        """Store bytes for a URL; identical content from different URLs shares one blob"""
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self.blob_dir / digest
+        if digest not in self._refs:
+            await asyncio.to_thread(_write_atomic, blob_path, data)
+        now = time.time()
+        entry = {
+            "hash": digest,
+            "size": len(data),
+            "content_type": content_type,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched_at": now,
+            "last_access": now
+        }
+        # 先登记新内容再释放旧内容，URL对应的内容未变时不会误删文件
+        self._ref(entry)
+        unused = self._drop(url, unlink=False)
+        self._index[url] = entry
+        unused += self._evict()
+        async with self._write_lock:
+            # 等待期间可能有其他URL重新引用了同一内容，这些文件不能删除
+            await asyncio.to_thread(self._remove_blobs, [path for path in unused if path.name not in self._refs])
+            await asyncio.to_thread(_write_atomic, self.index_path, self._dump_index())
+
+    def touch(self, url):
+        """Mark a cached URL as revalidated against its upstream"""
+        entry = self._index.get(url)
+        if entry is not None:
+            entry["fetched_at"] = entry["last_access"] = time.time()
+            self._index.move_to_end(url)
+
+    def _drop(self, url, unlink=True):
+        """Remove a URL from the index; returns the blob paths it no longer needs (deleted now if unlink)"""
+        entry = self._index.pop(url, None)
+        unused = [] if entry is None else [path for path in [self._unref(entry)] if path is not None]
+        if unlink:
+            self._remove_blobs(unused)
+            return []
+        return unused
+
+    def _evict(self):
+        """Drop least recently used URLs until the unique blobs fit in max_bytes; returns blobs to delete"""
+        unused = []
+        while self.bytes > self.max_bytes and self._index:
+            unused += self._drop(next(iter(self._index)), unlink=False)
+        return unused
+
+    @staticmethod
+    def _remove_blobs(paths):
+        for path in paths:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def flush(self):
+        """Persist the index so the cache survives restarts"""
+        _write_atomic(self.index_path, self._dump_index())
+
+    def _dump_index(self):
+        return json.dumps(self._index, ensure_ascii=False).encode("utf-8")
+
+    def stats(self):
+        """Return usage counters for introspection"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._index),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class CityIndex:
+    """Locally persisted index of city name -> tianqi/citylist entries"""
+
+    def __init__(self, path, max_entries=2000, pinned=(), miss_ttl=86400, max_misses=512):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        # 预置城市不会因为容量上限被淘汰
+        self.pinned = set(pinned)
+        self.miss_ttl = miss_ttl
+        self._write_lock = asyncio.Lock()
+        # name -> {"fetched_at": timestamp, "hit_at": timestamp, "entries": [{city_id, city, province, leader}]},
+        # 按最近查询时间排序
+        self._cities = OrderedDict()
+        # 查不到的名称（多为输入错误）只在内存中短期记住，不写入文件，也不会被后台刷新
+        self._misses = TTLCache(max_misses)
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                cities = json.load(f)
+            for name, record in sorted(cities.items(), key=lambda item: item[1].get("hit_at", 0)):
+                if record.get("entries"):
+                    self._cities[name] = record
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"[Apilot] Failed to load city index, starting empty: {str(e)}")
+
+    def lookup(self, name):
+        """Return the entries for a city name, [] for a recent miss, or None if it has to be resolved"""
+        record = self._cities.get(name)
+        if record is not None:
+            record["hit_at"] = time.time()
+            self._cities.move_to_end(name)
+            return record["entries"]
+        if self._misses.get(name) is not None:
+            return []
+        return None
+
+    async def record(self, name, entries):
+        """Store and persist the entries resolved for a city name; names with no entries are only kept as a short-lived miss"""
+        previous = self._cities.get(name)
+        if not entries:
+            self._misses.set(name, True, self.miss_ttl)
+            if previous is None:
+                return
+            del self._cities[name]
+        else:
+            self._cities[name] = {
+                "fetched_at": time.time(),
+                "hit_at": previous["hit_at"] if previous is not None else time.time(),
+                "entries": entries
+            }
+            self._cities.move_to_end(name)
+            self._evict()
+        async with self._write_lock:
+            data = json.dumps(self._cities, ensure_ascii=False).encode("utf-8")
+            await asyncio.to_thread(_write_atomic, self.path, data)
+
+    def _evict(self):
+        """Drop the least recently queried names that are not pinned until the index fits max_entries"""
+        excess = len(self._cities) - self.max_entries
+        if excess <= 0:
+            return
+        for name in [name for name in self._cities if name not in self.pinned][:excess]:
+            del self._cities[name]
+
+    def stale_names(self, seed_names, max_age):
+        """Return seed names not indexed yet, plus stale names that are seeds or were queried within max_age seconds"""
+        deadline = time.time() - max_age
+        seeds = set(seed_names)
+        names = [name for name in seed_names if name not in self._cities and self._misses.get(name) is None]
+        names += [
+            name for name, record in self._cities.items()
+            if record["fetched_at"] < deadline and (name in seeds or record.get("hit_at", 0) >= deadline)
+        ]
+        return names
+
+    def __len__(self):
+        return len(self._cities)
+
+
+class MediaHandle:
+    """Media payload backed by a file or an in-memory buffer, base64-encoded lazily at send time"""
+
+    def __init__(self, path=None, data=None, owned=False, encoded=False):
+        self.path = Path(path) if path is not None else None
+        self._data = memoryview(data) if data is not None else None
+        # owned 为 True 时 close() 会删除底层文件
+        self.owned = owned
+        # encoded 为 True 时文件内容已经是 base64 文本，发送时直接读取，无需再编码
+        self.encoded = encoded
+        self._encoded = None
+        self.peak_bytes = 0
+
+    @classmethod
+    def from_file(cls, path, owned=True, encoded=False):
+        return cls(path=path, owned=owned, encoded=encoded)
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data=data)
+
+    @property
+    def size(self):
+        if self._data is not None:
+            return self._data.nbytes
+        return self.path.stat().st_size
+
+    def encode(self):
+        """Return the payload as a base64 string, encoding it only once
+
+        Blocking: reads and encodes the whole payload, so call it from a worker thread.
+        """
+        if self._encoded is not None:
+            return self._encoded
+        if self.encoded:
+            self._encoded = _read_ascii(self.path)
+            self.peak_bytes = len(self._encoded)
+            return self._encoded
+        if self._data is not None:
+            resident = self._data.nbytes
+            encoded = base64.b64encode(self._data)
+            self._encoded = encoded.decode("ascii")
+            # 编码时同时存在的内存副本：原始数据 + base64 bytes + str
+            self.peak_bytes = resident + len(encoded) + len(self._encoded)
+            del encoded
+            return self._encoded
+        # 先分块编码到旁边的临时文件，再通过mmap直接解码成str，
+        # 原始数据和base64 bytes都不会整份出现在Python堆上
+        encoded_path = self.path.with_name(f"{self.path.name}.b64")
+        try:
+            _encode_file_base64(self.path, encoded_path)
+            self._encoded = _read_ascii(encoded_path)
+        finally:
+            encoded_path.unlink(missing_ok=True)
+        self.peak_bytes = len(self._encoded)
+        return self._encoded
+
+    def close(self):
+        """Drop the encoded payload and remove the backing file if the handle owns it"""
+        self._encoded = None
+        if self._data is not None:
+            self._data.release()
+            self._data = None
+        if self.owned and self.path is not None:
+            try:
+                self.path.unlink(missing_ok=True)
+            except Exception as e:
+                logger.error(f"[Apilot] Failed to remove media file {self.path}: {str(e)}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read_ascii(path):
+    """Read an ASCII file into a str through mmap, without an intermediate bytes copy"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return str(mm, "ascii")
+
+
+def _encode_file_base64(source, target):
+    """Write the base64 encoding of source to target in chunks, without loading the whole file"""
+    tmp_path = target.with_name(f"{target.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+            # 块大小是 3 的倍数，各块的编码结果可以直接拼接
+            while chunk := src.read(3 * 256 * 1024):
+                dst.write(base64.b64encode(chunk))
+        os.replace(tmp_path, target)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+
+class VideoDerivativeCache:
+    """On-disk cache of encoded videos and their covers, keyed by content hash, with LRU eviction
+
+    Each entry holds the base64 payload and the JPEG cover of one clip. A URL
+    index lets a repeated clip URL skip the download as well. Handles given out
+    are hard links (or copies, where hard links are unsupported) in a private
+    directory, so evicting an entry never breaks a send that is still pending.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.link_dir = self.directory / "pending"
+        self.index_path = self.directory / "index.json"
+        self.max_bytes = max_bytes
+        self.link_dir.mkdir(parents=True, exist_ok=True)
+        # Links left behind by a previous run no longer belong to any handle
+        for stale in self.link_dir.iterdir():
+            stale.unlink(missing_ok=True)
+        self.url_hits = 0
+        self.hash_hits = 0
+        self.misses = 0
+        # Set once hard links turn out to be unsupported, so handles get private copies
+        self._copy_fallback = False
+        self._write_lock = asyncio.Lock()
+        # hash -> {"size", "cover", "urls"}, least recently used first
+        self._entries = OrderedDict()
+        # url -> hash
+        self._urls = {}
+        self.bytes = 0
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            entries = []
+        except Exception as e:
+            logger.error(f"[Apilot] Failed to load video cache index, starting empty: {str(e)}")
+            entries = []
+        for digest, entry in entries:
+            if self._payload_path(digest).exists():
+                self._entries[digest] = entry
+                self.bytes += entry["size"]
+                for url in entry["urls"]:
+                    self._urls[url] = digest
+        self._sweep_orphans()
+
+    def _sweep_orphans(self):
+        """Remove payloads, covers and partial writes that no index entry references"""
+        keep = {self.index_path.name}
+        for digest, entry in self._entries.items():
+            keep.add(self._payload_path(digest).name)
+            if entry["cover"]:
+                keep.add(self._cover_path(digest).name)
+        removed = 0
+        for path in self.directory.iterdir():
+            if path.name in keep or not path.is_file():
+                continue
+            try:
+                path.unlink()
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.info(f"[Apilot] Removed {removed} unreferenced file(s) from the video cache")
+
+    def _payload_path(self, digest):
+        return self.directory / f"{digest}.b64"
+
+    def _cover_path(self, digest):
+        return self.directory / f"{digest}.jpg"
+
+    async def lookup_url(self, url):
+        """Return handles for a clip URL seen before, or None"""
+        digest = self._urls.get(url)
+        handles = await self._open(digest) if digest is not None else None
+        if handles is not None:
+            self.url_hits += 1
+        return handles
+
+    async def lookup_hash(self, digest, url):
+        """Return handles for downloaded content seen before under any URL, or None"""
+        handles = await self._open(digest)
+        if handles is None:
+            self.misses += 1
+            return None
+        self.hash_hits += 1
+        self._add_url(digest, url)
+        return handles
+
+    async def put(self, url, digest, video_path, cover_data):
+        """Store the encoded video and cover for a downloaded clip and return handles to them"""
+        payload_path = self._payload_path(digest)
+        await asyncio.to_thread(_encode_file_base64, video_path, payload_path)
+        if cover_data:
+            await asyncio.to_thread(_write_atomic, self._cover_path(digest), cover_data)
+        size = payload_path.stat().st_size + len(cover_data or b"")
+        previous = self._entries.pop(digest, None)
+        if previous is not None:
+            self.bytes -= previous["size"]
+        self._entries[digest] = {"size": size, "cover": bool(cover_data), "urls": previous["urls"] if previous else []}
+        self.bytes += size
+        self._add_url(digest, url)
+        # 先取得句柄再淘汰，即使新条目本身超出上限也不影响这次发送
+        handles = await self._open(digest)
+        self._evict()
+        async with self._write_lock:
+            await asyncio.to_thread(_write_atomic, self.index_path, self._dump_index())
+        return handles
+
+    def _add_url(self, digest, url):
+        if url is None or self._urls.get(url) == digest:
+            return
+        old = self._urls.get(url)
+        if old in self._entries:
+            self._entries[old]["urls"].remove(url)
+        self._urls[url] = digest
+        self._entries[digest]["urls"].append(url)
+
+    async def _open(self, digest):
+        entry = self._entries.get(digest)
+        if entry is None:
+            return None
+        link_path = self.link_dir / f"{uuid.uuid4().hex}.b64"
+        try:
+            await self._link(self._payload_path(digest), link_path)
+            cover_data = await asyncio.to_thread(self._cover_path(digest).read_bytes) if entry["cover"] else None
+        except FileNotFoundError as e:
+            # 只有缓存文件确实丢失时才删除条目
+            logger.error(f"[Apilot] Video cache entry {digest[:12]} is missing on disk, dropping it: {str(e)}")
+            link_path.unlink(missing_ok=True)
+            self._remove(digest)
+            return None
+        except OSError as e:
+            logger.error(f"[Apilot] Failed to open video cache entry {digest[:12]}: {str(e)}")
+            link_path.unlink(missing_ok=True)
+            return None
+        self._entries.move_to_end(digest)
+        return {
+            "video": MediaHandle.from_file(link_path, owned=True, encoded=True),
+            "cover": MediaHandle.from_bytes(cover_data) if cover_data else None
+        }
+
+    async def _link(self, source, target):
+        """Hard-link source to target, copying instead where the filesystem has no hard links"""
+        if not self._copy_fallback:
+            try:
+                os.link(source, target)
+                return
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                # 不支持硬链接（如 EXDEV、EPERM）时改为复制，之后不再尝试链接
+                logger.warning(f"[Apilot] Hard links unavailable in {self.link_dir}, copying cached videos instead: {str(e)}")
+                self._copy_fallback = True
+        await asyncio.to_thread(shutil.copyfile, source, target)
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, digest):
+        entry = self._entries.pop(digest, None)
+        if entry is None:
+            return
+        self.bytes -= entry["size"]
+        for url in entry["urls"]:
+            self._urls.pop(url, None)
+        for path in (self._payload_path(digest), self._cover_path(digest)):
+            try:
+                path.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+    def flush(self):
+        """Persist the index so the cache survives restarts"""
+        _write_atomic(self.index_path, self._dump_index())
+
+    def _dump_index(self):
+        return json.dumps(list(self._entries.items()), ensure_ascii=False).encode("utf-8")
+
+    def stats(self):
+        hits = self.url_hits + self.hash_hits
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": hits,
+            "url_hits": self.url_hits,
+            "hash_hits": self.hash_hits,
+            "misses": self.misses,
+            "hit_ratio": hits / lookups if lookups else 0.0
+        }
+
+
+class CoverPipe:
+    """ffmpeg process that turns the first bytes of a video, fed while it downloads, into a JPEG cover"""
+
+    def __init__(self, process, max_input_bytes):
+        self.process = process
+        self.max_input_bytes = max_input_bytes
+        self.fed = 0
+        self._input_closed = False
+        # Drain stdout/stderr from the start so ffmpeg never blocks on a full pipe while we feed stdin
+        self._stdout = asyncio.ensure_future(process.stdout.read())
+        self._stderr = asyncio.ensure_future(process.stderr.read())
+
+    @classmethod
+    async def start(cls, max_input_bytes):
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-loglevel", "error",
+            "-i", "pipe:0",
+            "-ss", "00:00:01",  # 与文件方式一致，取第 1 秒的画面
+            "-vframes", "1",
+            "-f", "image2", "-c:v", "mjpeg",
+            "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        return cls(process, max_input_bytes)
+
+    async def feed(self, chunk):
+        """Pass a downloaded chunk to ffmpeg until max_input_bytes have been fed; never raises"""
+        if self._input_closed:
+            return
+        chunk = chunk[:self.max_input_bytes - self.fed]
+        try:
+            self.process.stdin.write(chunk)
+            await self.process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg 已经拿到需要的画面并退出，或者已经失败
+            self._input_closed = True
+            return
+        self.fed += len(chunk)
+        if self.fed >= self.max_input_bytes:
+            self._close_input()
+
+    def _close_input(self):
+        if not self._input_closed:
+            self._input_closed = True
+            with contextlib.suppress(Exception):
+                self.process.stdin.close()
+
+    async def result(self, timeout):
+        """Signal end of input and return the JPEG bytes, or None if ffmpeg produced no frame"""
+        self._close_input()
+        try:
+            stdout, stderr = await asyncio.wait_for(asyncio.gather(self._stdout, self._stderr), timeout=timeout)
+            await asyncio.wait_for(self.process.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            # 立即结束ffmpeg，不必等到下载结束才释放进程和并发名额
+            with contextlib.suppress(ProcessLookupError):
+                self.process.kill()
+            logger.error(f"[Apilot] Piped ffmpeg timed out after {timeout}s, process killed")
+            return None
+        if self.process.returncode != 0 or not stdout:
+            logger.warning(f"[Apilot] Piped cover extraction failed after {self.fed} bytes: {stderr.decode(errors='replace').strip()}")
+            return None
+        logger.info(f"[Apilot] Extracted video cover while downloading, fed {self.fed} bytes, cover size: {len(stdout)} bytes")
+        return stdout
+
+    async def close(self):
+        """Kill ffmpeg if it is still running and release the pipe readers"""
+        self._close_input()
+        if self.process.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                self.process.kill()
+            await self.process.wait()
+        for task in (self._stdout, self._stderr):
+            task.cancel()
+        await asyncio.gather(self._stdout, self._stderr, return_exceptions=True)
+
+
+class VideoPool:
+    """Bounded per-category buffers of downloaded videos (file plus cover) ready to send"""
+
+    def __init__(self, categories, size=2, max_bytes=200 * 1024 * 1024):
+        self.size = size
+        self.max_bytes = max_bytes
+        # category -> deque of (bytes, {"video": MediaHandle, "cover": MediaHandle|None})
+        self._items = {category: deque() for category in categories}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Set whenever a video is taken, so the refill loop knows there is room again
+        self._demand = asyncio.Event()
+
+    def __contains__(self, category):
+        return category in self._items
+
+    def take(self, category):
+        """Return a ready video for the category, or None if its buffer is empty"""
+        items = self._items.get(category)
+        if not items:
+            self.misses += 1
+            return None
+        size, result = items.popleft()
+        self.bytes -= size
+        self.hits += 1
+        self._demand.set()
+        return result
+
+    def put(self, category, result):
+        """Add a prepared video; returns False if the category is full or the byte cap would be exceeded"""
+        cover = result.get("cover")
+        size = result["video"].size + (cover.size if cover else 0)
+        items = self._items[category]
+        if len(items) >= self.size or self.bytes + size > self.max_bytes:
+            return False
+        items.append((size, result))
+        self.bytes += size
+        return True
+
+    def next_category(self, exclude=()):
+        """Return the emptiest category with room left, or None when nothing needs refilling"""
+        if self.bytes >= self.max_bytes:
+            return None
+        candidates = [
+            category for category, items in self._items.items()
+            if len(items) < self.size and category not in exclude
+        ]
+        return min(candidates, key=lambda category: len(self._items[category]), default=None)
+
+    def clear_demand(self):
+        self._demand.clear()
+
+    async def wait_for_demand(self):
+        """Wait until a video has been taken since the last clear_demand()"""
+        await self._demand.wait()
+
+    def close(self):
+        """Remove every buffered video file"""
+        for items in self._items.values():
+            while items:
+                _, result = items.popleft()
+                result["video"].close()
+                if result.get("cover"):
+                    result["cover"].close()
+        self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": sum(len(items) for items in self._items.values()),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "per_category": {category: len(items) for category, items in self._items.items()}
+        }
+
+
+class TextBuffer:
+    """Small buffer of random text items that avoids repeating an item recently served to the same chat"""
+
+    def __init__(self, size=10, refill_below=5, recent=20, max_chats=10000):
+        self.size = size
+        self.refill_below = refill_below
+        self.recent = recent
+        self.max_chats = max_chats
+        self._items = deque()
+        # chat -> deque of recently served items, least recently active chat first
+        self._served = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.repeats = 0
+        # Set when the buffer drops below refill_below, so the refill loop tops it up
+        self._low = asyncio.Event()
+
+    def __len__(self):
+        return len(self._items)
+
+    def take(self, chat):
+        """Return the oldest item not recently served to chat, or None if the buffer is empty"""
+        if not self._items:
+            self.misses += 1
+            self._low.set()
+            return None
+        served = self._served.get(chat, ())
+        index = next((i for i, item in enumerate(self._items) if item not in served), None)
+        if index is None:
+            # 缓冲区中的内容这个会话最近都看过，只能重复发送最早的一条
+            index = 0
+            self.repeats += 1
+        item = self._items[index]
+        del self._items[index]
+        self.remember(chat, item)
+        if len(self._items) < self.refill_below:
+            self._low.set()
+        self.hits += 1
+        return item
+
+    def served(self, chat):
+        """Return the items recently served to chat, oldest first"""
+        return self._served.get(chat, ())
+
+    def remember(self, chat, item):
+        """Record that item was sent to chat, so it is skipped for that chat for a while"""
+        served = self._served.get(chat)
+        if served is None:
+            served = self._served[chat] = deque(maxlen=self.recent)
+            if len(self._served) > self.max_chats:
+                self._served.popitem(last=False)
+        else:
+            self._served.move_to_end(chat)
+        served.append(item)
+
+    def add(self, item):
+        """Buffer a fetched item; returns False if the buffer is full or already holds it"""
+        if len(self._items) >= self.size or item in self._items:
+            return False
+        self._items.append(item)
+        return True
+
+    def needs_refill(self):
+        return len(self._items) < self.refill_below
+
+    def clear_low(self):
+        self._low.clear()
+
+    async def wait_low(self):
+        """Wait until the buffer has dropped below refill_below since the last clear_low()"""
+        await self._low.wait()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "repeats": self.repeats,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+class QuoteCorpus:
+    """SQLite store of every random text item fetched so far, deduplicated by content hash"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS quotes ("
+            "id INTEGER PRIMARY KEY, feature TEXT NOT NULL, hash TEXT NOT NULL UNIQUE, "
+            "text TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+        # Statements run in a worker thread, one at a time
+        self._lock = asyncio.Lock()
+        # feature -> rowids, so a uniform random pick is one list index plus one primary key lookup
+        self._ids = {}
+        for feature, rowid in self._conn.execute("SELECT feature, id FROM quotes"):
+            self._ids.setdefault(feature, []).append(rowid)
+        self.added = 0
+        self.served = 0
+
+    def count(self, feature):
+        return len(self._ids.get(feature, ()))
+
+    async def add(self, feature, text):
+        """Store an item unless the same content is already stored; returns True if it was new"""
+        digest = hashlib.sha256(f"{feature}\0{text}".encode("utf-8")).hexdigest()
+        async with self._lock:
+            rowid = await asyncio.to_thread(self._insert, feature, digest, text)
+        if rowid is None:
+            return False
+        self._ids.setdefault(feature, []).append(rowid)
+        self.added += 1
+        return True
+
+    def _insert(self, feature, digest, text):
+        cursor = self._conn.execute(
+            "INSERT OR IGNORE INTO quotes (feature, hash, text, created_at) VALUES (?, ?, ?, ?)",
+            (feature, digest, text, time.time())
+        )
+        self._conn.commit()
+        return cursor.lastrowid if cursor.rowcount else None
+
+    async def pick(self, feature, avoid=()):
+        """Return a random stored item for the feature, trying a few times to avoid the given items"""
+        ids = self._ids.get(feature)
+        if not ids:
+            return None
+        async with self._lock:
+            for _ in range(3):
+                text = await asyncio.to_thread(self._select, random.choice(ids))
+                if text not in avoid:
+                    break
+        self.served += 1
+        return text
+
+    def _select(self, rowid):
+        row = self._conn.execute("SELECT text FROM quotes WHERE id = ?", (rowid,)).fetchone()
+        return row[0] if row else None
+
+    def stats(self):
+        return {
+            "entries": sum(len(ids) for ids in self._ids.values()),
+            "per_feature": {feature: len(ids) for feature, ids in self._ids.items()},
+            "added": self.added,
+            "served": self.served
+        }
+
 
 class Apilot(PluginBase):
     description = "从DOW迁移到XXX平台的插件"
@@ -63,6 +1650,10 @@ class Apilot(PluginBase):
 
     def __init__(self):
         super().__init__()
+        # Replaced by the configured policy once the config has been read
+        self.log_policy = LogPolicy()
+        # Optional dedicated log file for this plugin, added on enable
+        self.log_sink_id = None
         try:
             # Load configuration from TOML file
             config_path = os.path.join(os.path.dirname(__file__), "config.toml")
@@ -73,7 +1664,12 @@ class Apilot(PluginBase):
                 # Read basic configuration
                 basic_config = config.get("basic", {})
                 self.enable = basic_config.get("enable", True)  # Default to True
-                self.alapi_token = basic_config.get("alapi_token", None)
+                # alapi_token 可以是单个token，也可以是token列表
+                alapi_tokens = basic_config.get("alapi_token", None)
+                if not isinstance(alapi_tokens, list):
+                    alapi_tokens = [alapi_tokens]
+                alapi_tokens = [token for token in alapi_tokens if token]
+                self.alapi_token = alapi_tokens[0] if alapi_tokens else None
                 self.morning_news_text_enabled = basic_config.get("morning_news_text_enabled", False)
 
                 # Read trigger patterns
@@ -100,6 +1696,9 @@ class Apilot(PluginBase):
                 self.jksp_trigger = triggers_config.get("jksp_trigger", 'JK视频')
                 self.llsp_trigger = triggers_config.get("llsp_trigger", '萝莉视频')
 
+                # Compile the trigger dispatcher once instead of per message
+                self.dispatcher = self._build_dispatcher()
+
                 # Read API URLs
                 apis_config = config.get("apis", {})
                 self.bagua_api_url = apis_config.get("bagua_api_url", "https://dayu.qqsuu.cn/mingxingbagua/apis.php")
@@ -114,6 +1713,198 @@ class Apilot(PluginBase):
                 self.jksp_api_url = apis_config.get("jksp_api_url", "https://api.yujn.cn/api/jk.php")
                 self.llsp_api_url = apis_config.get("llsp_api_url", "https://api.yujn.cn/api/luoli.php")
 
+                # Read HTTP connection pool settings
+                http_config = config.get("http", {})
+                self.http_connection_limit = http_config.get("connection_limit", 100)
+                self.http_limit_per_host = http_config.get("limit_per_host", 10)
+                self.http_dns_cache_ttl = http_config.get("dns_cache_ttl", 300)
+                self.http_keepalive_timeout = http_config.get("keepalive_timeout", 30)
+
+                # Read video download settings
+                video_config = config.get("video", {})
+                self.video_max_size_mb = video_config.get("max_size_mb", 50)
+                self.video_chunk_size = video_config.get("chunk_size_kb", 64) * 1024
+                self.ffmpeg_timeout = video_config.get("ffmpeg_timeout", 30)
+                self.ffmpeg_semaphore = asyncio.Semaphore(max(1, video_config.get("ffmpeg_concurrency", 2)))
+                # Bytes from the start of each download piped into ffmpeg for the cover; 0 extracts from the file afterwards
+                self.cover_pipe_bytes = int(video_config.get("cover_pipe_mb", 4) * 1024 * 1024)
+                # Piped ffmpeg processes live as long as the download, so they get their own limit
+                # instead of holding ffmpeg_semaphore slots that file extraction is waiting for
+                self.cover_pipe_semaphore = asyncio.Semaphore(max(1, video_config.get("cover_pipe_concurrency", 2)))
+
+                # Read video derivative cache settings
+                video_cache_config = config.get("video_cache", {})
+                self.video_cache = None
+                if video_cache_config.get("enable", True):
+                    self.video_cache = VideoDerivativeCache(
+                        os.path.join(os.path.dirname(__file__), video_cache_config.get("directory", "cache/video")),
+                        video_cache_config.get("max_size_mb", 500) * 1024 * 1024
+                    )
+
+                # Read pre-warmed video pool settings
+                video_pool_config = config.get("video_pool", {})
+                self.video_pool = None
+                if video_pool_config.get("enable", True):
+                    self.video_pool = VideoPool(
+                        [category for category in video_pool_config.get("categories", VIDEO_TYPES) if category in VIDEO_TYPES],
+                        size=video_pool_config.get("size", 2),
+                        max_bytes=video_pool_config.get("max_size_mb", 200) * 1024 * 1024
+                    )
+                self.video_pool_retry_interval = video_pool_config.get("retry_interval", 60)
+
+                # Read rate limit settings
+                rate_limit_config = config.get("rate_limit", {})
+                self.rate_limit_enabled = rate_limit_config.get("enable", True)
+                limiter_settings = {
+                    "max_keys": rate_limit_config.get("max_keys", 10000),
+                    "idle_seconds": rate_limit_config.get("idle_seconds", 600)
+                }
+                self.chat_limiter = RateLimiter(
+                    rate_limit_config.get("chat_per_minute", 20) / 60, rate_limit_config.get("chat_burst", 10), **limiter_settings
+                )
+                self.user_limiter = RateLimiter(
+                    rate_limit_config.get("user_per_minute", 6) / 60, rate_limit_config.get("user_burst", 3), **limiter_settings
+                )
+                self.rate_limit_message = rate_limit_config.get("message", "操作太频繁了，请稍后再试~")
+                self.rate_limit_notice_interval = rate_limit_config.get("notice_interval", 30)
+                self.rate_limit_notices = TTLCache(limiter_settings["max_keys"])
+                # host -> outbound requests per second
+                self.host_limiters = {
+                    host: RateLimiter(rate, max(1, rate))
+                    for host, rate in rate_limit_config.get("hosts", {}).items()
+                }
+
+                # Read per-host circuit breaker settings
+                breaker_config = config.get("circuit_breaker", {})
+                self.breaker_enabled = breaker_config.get("enable", True)
+                self.breaker_settings = {
+                    "window": breaker_config.get("window", 60),
+                    "min_requests": breaker_config.get("min_requests", 5),
+                    "error_rate": breaker_config.get("error_rate", 0.5),
+                    "open_seconds": breaker_config.get("open_seconds", 30)
+                }
+                # host -> CircuitBreaker, created on first contact
+                self.breakers = {}
+
+                # Read logging policy settings
+                logging_config = config.get("logging", {})
+                self.log_policy = LogPolicy(
+                    level=logging_config.get("level", "INFO"),
+                    feature_levels=logging_config.get("levels", {}),
+                    max_payload_chars=logging_config.get("max_payload_chars", 200),
+                    payload_sample_rate=logging_config.get("payload_sample_rate", 0.0)
+                )
+                self.log_file = logging_config.get("file", "")
+                self.log_file_level = _parse_log_level(logging_config.get("file_level", "DEBUG"), "[logging].file_level")
+
+                # Read metrics endpoint settings
+                metrics_config = config.get("metrics", {})
+                self.metrics_http_enable = metrics_config.get("http_enable", False)
+                self.metrics_host = metrics_config.get("host", "127.0.0.1")
+                self.metrics_port = metrics_config.get("port", 9464)
+
+                # Read ALAPI token pool settings
+                token_pool_config = config.get("token_pool", {})
+                self.token_pool = TokenPool(
+                    alapi_tokens,
+                    strategy=token_pool_config.get("strategy", "round_robin"),
+                    cooldown=token_pool_config.get("cooldown", 300),
+                    max_cooldown=token_pool_config.get("max_cooldown", 86400)
+                ) if len(alapi_tokens) > 1 else None
+                self.quota_error_codes = set(token_pool_config.get("quota_error_codes", [429]))
+                self.quota_error_keywords = token_pool_config.get("quota_error_keywords", ["次数", "额度", "上限", "频繁"])
+
+                # Read retry settings
+                retry_config = config.get("retry", {})
+                self.retry_enabled = retry_config.get("enable", True)
+                retry_settings = {
+                    "base_delay": retry_config.get("base_delay", 0.2),
+                    "max_delay": retry_config.get("max_delay", 2.0),
+                    "retry_statuses": retry_config.get("retry_statuses", [429, 500, 502, 503, 504])
+                }
+                self.retry_policy = RetryPolicy(retry_config.get("max_attempts", 2), **retry_settings)
+                # URL prefix -> policy, longest prefix first
+                self.endpoint_retry_policies = [
+                    (prefix, RetryPolicy(attempts, **retry_settings))
+                    for prefix, attempts in sorted(retry_config.get("endpoints", {}).items(), key=lambda item: -len(item[0]))
+                ]
+                self.retry_budget = RetryBudget(retry_config.get("budget_ratio", 0.1), retry_config.get("budget_max_tokens", 10))
+
+                # Read morning news source settings
+                morning_news_config = config.get("morning_news", {})
+                self.morning_news_hedge_enable = morning_news_config.get("hedge_enable", True)
+                self.morning_news_hedge_delay = morning_news_config.get("hedge_delay", 2)
+                self.morning_news_backup_sources = morning_news_config.get("backup_sources", [
+                    "https://api.03c3.cn/api/zb",
+                    "https://api.vvhan.com/api/60s",
+                    "https://api.pearktrue.cn/api/60s/image"
+                ])
+
+                # Read ALAPI response cache settings
+                cache_config = config.get("cache", {})
+                self.cache_enabled = cache_config.get("enable", True)
+                self.cache_ttls = {**DEFAULT_CACHE_TTLS, **cache_config.get("ttl", {})}
+                self.response_cache = TTLCache(cache_config.get("max_entries", 512))
+
+                # Concurrent identical upstream calls share one in-flight request
+                self.single_flight = SingleFlight()
+
+                # Read random text refill buffer settings
+                text_buffer_config = config.get("text_buffer", {})
+                self.text_buffers = {}
+                if text_buffer_config.get("enable", True):
+                    self.text_buffers = {
+                        feature: TextBuffer(
+                            size=text_buffer_config.get("size", 10),
+                            refill_below=text_buffer_config.get("refill_below", 5),
+                            recent=text_buffer_config.get("recent", 20)
+                        )
+                        for feature in text_buffer_config.get("features", list(TEXT_BUFFER_FEATURES))
+                        if feature in TEXT_BUFFER_FEATURES
+                    }
+                self.text_buffer_batch = max(1, text_buffer_config.get("batch", 3))
+                self.text_buffer_retry_interval = text_buffer_config.get("retry_interval", 60)
+                # Background refills of all buffers share one budget so they stay within the token's QPS
+                qps = text_buffer_config.get("qps", 1)
+                self.text_refill_limiter = RateLimiter(qps, max(1, qps))
+
+                # Read local quote corpus settings
+                quote_corpus_config = config.get("quote_corpus", {})
+                self.quote_corpus = None
+                if quote_corpus_config.get("enable", True):
+                    self.quote_corpus = QuoteCorpus(os.path.join(
+                        os.path.dirname(__file__), quote_corpus_config.get("path", "cache/quotes.db")
+                    ))
+                self.quote_fallback_after = quote_corpus_config.get("fallback_after", 3)
+
+                # Read daily media prefetch settings
+                prefetch_config = config.get("prefetch", {})
+                self.prefetch_enabled = prefetch_config.get("enable", True)
+                self.prefetch_retry_interval = prefetch_config.get("retry_interval", 300)
+                # name -> (hour, minute), validated once so triggers and the prefetch loop never parse config
+                self.prefetch_times = {}
+                for name, (key, default) in DEFAULT_PREFETCH_TIMES.items():
+                    try:
+                        self.prefetch_times[name] = _parse_clock(prefetch_config.get(key, default))
+                    except ValueError as e:
+                        logger.warning(f"[Apilot] Invalid [prefetch].{key} ({str(e)}), using {default}")
+                        self.prefetch_times[name] = _parse_clock(default)
+                if self.morning_news_text_enabled:
+                    # The text edition is served from the response cache instead
+                    del self.prefetch_times["morning_news"]
+                # Daily media ready to serve: name -> (fetched_at, bytes)
+                self.daily_media = {}
+
+                # Read on-disk media cache settings
+                media_cache_config = config.get("media_cache", {})
+                self.media_cache = None
+                if media_cache_config.get("enable", True):
+                    media_cache_dir = media_cache_config.get("directory", "cache/media")
+                    self.media_cache = MediaDiskCache(
+                        os.path.join(os.path.dirname(__file__), media_cache_dir),
+                        media_cache_config.get("max_size_mb", 200) * 1024 * 1024
+                    )
+
                 # Important: Set self.enabled to True for the plugin system
                 self.enabled = True
 
@@ -125,6 +1916,22 @@ class Apilot(PluginBase):
                 # Initialize condition_2_and_3_cities for weather queries
                 self.condition_2_and_3_cities = None
 
+                # Read local city index settings for weather queries
+                weather_config = config.get("weather", {})
+                self.city_index = None
+                self.city_index_refresh_days = weather_config.get("city_index_refresh_days", 30)
+                self.city_index_request_interval = weather_config.get("city_index_request_interval", 2)
+                self.city_index_seed_cities = weather_config.get("city_index_seed_cities", DEFAULT_SEED_CITIES)
+                if weather_config.get("city_index_enable", True):
+                    self.city_index = CityIndex(
+                        os.path.join(
+                            os.path.dirname(__file__), weather_config.get("city_index_path", "cache/city_index.json")
+                        ),
+                        max_entries=weather_config.get("city_index_max_entries", 2000),
+                        pinned=self.city_index_seed_cities,
+                        miss_ttl=weather_config.get("city_index_miss_ttl_hours", 24) * 3600
+                    )
+
                 logger.info("[Apilot] Plugin initialized successfully")
 
             except Exception as e:
@@ -139,353 +1946,326 @@ class Apilot(PluginBase):
             self.enable = False
             self.enabled = False  # Also set system property
 
+        # Shared aiohttp session, created on enable and closed on disable
+        self.session = None
+        # In-process metrics, exported through render_metrics() or the optional HTTP endpoint
+        self.metrics = MetricsRegistry()
+        self._register_metrics()
+        self.metrics_runner = None
+        # Background tasks started on enable and cancelled on disable
+        self._background_tasks = []
+        # Live text fetches still running after their trigger was answered from the quote corpus
+        self._pending_fetches = set()
+
+    async def _get_session(self):
+        """Return the shared aiohttp session, creating it if needed"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=getattr(self, "http_connection_limit", 100),
+                limit_per_host=getattr(self, "http_limit_per_host", 10),
+                ttl_dns_cache=getattr(self, "http_dns_cache_ttl", 300),
+                keepalive_timeout=getattr(self, "http_keepalive_timeout", 30)
+            )
+            # 统计每个上游主机下载的字节数
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_response_chunk_received.append(self._on_response_chunk)
+            self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+            logger.info("[Apilot] Created shared HTTP session")
+        return self.session
+
+    async def _on_response_chunk(self, session, context, params):
+        self.upstream_bytes.inc(len(params.chunk), host=params.url.host)
+
+    async def _close_session(self):
+        """Close the shared aiohttp session"""
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logger.info("[Apilot] Closed shared HTTP session")
+        self.session = None
+
+    def _register_metrics(self):
+        """Create the plugin's metrics; component statistics are read at export time"""
+        metrics = self.metrics
+        self.trigger_latency = metrics.histogram(
+            "apilot_trigger_latency_seconds", "Time from handle_text entry until the reply has been sent, per trigger"
+        )
+        self.trigger_count = metrics.counter("apilot_triggers_total", "Matched messages by trigger and outcome")
+        self.triggers_in_flight = metrics.gauge("apilot_triggers_in_flight", "Matched messages currently being handled")
+        self.upstream_latency = metrics.histogram(
+            "apilot_upstream_latency_seconds", "Time until response headers (or failure) per upstream host"
+        )
+        self.upstream_requests = metrics.counter("apilot_upstream_requests_total", "Upstream attempts by host and status")
+        self.upstream_in_flight = metrics.gauge("apilot_upstream_in_flight", "Upstream requests currently open per host")
+        self.upstream_bytes = metrics.counter("apilot_upstream_bytes_total", "Response body bytes downloaded per upstream host")
+
+        def caches():
+            result = {}
+            for name, cache in (
+                ("response", getattr(self, "response_cache", None)),
+                ("media", getattr(self, "media_cache", None)),
+                ("video_pool", getattr(self, "video_pool", None)),
+                ("video_derivative", getattr(self, "video_cache", None))
+            ):
+                if cache is not None:
+                    result[name] = cache.stats()
+            for feature, buffer in getattr(self, "text_buffers", {}).items():
+                result[f"text_{feature}"] = buffer.stats()
+            return result
+
+        metrics.counter("apilot_cache_lookups_total", "Cache lookups by cache and result", lambda: {
+            (("cache", name), ("result", result)): stats[key]
+            for name, stats in caches().items() for result, key in (("hit", "hits"), ("miss", "misses"))
+        })
+        metrics.gauge("apilot_cache_hit_ratio", "Cache hit ratio since start", lambda: {
+            (("cache", name),): stats["hit_ratio"] for name, stats in caches().items()
+        })
+        metrics.gauge("apilot_cache_entries", "Entries held per cache", lambda: {
+            (("cache", name),): stats["entries"] for name, stats in caches().items()
+        })
+        metrics.gauge("apilot_quote_corpus_entries", "Items stored in the local quote corpus per feature", lambda: {
+            (("feature", feature),): count for feature, count in self.quote_corpus.stats()["per_feature"].items()
+        } if getattr(self, "quote_corpus", None) is not None else None)
+        metrics.counter("apilot_quote_corpus_served_total", "Replies served from the local quote corpus", lambda: (
+            self.quote_corpus.served if getattr(self, "quote_corpus", None) is not None else None
+        ))
+        metrics.counter("apilot_single_flight_calls_total", "Coalesced upstream calls by role", lambda: {
+            (("role", "leader"),): self.single_flight.leaders,
+            (("role", "follower"),): self.single_flight.followers
+        } if hasattr(self, "single_flight") else None)
+        breaker_levels = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+        metrics.gauge("apilot_circuit_breaker_state", "Circuit breaker state per host (0 closed, 1 half-open, 2 open)", lambda: {
+            (("host", host),): breaker_levels[breaker.state] for host, breaker in getattr(self, "breakers", {}).items()
+        })
+        metrics.counter("apilot_retries_total", "Retries sent and retries refused by the retry budget", lambda: {
+            (("result", "retried"),): self.retry_budget.retries,
+            (("result", "budget_exhausted"),): self.retry_budget.exhausted
+        } if hasattr(self, "retry_budget") else None)
+        metrics.counter("apilot_rate_limited_total", "Commands rejected by the rate limiter per scope", lambda: {
+            (("scope", "chat"),): self.chat_limiter.limited,
+            (("scope", "user"),): self.user_limiter.limited
+        } if hasattr(self, "chat_limiter") else None)
+        metrics.counter("apilot_alapi_token_calls_total", "ALAPI calls per pooled token", lambda: {
+            (("token", token),): usage["calls"] for token, usage in self.token_pool.stats().items()
+        } if getattr(self, "token_pool", None) is not None else None)
+
+    def render_metrics(self):
+        """Return the plugin's metrics in the Prometheus text format"""
+        return self.metrics.render()
+
+    async def _start_metrics_server(self):
+        """Serve /metrics on the configured local address"""
+        from aiohttp import web
+
+        async def handle_metrics(request):
+            return web.Response(text=self.render_metrics(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.metrics_host, self.metrics_port).start()
+        except OSError as e:
+            logger.error(f"[Apilot] Failed to start metrics endpoint on {self.metrics_host}:{self.metrics_port}: {str(e)}")
+            await runner.cleanup()
+            return
+        self.metrics_runner = runner
+        logger.info(f"[Apilot] Metrics available at http://{self.metrics_host}:{self.metrics_port}/metrics")
+
+    async def _stop_metrics_server(self):
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+            self.metrics_runner = None
+
+    def _build_dispatcher(self):
+        """Build the trigger dispatcher from the configured triggers, in matching priority order"""
+        routes = [
+            ("regex", self.news_pattern, self._handle_news),
+            ("exact", "新闻", self._handle_news),
+            ("exact", self.hitokoto_trigger, self._handle_hitokoto),
+            ("regex", self.horoscope_pattern, self._handle_horoscope),
+            ("regex", self.weather_pattern, self._handle_weather),
+            ("exact", self.dujitang_trigger, self._handle_dujitang),
+            ("exact", self.dog_diary_trigger, self._handle_dog_diary),
+            ("exact", "历史上的今天", self._handle_history),
+            ("regex", self.history_pattern, self._handle_history),
+            ("exact", self.morning_news_trigger, self._handle_morning_news),
+            ("exact", self.moyu_trigger, self._handle_moyu),
+            ("exact", self.moyu_video_trigger, self._handle_moyu_video),
+            ("exact", self.bagua_trigger, self._handle_bagua),
+            ("exact", self.bstp_trigger, self._handle_bstp),
+            ("exact", self.hstp_trigger, self._handle_hstp)
+        ]
+        for video_type in VIDEO_TYPES:
+            routes.append(("exact", getattr(self, f"{video_type}_trigger"), functools.partial(self._handle_video, video_type)))
+        routes.append(("regex", self.hot_trend_pattern, self._handle_hot_trends))
+        return TriggerDispatcher(routes)
+
     @on_text_message(priority=99)  # Increase priority to highest
     async def handle_text(self, bot: WechatAPIClient, message: dict):
         """Handle text messages"""
-        # Log that the handler was called
-        logger.info(f"[Apilot] handle_text called with message: {message.get('Content', '')[:20]}...")
-        logger.info(f"[Apilot] Plugin state: enabled={self.enabled}, enable={self.enable}")
+        started = time.perf_counter()
+        # 每条消息都会经过这里，只在 dispatch 功能开启 DEBUG 时才格式化日志
+        self.log_policy.log(
+            "dispatch", "DEBUG", "[Apilot] handle_text called with message: {}... (enabled={}, enable={})",
+            lambda: message.get('Content', '')[:20], lambda: self.enabled, lambda: self.enable
+        )
 
         # Check both system enabled state and config enabled state
         if not hasattr(self, 'enabled') or not self.enabled or not self.enable:
-            logger.warning("[Apilot] Plugin is disabled, skipping message processing")
+            self.log_policy.log("dispatch", "DEBUG", "[Apilot] Plugin is disabled, skipping message processing")
             return True  # Allow other plugins to process
 
         content = message["Content"].strip()
         from_wxid = message["FromWxid"]
-        logger.info(f"[Apilot] Processing text message: {content}")
-
-        # Handle news query
-        news_match = re.match(self.news_pattern, content)
-        if news_match or content == "新闻":
-            logger.info(f"[Apilot] Matched news query: {content}")
-            news_type = news_match.group(1) if news_match and news_match.group(1) else "综合"
-            news_content = self.get_netease_news(self.alapi_token, news_type)
-            await bot.send_text_message(from_wxid, news_content)
-            return False  # Block other plugins from processing
-
-        # Handle hitokoto (一言)
-        if content == self.hitokoto_trigger:
-            logger.info(f"[Apilot] Matched hitokoto query: {content}")
-            hitokoto = self.get_hitokoto(self.alapi_token)
-            await bot.send_text_message(from_wxid, hitokoto)
-            return False  # Block other plugins from processing
-
-        # Handle horoscope query
-        horoscope_match = re.match(self.horoscope_pattern, content)
-        if horoscope_match:
-            logger.info(f"[Apilot] Matched horoscope query: {content}")
-            if content in ZODIAC_MAPPING:
-                zodiac_english = ZODIAC_MAPPING[content]
-                horoscope_content = self.get_horoscope(self.alapi_token, zodiac_english)
-                await bot.send_text_message(from_wxid, horoscope_content)
-            else:
-                await bot.send_text_message(from_wxid, "请重新输入星座名称")
-            return False  # Block other plugins from processing
-
-        # Handle weather query
-        weather_match = re.match(self.weather_pattern, content)
-        if weather_match:
-            logger.info(f"[Apilot] Matched weather query: {content}")
-            city_or_id = weather_match.group(1) or weather_match.group(2)
-            date = weather_match.group(3)
-            if not self.alapi_token:
-                await bot.send_text_message(from_wxid, "请先配置alapi的token")
-            else:
-                weather_content = self.get_weather(self.alapi_token, city_or_id, date, content)
-                await bot.send_text_message(from_wxid, weather_content)
-            return False  # Block other plugins from processing
-
-        # Handle 毒鸡汤
-        if content == self.dujitang_trigger:
-            logger.info(f"[Apilot] Matched dujitang query: {content}")
-            dujitang_content = self.get_soul_dujitang(self.alapi_token)
-            await bot.send_text_message(from_wxid, dujitang_content)
-            return False  # Block other plugins from processing
-
-        # Handle 舔狗日记
-        if content == self.dog_diary_trigger:
-            logger.info(f"[Apilot] Matched dog diary query: {content}")
-            dog_diary_content = self.get_dog_diary(self.alapi_token)
-            await bot.send_text_message(from_wxid, dog_diary_content)
-            return False  # Block other plugins from processing
-
-        # Handle 历史上的今天
-        history_match = re.match(self.history_pattern, content)
-        if content == "历史上的今天" or history_match:
-            logger.info(f"[Apilot] Matched history query: {content}")
-            month, day = '', ''
-            if history_match:
-                month, day = history_match.group(1), history_match.group(2)
-            history_content = self.get_today_on_history(self.alapi_token, month, day)
-            await bot.send_text_message(from_wxid, history_content)
-            return False  # Block other plugins from processing
-
-        # Handle 早报
-        if content == self.morning_news_trigger:
-            logger.info(f"[Apilot] Matched morning news query: {content}")
-            morning_news = await self.get_morning_news(self.alapi_token, self.morning_news_text_enabled)
-            # 检查返回的是图片字节还是URL或文本
-            if isinstance(morning_news, bytes):
-                logger.info(f"[Apilot] Sending morning news as image bytes, size: {len(morning_news)} bytes")
-                await bot.send_image_message(from_wxid, morning_news)
-            elif self.is_valid_url(morning_news):
-                # 如果是URL，发送图片
-                logger.info(f"[Apilot] Sending morning news as image URL: {morning_news}")
-                await bot.send_image_message(from_wxid, morning_news)
-            else:
-                # 否则发送文本
-                logger.info(f"[Apilot] Sending morning news as text")
-                await bot.send_text_message(from_wxid, morning_news)
-            return False  # Block other plugins from processing
-
-        # Handle 摸鱼
-        if content == self.moyu_trigger:
-            logger.info(f"[Apilot] Matched moyu query: {content}")
-            moyu_calendar = await self.get_moyu_calendar()
-            # 检查返回的是图片字节还是URL或错误消息
-            if isinstance(moyu_calendar, bytes):
-                logger.info(f"[Apilot] Sending moyu calendar as image bytes, size: {len(moyu_calendar)} bytes")
-                await bot.send_image_message(from_wxid, moyu_calendar)
-            elif self.is_valid_url(moyu_calendar):
-                logger.info(f"[Apilot] Sending moyu calendar as image URL: {moyu_calendar}")
-                await bot.send_image_message(from_wxid, moyu_calendar)
-            else:
-                logger.info(f"[Apilot] Sending moyu calendar as text: {moyu_calendar}")
-                await bot.send_text_message(from_wxid, moyu_calendar)
-            return False  # Block other plugins from processing
-
-        # Handle 摸鱼视频
-        if content == self.moyu_video_trigger:
-            logger.info(f"[Apilot] Matched moyu video query: {content}")
-            moyu_video = await self.get_moyu_calendar_video()
-            # 检查返回的是视频字节还是URL或错误消息
-            if isinstance(moyu_video, bytes):
-                logger.info(f"[Apilot] Sending moyu video as video bytes, size: {len(moyu_video)} bytes")
-                await bot.send_video_message(from_wxid, moyu_video)
-            elif self.is_valid_url(moyu_video):
-                logger.info(f"[Apilot] Sending moyu video as video URL: {moyu_video}")
-                await bot.send_video_message(from_wxid, moyu_video)
-            else:
-                logger.info(f"[Apilot] Sending moyu video as text: {moyu_video}")
-                await bot.send_text_message(from_wxid, moyu_video)
-            return False  # Block other plugins from processing
-
-        # Handle 八卦
-        if content == self.bagua_trigger:
-            logger.info(f"[Apilot] Matched bagua query: {content}")
-            bagua = await self.get_mx_bagua()
-            # 检查返回的是图片字节还是URL或错误消息
-            if isinstance(bagua, bytes):
-                logger.info(f"[Apilot] Sending bagua as image bytes, size: {len(bagua)} bytes")
-                await bot.send_image_message(from_wxid, bagua)
-            elif self.is_valid_url(bagua):
-                logger.info(f"[Apilot] Sending bagua as image URL: {bagua}")
-                await bot.send_image_message(from_wxid, bagua)
-            else:
-                logger.info(f"[Apilot] Sending bagua as text: {bagua}")
-                await bot.send_text_message(from_wxid, bagua)
-            return False  # Block other plugins from processing
-
-        # Handle 白丝图片
-        if content == self.bstp_trigger:
-            logger.info(f"[Apilot] Matched bstp query: {content}")
-            bstp = await self.get_mx_bstp()
-            # 检查返回的是图片字节还是URL或错误消息
-            if isinstance(bstp, bytes):
-                logger.info(f"[Apilot] Sending bstp as image bytes, size: {len(bstp)} bytes")
-                await bot.send_image_message(from_wxid, bstp)
-            elif self.is_valid_url(bstp):
-                logger.info(f"[Apilot] Sending bstp as image URL: {bstp}")
-                await bot.send_image_message(from_wxid, bstp)
-            else:
-                logger.info(f"[Apilot] Sending bstp as text: {bstp}")
-                await bot.send_text_message(from_wxid, bstp)
-            return False  # Block other plugins from processing
-
-        # Handle 黑丝图片
-        if content == self.hstp_trigger:
-            logger.info(f"[Apilot] Matched hstp query: {content}")
-            hstp = await self.get_mx_hstp()
-            # 检查返回的是图片字节还是URL或错误消息
-            if isinstance(hstp, bytes):
-                logger.info(f"[Apilot] Sending hstp as image bytes, size: {len(hstp)} bytes")
-                await bot.send_image_message(from_wxid, hstp)
-            elif self.is_valid_url(hstp):
-                logger.info(f"[Apilot] Sending hstp as image URL: {hstp}")
-                await bot.send_image_message(from_wxid, hstp)
-            else:
-                logger.info(f"[Apilot] Sending hstp as text: {hstp}")
-                await bot.send_text_message(from_wxid, hstp)
-            return False  # Block other plugins from processing
-
-        # Handle 小姐姐视频
-        if content == self.xjjsp_trigger:
-            logger.info(f"[Apilot] Matched xjjsp query: {content}")
-            xjjsp = await self.get_xjjsp()
-            # 检查返回的是视频字典、URL还是错误消息
-            if isinstance(xjjsp, dict) and "video" in xjjsp:
-                video_data = xjjsp["video"]
-                cover_data = xjjsp.get("cover")
-
-                # 使用与VideoDemand插件相同的参数格式
-                logger.info(f"[Apilot] Sending xjjsp as video base64, video size: {len(video_data)} characters, cover size: {len(cover_data) if cover_data else 0} characters")
-                # 发送视频消息 - 使用与VideoSender相同的参数格式
-                client_msg_id, new_msg_id = await bot.send_video_message(
-                    from_wxid,
-                    video=video_data,
-                    image=cover_data or "None"  # 使用字符串"None"与VideoSender保持一致
-                )
-                logger.info(f"[Apilot] Video sent successfully: client_msg_id={client_msg_id}, new_msg_id={new_msg_id}")
-            elif self.is_valid_url(xjjsp):
-                logger.info(f"[Apilot] Sending xjjsp as video URL: {xjjsp}")
-                await bot.send_video_message(from_wxid, xjjsp)
-            else:
-                logger.info(f"[Apilot] Sending xjjsp as text: {xjjsp}")
-                await bot.send_text_message(from_wxid, xjjsp)
-            return False  # Block other plugins from processing
-
-        # Handle 玉足视频
-        if content == self.yzsp_trigger:
-            logger.info(f"[Apilot] Matched yzsp query: {content}")
-            yzsp = await self.get_yzsp()
-            # 检查返回的是视频字典、URL还是错误消息
-            if isinstance(yzsp, dict) and "video" in yzsp:
-                video_data = yzsp["video"]
-                cover_data = yzsp.get("cover")
-
-                # 使用与VideoDemand插件相同的参数格式
-                logger.info(f"[Apilot] Sending yzsp as video base64, video size: {len(video_data)} characters, cover size: {len(cover_data) if cover_data else 0} characters")
-                # 发送视频消息 - 使用与VideoSender相同的参数格式
-                client_msg_id, new_msg_id = await bot.send_video_message(
-                    from_wxid,
-                    video=video_data,
-                    image=cover_data or "None"  # 使用字符串"None"与VideoSender保持一致
-                )
-                logger.info(f"[Apilot] Video sent successfully: client_msg_id={client_msg_id}, new_msg_id={new_msg_id}")
-            elif self.is_valid_url(yzsp):
-                logger.info(f"[Apilot] Sending yzsp as video URL: {yzsp}")
-                await bot.send_video_message(from_wxid, yzsp)
-            else:
-                logger.info(f"[Apilot] Sending yzsp as text: {yzsp}")
-                await bot.send_text_message(from_wxid, yzsp)
-            return False  # Block other plugins from processing
-
-        # Handle 黑丝视频
-        if content == self.hssp_trigger:
-            logger.info(f"[Apilot] Matched hssp query: {content}")
-            hssp = await self.get_hssp()
-            # 检查返回的是视频字典、URL还是错误消息
-            if isinstance(hssp, dict) and "video" in hssp:
-                video_data = hssp["video"]
-                cover_data = hssp.get("cover")
-
-                # 使用与VideoDemand插件相同的参数格式
-                logger.info(f"[Apilot] Sending hssp as video base64, video size: {len(video_data)} characters, cover size: {len(cover_data) if cover_data else 0} characters")
-                # 发送视频消息 - 使用与VideoSender相同的参数格式
-                client_msg_id, new_msg_id = await bot.send_video_message(
-                    from_wxid,
-                    video=video_data,
-                    image=cover_data or "None"  # 使用字符串"None"与VideoSender保持一致
-                )
-                logger.info(f"[Apilot] Video sent successfully: client_msg_id={client_msg_id}, new_msg_id={new_msg_id}")
-            elif self.is_valid_url(hssp):
-                logger.info(f"[Apilot] Sending hssp as video URL: {hssp}")
-                await bot.send_video_message(from_wxid, hssp)
-            else:
-                logger.info(f"[Apilot] Sending hssp as text: {hssp}")
-                await bot.send_text_message(from_wxid, hssp)
-            return False  # Block other plugins from processing
-
-        # Handle cos视频
-        if content == self.cos_trigger:
-            logger.info(f"[Apilot] Matched cos query: {content}")
-            cos = await self.get_cos()
-            # 检查返回的是视频字典、URL还是错误消息
-            if isinstance(cos, dict) and "video" in cos:
-                video_data = cos["video"]
-                cover_data = cos.get("cover")
-
-                # 使用与VideoDemand插件相同的参数格式
-                logger.info(f"[Apilot] Sending cos as video base64, video size: {len(video_data)} characters, cover size: {len(cover_data) if cover_data else 0} characters")
-                # 发送视频消息 - 使用与VideoSender相同的参数格式
-                client_msg_id, new_msg_id = await bot.send_video_message(
-                    from_wxid,
-                    video=video_data,
-                    image=cover_data or "None"  # 使用字符串"None"与VideoSender保持一致
-                )
-                logger.info(f"[Apilot] Video sent successfully: client_msg_id={client_msg_id}, new_msg_id={new_msg_id}")
-            elif self.is_valid_url(cos):
-                logger.info(f"[Apilot] Sending cos as video URL: {cos}")
-                await bot.send_video_message(from_wxid, cos)
-            else:
-                logger.info(f"[Apilot] Sending cos as text: {cos}")
-                await bot.send_text_message(from_wxid, cos)
-            return False  # Block other plugins from processing
-
-        # Handle 吊带视频
-        if content == self.ddsp_trigger:
-            logger.info(f"[Apilot] Matched ddsp query: {content}")
-            ddsp = await self.get_ddsp()
-            # 检查返回的是视频字典、URL还是错误消息
-            if isinstance(ddsp, dict) and "video" in ddsp:
-                video_data = ddsp["video"]
-                cover_data = ddsp.get("cover")
 
-                # 使用与VideoDemand插件相同的参数格式
-                logger.info(f"[Apilot] Sending ddsp as video base64, video size: {len(video_data)} characters, cover size: {len(cover_data) if cover_data else 0} characters")
-                # 发送视频消息 - 使用与VideoSender相同的参数格式
-                client_msg_id, new_msg_id = await bot.send_video_message(
-                    from_wxid,
-                    video=video_data,
-                    image=cover_data or "None"  # 使用字符串"None"与VideoSender保持一致
-                )
-                logger.info(f"[Apilot] Video sent successfully: client_msg_id={client_msg_id}, new_msg_id={new_msg_id}")
-            elif self.is_valid_url(ddsp):
-                logger.info(f"[Apilot] Sending ddsp as video URL: {ddsp}")
-                await bot.send_video_message(from_wxid, ddsp)
-            else:
-                logger.info(f"[Apilot] Sending ddsp as text: {ddsp}")
-                await bot.send_text_message(from_wxid, ddsp)
-            return False  # Block other plugins from processing
-
-        # Handle JK视频
-        if content == self.jksp_trigger:
-            logger.info(f"[Apilot] Matched jksp query: {content}")
-            jksp = await self.get_jksp()
-            # 检查返回的是视频字典、URL还是错误消息
-            if isinstance(jksp, dict) and "video" in jksp:
-                video_data = jksp["video"]
-                cover_data = jksp.get("cover")
+        route = self.dispatcher.match(content)
+        if route is None:
+            # Allow other plugins to process if no match
+            self.log_policy.log("dispatch", "DEBUG", "[Apilot] No match found for message: {}", lambda: content[:20])
+            return True
+
+        handler, match = route
+        trigger = _handler_name(handler)
+        if not self._check_rate_limit(from_wxid, message):
+            logger.info(f"[Apilot] Rate limited {from_wxid}: {content}")
+            self.trigger_count.inc(trigger=trigger, outcome="rate_limited")
+            # 每个会话在提示间隔内只提醒一次，其余超限请求直接忽略
+            if self.rate_limit_notices.get(from_wxid) is None:
+                self.rate_limit_notices.set(from_wxid, True, self.rate_limit_notice_interval)
+                await bot.send_text_message(from_wxid, self.rate_limit_message)
+            return False
 
-                # 使用与VideoDemand插件相同的参数格式
-                logger.info(f"[Apilot] Sending jksp as video base64, video size: {len(video_data)} characters, cover size: {len(cover_data) if cover_data else 0} characters")
-                # 发送视频消息 - 使用与VideoSender相同的参数格式
-                client_msg_id, new_msg_id = await bot.send_video_message(
-                    from_wxid,
-                    video=video_data,
-                    image=cover_data or "None"  # 使用字符串"None"与VideoSender保持一致
-                )
-                logger.info(f"[Apilot] Video sent successfully: client_msg_id={client_msg_id}, new_msg_id={new_msg_id}")
-            elif self.is_valid_url(jksp):
-                logger.info(f"[Apilot] Sending jksp as video URL: {jksp}")
-                await bot.send_video_message(from_wxid, jksp)
-            else:
-                logger.info(f"[Apilot] Sending jksp as text: {jksp}")
-                await bot.send_text_message(from_wxid, jksp)
-            return False  # Block other plugins from processing
-
-        # Handle 萝莉视频
-        if content == self.llsp_trigger:
-            logger.info(f"[Apilot] Matched llsp query: {content}")
-            llsp = await self.get_llsp()
-            # 检查返回的是视频字典、URL还是错误消息
-            if isinstance(llsp, dict) and "video" in llsp:
-                video_data = llsp["video"]
-                cover_data = llsp.get("cover")
+        outcome = "error"
+        self.triggers_in_flight.inc()
+        try:
+            await handler(bot, from_wxid, content, match)
+            outcome = "ok"
+        finally:
+            self.triggers_in_flight.dec()
+            self.trigger_latency.observe(time.perf_counter() - started, trigger=trigger)
+            self.trigger_count.inc(trigger=trigger, outcome=outcome)
+        return False  # Block other plugins from processing
+
+    def _check_rate_limit(self, from_wxid, message):
+        """Spend one token from the sender's bucket (in groups) and the chat's bucket"""
+        if not getattr(self, "rate_limit_enabled", False):
+            return True
+        # 先检查发送者，避免刷屏的成员耗尽整个群的额度
+        sender = message.get("SenderWxid")
+        if from_wxid.endswith("@chatroom") and sender and not self.user_limiter.allow(sender):
+            return False
+        return self.chat_limiter.allow(from_wxid)
+
+    async def _handle_news(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched news query: {content}")
+        news_type = match.group(1) if match and match.group(1) else "综合"
+        news_content = await self.get_netease_news(self.alapi_token, news_type)
+        await bot.send_text_message(from_wxid, news_content)
+
+    async def _handle_hitokoto(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched hitokoto query: {content}")
+        hitokoto = await self._get_buffered_text("hitokoto", from_wxid)
+        await bot.send_text_message(from_wxid, hitokoto)
+
+    async def _handle_horoscope(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched horoscope query: {content}")
+        if content in ZODIAC_MAPPING:
+            zodiac_english = ZODIAC_MAPPING[content]
+            horoscope_content = await self.get_horoscope(self.alapi_token, zodiac_english)
+            await bot.send_text_message(from_wxid, horoscope_content)
+        else:
+            await bot.send_text_message(from_wxid, "请重新输入星座名称")
+
+    async def _handle_weather(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched weather query: {content}")
+        city_or_id = match.group(1) or match.group(2)
+        date = match.group(3)
+        if not self.alapi_token:
+            await bot.send_text_message(from_wxid, "请先配置alapi的token")
+        else:
+            weather_content = await self.get_weather(self.alapi_token, city_or_id, date, content)
+            await bot.send_text_message(from_wxid, weather_content)
+
+    async def _handle_dujitang(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched dujitang query: {content}")
+        dujitang_content = await self._get_buffered_text("dujitang", from_wxid)
+        await bot.send_text_message(from_wxid, dujitang_content)
+
+    async def _handle_dog_diary(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched dog diary query: {content}")
+        dog_diary_content = await self._get_buffered_text("dog_diary", from_wxid)
+        await bot.send_text_message(from_wxid, dog_diary_content)
+
+    async def _handle_history(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched history query: {content}")
+        month, day = '', ''
+        if match:
+            month, day = match.group(1), match.group(2)
+        history_content = await self.get_today_on_history(self.alapi_token, month, day)
+        await bot.send_text_message(from_wxid, history_content)
+
+    async def _handle_morning_news(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched morning news query: {content}")
+        morning_news = await self._get_daily_media("morning_news")
+        await self._send_image_result(bot, from_wxid, morning_news, "morning news")
+
+    async def _handle_moyu(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched moyu query: {content}")
+        moyu_calendar = await self._get_daily_media("moyu_calendar")
+        await self._send_image_result(bot, from_wxid, moyu_calendar, "moyu calendar")
+
+    async def _handle_moyu_video(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched moyu video query: {content}")
+        moyu_video = await self.get_moyu_calendar_video()
+        # 检查返回的是视频字节还是URL或错误消息
+        if isinstance(moyu_video, bytes):
+            logger.info(f"[Apilot] Sending moyu video as video bytes, size: {len(moyu_video)} bytes")
+            await bot.send_video_message(from_wxid, moyu_video)
+        elif self.is_valid_url(moyu_video):
+            logger.info(f"[Apilot] Sending moyu video as video URL: {moyu_video}")
+            await bot.send_video_message(from_wxid, moyu_video)
+        else:
+            logger.info(f"[Apilot] Sending moyu video as text: {moyu_video}")
+            await bot.send_text_message(from_wxid, moyu_video)
+
+    async def _handle_bagua(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched bagua query: {content}")
+        bagua = await self._get_daily_media("bagua")
+        await self._send_image_result(bot, from_wxid, bagua, "bagua")
+
+    async def _handle_bstp(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched bstp query: {content}")
+        bstp = await self.get_mx_bstp()
+        await self._send_image_result(bot, from_wxid, bstp, "bstp")
+
+    async def _handle_hstp(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched hstp query: {content}")
+        hstp = await self.get_mx_hstp()
+        await self._send_image_result(bot, from_wxid, hstp, "hstp")
+
+    async def _handle_video(self, video_type, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched {video_type} query: {content}")
+        # 优先使用后台预先准备好的视频，缓冲区为空时才现场获取
+        result = None
+        if self.video_pool is not None and video_type in self.video_pool:
+            result = self.video_pool.take(video_type)
+        if result is not None:
+            logger.info(f"[Apilot] Serving pre-warmed {video_type} video")
+        else:
+            result = await getattr(self, f"get_{video_type}")()
+        # 检查返回的是视频字典、URL还是错误消息
+        if isinstance(result, dict) and "video" in result:
+            video = result["video"]
+            cover = result.get("cover")
+            try:
+                # 在调用发送接口时才编码，编码结果只生成一次；编码在线程中进行，不阻塞事件循环
+                video_data = await asyncio.to_thread(video.encode)
+                cover_data = await asyncio.to_thread(cover.encode) if cover else None
+                peak_bytes = video.peak_bytes + (cover.peak_bytes if cover else 0)
 
                 # 使用与VideoDemand插件相同的参数格式
-                logger.info(f"[Apilot] Sending llsp as video base64, video size: {len(video_data)} characters, cover size: {len(cover_data) if cover_data else 0} characters")
+                logger.info(f"[Apilot] Sending {video_type} as video base64, video size: {len(video_data)} characters, cover size: {len(cover_data) if cover_data else 0} characters, peak memory: {peak_bytes / 1024 / 1024:.1f}MB")
                 # 发送视频消息 - 使用与VideoSender相同的参数格式
                 client_msg_id, new_msg_id = await bot.send_video_message(
                     from_wxid,
@@ -493,26 +2273,35 @@ class Apilot(PluginBase):
                     image=cover_data or "None"  # 使用字符串"None"与VideoSender保持一致
                 )
                 logger.info(f"[Apilot] Video sent successfully: client_msg_id={client_msg_id}, new_msg_id={new_msg_id}")
-            elif self.is_valid_url(llsp):
-                logger.info(f"[Apilot] Sending llsp as video URL: {llsp}")
-                await bot.send_video_message(from_wxid, llsp)
-            else:
-                logger.info(f"[Apilot] Sending llsp as text: {llsp}")
-                await bot.send_text_message(from_wxid, llsp)
-            return False  # Block other plugins from processing
-
-        # Handle 热榜
-        hot_trend_match = re.match(self.hot_trend_pattern, content)
-        if hot_trend_match:
-            logger.info(f"[Apilot] Matched hot trend query: {content}")
-            hot_trends_type = hot_trend_match.group(1).strip()  # 提取匹配的组并去掉可能的空格
-            hot_trends_content = self.get_hot_trends(hot_trends_type)
-            await bot.send_text_message(from_wxid, hot_trends_content)
-            return False  # Block other plugins from processing
-
-        # Allow other plugins to process if no match
-        logger.info("[Apilot] No match found for message, allowing other plugins to process")
-        return True
+            finally:
+                video.close()
+                if cover:
+                    cover.close()
+        elif self.is_valid_url(result):
+            logger.info(f"[Apilot] Sending {video_type} as video URL: {result}")
+            await bot.send_video_message(from_wxid, result)
+        else:
+            self.log_policy.log(f"video_{video_type}", "INFO", "[Apilot] Sending {} as text: {}", lambda: video_type, lambda: _truncate(result, self.log_policy.max_payload_chars))
+            await bot.send_text_message(from_wxid, result)
+
+    async def _handle_hot_trends(self, bot, from_wxid, content, match):
+        logger.info(f"[Apilot] Matched hot trend query: {content}")
+        hot_trends_type = match.group(1).strip()  # 提取匹配的组并去掉可能的空格
+        hot_trends_content = await self.get_hot_trends(hot_trends_type)
+        await bot.send_text_message(from_wxid, hot_trends_content)
+
+    async def _send_image_result(self, bot, from_wxid, result, label):
+        """Send an image fetch result, which may be image bytes, an image URL or a text message"""
+        # 检查返回的是图片字节还是URL或错误消息
+        if isinstance(result, bytes):
+            logger.info(f"[Apilot] Sending {label} as image bytes, size: {len(result)} bytes")
+            await bot.send_image_message(from_wxid, result)
+        elif self.is_valid_url(result):
+            logger.info(f"[Apilot] Sending {label} as image URL: {result}")
+            await bot.send_image_message(from_wxid, result)
+        else:
+            self.log_policy.log(label.replace(" ", "_"), "INFO", "[Apilot] Sending {} as text: {}", lambda: label, lambda: _truncate(result, self.log_policy.max_payload_chars))
+            await bot.send_text_message(from_wxid, result)
 
     def get_help_text(self, verbose=False):
         """Return help text for the plugin"""
@@ -544,8 +2333,13 @@ class Apilot(PluginBase):
 
         return help_text
 
-    def get_hitokoto(self, alapi_token):
+    async def get_hitokoto(self, alapi_token):
         """Get a random Hitokoto quote"""
+        _, text = await self._fetch_hitokoto(alapi_token)
+        return text
+
+    async def _fetch_hitokoto(self, alapi_token):
+        """Fetch a random Hitokoto quote; returns (ok, text) where text is the reply or an error message"""
         logger.info("[Apilot] Getting hitokoto")
         url = BASE_URL_ALAPI + "hitokoto"
         hitokoto_type = 'abcdefghijkl'
@@ -557,14 +2351,14 @@ class Apilot(PluginBase):
         headers = {"Content-Type": "application/json"}
         try:
             logger.info(f"[Apilot] Making hitokoto request to {url}")
-            hitokoto_data = self.make_request(url, method="POST", headers=headers, json_data=payload)
-            logger.info(f"[Apilot] Hitokoto API response: {hitokoto_data}")
+            hitokoto_data = await self.make_request(url, method="POST", headers=headers, json_data=payload)
+            self.log_policy.payload("hitokoto", "Hitokoto API response", hitokoto_data)
 
             if isinstance(hitokoto_data, dict) and hitokoto_data.get("code") == 200:
                 data = hitokoto_data.get("data", {})
                 if not isinstance(data, dict):
                     logger.error(f"[Apilot] Hitokoto data is not a dictionary: {data}")
-                    return "一言获取失败，请稍后再试"
+                    return False, "一言获取失败，请稍后再试"
 
                 format_data = (
                     f"【Hitokoto一言】\n"
@@ -572,19 +2366,19 @@ class Apilot(PluginBase):
                     f"🎐type: {hitokoto_type_dict.get(hitokoto_type[random_type], '未知')}\n"
                     f"🥷author: {data.get('from', '未知')}"
                 )
-                return format_data
+                return True, format_data
             else:
                 error_msg = "一言获取失败，请稍后再试"
                 if isinstance(hitokoto_data, dict) and "error" in hitokoto_data:
                     error_msg += f"（{hitokoto_data['error']}）"
                 logger.error(f"[Apilot] Hitokoto API error: {hitokoto_data}")
-                return error_msg
+                return False, error_msg
         except Exception as e:
             logger.error(f"[Apilot] Exception in get_hitokoto: {str(e)}")
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
-            return f"获取一言时出错: {str(e)}"
+            return False, f"获取一言时出错: {str(e)}"
 
-    def get_horoscope(self, alapi_token, zodiac_english):
+    async def get_horoscope(self, alapi_token, zodiac_english):
         """Get horoscope information for a zodiac sign"""
         logger.info(f"[Apilot] Getting horoscope for zodiac: {zodiac_english}")
         url = BASE_URL_ALAPI + "star"
@@ -595,12 +2389,12 @@ class Apilot(PluginBase):
         headers = {"Content-Type": "application/json"}
         try:
             logger.info(f"[Apilot] Making horoscope request to {url}")
-            horoscope_data = self.make_request(url, method="POST", headers=headers, json_data=payload)
-            logger.info(f"[Apilot] Horoscope API response: {horoscope_data}")
+            horoscope_data = await self.make_request(url, method="POST", headers=headers, json_data=payload)
+            self.log_policy.payload("horoscope", "Horoscope API response", horoscope_data)
 
             if isinstance(horoscope_data, dict) and horoscope_data.get("code") == 200:
                 data = horoscope_data.get("data", {})
-                logger.info(f"[Apilot] Horoscope data: {data}")
+                self.log_policy.payload("horoscope", "Horoscope data", data)
 
                 if not isinstance(data, dict):
                     logger.error(f"[Apilot] Horoscope data is not a dictionary: {data}")
@@ -637,7 +2431,7 @@ class Apilot(PluginBase):
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
             return f"获取星座信息时出错: {str(e)}"
 
-    def get_weather(self, alapi_token, city_or_id, date, content):
+    async def get_weather(self, alapi_token, city_or_id, date, content):
         """Get weather information for a city"""
         logger.info(f"[Apilot] Getting weather for city_or_id={city_or_id}, date={date}")
 
@@ -655,30 +2449,37 @@ class Apilot(PluginBase):
             }
             logger.info(f"[Apilot] Using city_id: {city_or_id}")
         else:
-            city_info = self.check_multiple_city_ids(city_or_id)
-            if city_info:
-                data = city_info['data']
+            city_entries = await self.lookup_city_ids(city_or_id)
+            if city_entries and len(city_entries) > 1:
                 formatted_city_info = "\n".join(
                     [f"{idx + 1}) {entry['province']}--{entry['leader']}, ID: {entry['city_id']}"
-                     for idx, entry in enumerate(data)]
+                     for idx, entry in enumerate(city_entries)]
                 )
                 logger.info(f"[Apilot] Multiple cities found for {city_or_id}")
                 return f'查询 <{city_or_id}> 具有多条数据：\n{formatted_city_info}\n请使用id查询，发送"id天气"'
 
-            params = {
-                'city': city_or_id,
-                'token': f'{alapi_token}'
-            }
-            logger.info(f"[Apilot] Using city name: {city_or_id}")
+            if city_entries:
+                # 城市名唯一，直接按city_id查询
+                params = {
+                    'city_id': city_entries[0]['city_id'],
+                    'token': f'{alapi_token}'
+                }
+                logger.info(f"[Apilot] Resolved city {city_or_id} to city_id: {city_entries[0]['city_id']}")
+            else:
+                params = {
+                    'city': city_or_id,
+                    'token': f'{alapi_token}'
+                }
+                logger.info(f"[Apilot] Using city name: {city_or_id}")
 
         try:
             logger.info(f"[Apilot] Making weather request to {url} with params: {params}")
-            weather_data = self.make_request(url, params=params)
-            logger.info(f"[Apilot] Weather API response: {weather_data}")
+            weather_data = await self.make_request(url, params=params)
+            self.log_policy.payload("weather", "Weather API response", weather_data)
 
             if isinstance(weather_data, dict) and weather_data.get("code") == 200:
                 data = weather_data.get("data", {})
-                logger.info(f"[Apilot] Weather data: {data}")
+                self.log_policy.payload("weather", "Weather data", data)
 
                 if isFuture:
                     # 未来天气API返回的是一个列表
@@ -1223,7 +3024,7 @@ class Apilot(PluginBase):
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
             return f"获取天气信息时出错: {str(e)}"
 
-    def get_netease_news(self, alapi_token, news_type="综合"):
+    async def get_netease_news(self, alapi_token, news_type="综合"):
         """Get news from NetEase"""
         logger.info(f"[Apilot] Getting news for type: {news_type}")
         url = BASE_URL_ALAPI + "new/toutiao"
@@ -1274,12 +3075,12 @@ class Apilot(PluginBase):
         headers = {"Content-Type": "application/json"}
         try:
             logger.info(f"[Apilot] Making GET news request to {url} with params: {params}")
-            news_data = self.make_request(url, method="GET", params=params, headers=headers)
-            logger.info(f"[Apilot] News API response: {news_data}")
+            news_data = await self.make_request(url, method="GET", params=params, headers=headers)
+            self.log_policy.payload("news", "News API response", news_data)
 
             if isinstance(news_data, dict) and news_data.get("code") == 200:
                 data = news_data.get("data", [])
-                logger.info(f"[Apilot] News data: {data}")
+                self.log_policy.payload("news", "News data", data)
 
                 # 检查data是否为列表
                 if isinstance(data, list):
@@ -1332,37 +3133,241 @@ class Apilot(PluginBase):
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
             return f"获取新闻时出错: {str(e)}"
 
-    def check_multiple_city_ids(self, city_name):
-        """Check if a city name has multiple IDs"""
+    async def lookup_city_ids(self, city_name):
+        """Look up the city_id entries for a city name, from the local city index or tianqi/citylist"""
+        if self.city_index is not None:
+            entries = self.city_index.lookup(city_name)
+            if entries is not None:
+                return entries
+        entries = await self._fetch_city_list(city_name)
+        # 查不到的名称只进入内存中的短期未命中缓存，不会写入索引
+        if entries is not None and self.city_index is not None:
+            await self.city_index.record(city_name, entries)
+        return entries
+
+    async def _fetch_city_list(self, city_name):
+        """Fetch the city_id entries for a city name from tianqi/citylist, or None on failure"""
         url = BASE_URL_ALAPI + 'tianqi/citylist'
         params = {
             'token': self.alapi_token,
             'city': city_name
         }
         try:
-            response = self.make_request(url, params=params)
+            response = await self.make_request(url, params=params)
             if isinstance(response, dict) and response.get("code") == 200:
-                data = response.get("data", [])
-                if len(data) > 1:
-                    return response
+                data = response.get("data") or []
+                return [
+                    {
+                        "city_id": entry.get("city_id"),
+                        "city": entry.get("city", city_name),
+                        "province": entry.get("province", ""),
+                        "leader": entry.get("leader", "")
+                    }
+                    for entry in data if isinstance(entry, dict) and entry.get("city_id")
+                ]
             return None
         except Exception as e:
             logger.error(f"[Apilot] Error checking city IDs: {str(e)}")
             return None
 
-    def make_request(self, url, method="GET", params=None, headers=None, json_data=None):
-        """Make an HTTP request to an API"""
-        try:
-            if method.upper() == "GET":
-                response = requests.get(url, params=params, headers=headers, timeout=10)
-            else:
-                response = requests.post(url, params=params, headers=headers, json=json_data, timeout=10)
+    async def _refresh_city_index_loop(self):
+        """Build and refresh the local city index in the background, pacing requests to spare the quota"""
+        max_age = self.city_index_refresh_days * 86400
+        while True:
+            for city_name in self.city_index.stale_names(self.city_index_seed_cities, max_age):
+                entries = await self._fetch_city_list(city_name)
+                if entries is not None:
+                    await self.city_index.record(city_name, entries)
+                await asyncio.sleep(self.city_index_request_interval)
+            await asyncio.sleep(3600)
+
+    @contextlib.asynccontextmanager
+    async def _open(self, method, url, timeout=10, **kwargs):
+        """Open an HTTP request on the shared session without blocking the event loop
+
+        Idempotent requests that fail with a connection error, a timeout or a
+        retryable status are retried with backoff before the response is handed
+        out, within the global retry budget. Raises UpstreamUnavailable without
+        sending anything while the host's circuit breaker is open.
+        """
+        host = urlparse(url).hostname
+        policy = self._retry_policy_for(method, url)
+        if policy.max_attempts > 1:
+            self.retry_budget.deposit()
+        session = await self._get_session()
+        attempt = 0
+        while True:
+            attempt += 1
+            await self._throttle_outbound(url)
+            breaker = self._get_breaker(url)
+            if breaker is not None and not breaker.allow():
+                self.upstream_requests.inc(host=host, status="circuit_open")
+                raise UpstreamUnavailable(host)
+            recorded = False
+            yielded = False
+            status = "cancelled"
+            started = time.perf_counter()
+            self.upstream_in_flight.inc(host=host)
+            try:
+                async with session.request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as response:
+                    status = response.status
+                    self.upstream_latency.observe(time.perf_counter() - started, host=host)
+                    if breaker is not None:
+                        # 5xx 视为上游故障，4xx 属于请求本身的问题
+                        breaker.record(response.status < 500)
+                        recorded = True
+                    if not (response.status in policy.retry_statuses and self._may_retry(policy, attempt)):
+                        yielded = True
+                        yield response
+                        return
+                    reason = f"status {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not yielded:
+                    status = "timeout" if isinstance(e, asyncio.TimeoutError) else "error"
+                    self.upstream_latency.observe(time.perf_counter() - started, host=host)
+                if breaker is not None and not recorded:
+                    breaker.record(False)
+                    recorded = True
+                # 响应交给调用方之后的异常不重试；熔断器已打开时也不再重试
+                if yielded or isinstance(e, UpstreamUnavailable) or not self._may_retry(policy, attempt):
+                    raise
+                reason = str(e) or type(e).__name__
+            finally:
+                self.upstream_in_flight.dec(host=host)
+                self.upstream_requests.inc(host=host, status=status)
+                if breaker is not None and not recorded:
+                    breaker.abandon()
+            delay = policy.backoff(attempt)
+            logger.warning(f"[Apilot] {method} {url} failed ({reason}), retrying in {delay:.2f}s (attempt {attempt + 1}/{policy.max_attempts})")
+            await asyncio.sleep(delay)
+
+    def _retry_policy_for(self, method, url):
+        """Return the retry policy for a request; non-idempotent requests get a single attempt"""
+        # ALAPI 的 POST 接口都是只读查询，可以安全重试
+        if not getattr(self, "retry_enabled", False) or (method.upper() not in ("GET", "HEAD") and not url.startswith(BASE_URL_ALAPI)):
+            return NO_RETRY
+        for prefix, policy in self.endpoint_retry_policies:
+            if url.startswith(prefix):
+                return policy
+        return self.retry_policy
+
+    def _may_retry(self, policy, attempt):
+        return attempt < policy.max_attempts and self.retry_budget.withdraw()
+
+    async def _throttle_outbound(self, url):
+        """Wait for a token from the host's outbound bucket, if the host has a configured rate"""
+        limiter = getattr(self, "host_limiters", {}).get(urlparse(url).hostname)
+        if limiter is not None:
+            delay = limiter.reserve("")
+            if delay > 0:
+                logger.debug(f"[Apilot] Throttling request to {url} for {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    def _get_breaker(self, url):
+        """Return the circuit breaker for the URL's host, or None when breakers are disabled"""
+        if not getattr(self, "breaker_enabled", False):
+            return None
+        host = urlparse(url).hostname
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(**self.breaker_settings)
+            self.breakers[host] = breaker
+        return breaker
+
+    def get_breaker_states(self):
+        """Return the circuit breaker state of every upstream host contacted so far"""
+        return {host: breaker.snapshot() for host, breaker in self.breakers.items()}
+
+    async def make_request(self, url, method="GET", params=None, headers=None, json_data=None, data=None):
+        """Make an HTTP request to an API, serving cacheable ALAPI endpoints from the TTL cache"""
+        cache_key, ttl = None, None
+        if url.startswith(BASE_URL_ALAPI):
+            endpoint = url[len(BASE_URL_ALAPI):]
+            ttl = self.cache_ttls.get(endpoint)
+            if ttl:
+                cache_key = self._cache_key(endpoint, params, json_data)
+                if self.cache_enabled:
+                    cached = self.response_cache.get(cache_key)
+                    if cached is not None:
+                        logger.debug(f"[Apilot] Cache hit for {endpoint}")
+                        # 缓存中的结果是共享的，调用方拿到的是副本
+                        return copy.deepcopy(cached)
+
+        send = self._send_request
+        if url.startswith(BASE_URL_ALAPI) and getattr(self, "token_pool", None) is not None:
+            send = self._send_alapi_request
+
+        if cache_key is None:
+            return await send(url, method, params, headers, json_data, data)
+
+        async def fetch():
+            result = await send(url, method, params, headers, json_data, data)
+            if self.cache_enabled and isinstance(result, dict) and result.get("code") == 200:
+                self.response_cache.set(cache_key, result, ttl)
+            return result
+
+        # Identical concurrent queries for deterministic endpoints share one upstream call;
+        # the shared result (also held by the cache) is copied for each caller
+        return copy.deepcopy(await self.single_flight.do(cache_key, fetch))
+
+    async def _send_alapi_request(self, url, method="GET", params=None, headers=None, json_data=None, data=None):
+        """Send an ALAPI request with a token from the pool, failing over once if its quota is exhausted"""
+        result = None
+        tried = []
+        for _ in range(2):
+            token = self.token_pool.acquire(exclude=tried)
+            if token is None:
+                break
+            tried.append(token)
+            # 替换调用方传入的token
+            if isinstance(params, dict) and "token" in params:
+                params = {**params, "token": token}
+            if isinstance(json_data, dict) and "token" in json_data:
+                json_data = {**json_data, "token": token}
+            result = await self._send_request(url, method, params, headers, json_data, data)
+            quota_exceeded = self._is_quota_error(result)
+            self.token_pool.report(
+                token, isinstance(result, dict) and result.get("code") == 200, quota_exceeded
+            )
+            if not quota_exceeded:
+                break
+        return result
 
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+    def _is_quota_error(self, result):
+        """Return True if an ALAPI result says the token ran out of quota or hit its QPS limit"""
+        if not isinstance(result, dict):
+            return False
+        if result.get("status") in self.quota_error_codes or result.get("code") in self.quota_error_codes:
+            return True
+        message = str(result.get("message") or result.get("msg") or "")
+        return result.get("code") != 200 and any(keyword in message for keyword in self.quota_error_keywords)
+
+    def _cache_key(self, endpoint, params=None, json_data=None):
+        """Build a cache key from the endpoint and its params (sorted, whitespace-stripped), ignoring the token"""
+        merged = {}
+        for source in (params, json_data):
+            if isinstance(source, dict):
+                merged.update(source)
+        normalized = tuple(sorted(
+            (str(key), str(value).strip()) for key, value in merged.items() if key != "token"
+        ))
+        return endpoint, normalized
+
+    async def _send_request(self, url, method="GET", params=None, headers=None, json_data=None, data=None):
+        """Send a single HTTP request and parse the JSON body"""
+        try:
+            async with self._open(method.upper(), url, params=params, headers=headers, json=json_data, data=data) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except aiohttp.ClientResponseError as e:
+            logger.error(f"[Apilot] Request error: {str(e)}")
+            return {"error": str(e), "status": e.status}
+        except aiohttp.ClientError as e:
             logger.error(f"[Apilot] Request error: {str(e)}")
             return {"error": str(e)}
+        except asyncio.TimeoutError:
+            logger.error(f"[Apilot] Request timeout: {url}")
+            return {"error": "Request timeout"}
         except ValueError as e:
             logger.error(f"[Apilot] JSON parsing error: {str(e)}")
             return {"error": "Invalid JSON response"}
@@ -1370,40 +3375,50 @@ class Apilot(PluginBase):
             logger.error(f"[Apilot] Unexpected error: {str(e)}")
             return {"error": str(e)}
 
-    def get_soul_dujitang(self, alapi_token):
+    async def get_soul_dujitang(self, alapi_token):
         """Get a random soul chicken soup quote"""
+        _, text = await self._fetch_soul_dujitang(alapi_token)
+        return text
+
+    async def _fetch_soul_dujitang(self, alapi_token):
+        """Fetch a random soul chicken soup quote; returns (ok, text)"""
         logger.info("[Apilot] Getting soul dujitang")
         url = BASE_URL_ALAPI + "soul"
         payload = {"token": alapi_token}
         headers = {'Content-Type': "application/json"}
         try:
             logger.info(f"[Apilot] Making soul dujitang request to {url}")
-            soul_data = self.make_request(url, method="POST", headers=headers, json_data=payload)
-            logger.info(f"[Apilot] Soul dujitang API response: {soul_data}")
+            soul_data = await self.make_request(url, method="POST", headers=headers, json_data=payload)
+            self.log_policy.payload("dujitang", "Soul dujitang API response", soul_data)
 
             if isinstance(soul_data, dict) and soul_data.get('code') == 200:
                 data = soul_data.get('data', {})
                 if not isinstance(data, dict):
                     logger.error(f"[Apilot] Soul dujitang data is not a dictionary: {data}")
-                    return "毒鸡汤获取失败，请稍后再试"
+                    return False, "毒鸡汤获取失败，请稍后再试"
 
                 content = data.get('content', '未知')
                 # 格式化并返回 ALAPI 提供的心灵毒鸡汤信息
                 result = f"💡【今日心灵毒鸡汤】\n{content}\n"
-                return result
+                return True, result
             else:
                 error_msg = "毒鸡汤获取失败，请稍后再试"
                 if isinstance(soul_data, dict) and "error" in soul_data:
                     error_msg += f"（{soul_data['error']}）"
                 logger.error(f"[Apilot] Soul dujitang API error: {soul_data}")
-                return error_msg
+                return False, error_msg
         except Exception as e:
             logger.error(f"[Apilot] Exception in get_soul_dujitang: {str(e)}")
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
-            return f"获取毒鸡汤时出错: {str(e)}"
+            return False, f"获取毒鸡汤时出错: {str(e)}"
 
-    def get_dog_diary(self, alapi_token):
+    async def get_dog_diary(self, alapi_token):
         """Get a random dog diary entry"""
+        _, text = await self._fetch_dog_diary(alapi_token)
+        return text
+
+    async def _fetch_dog_diary(self, alapi_token):
+        """Fetch a random dog diary entry; returns (ok, text)"""
         logger.info("[Apilot] Getting dog diary")
         url = BASE_URL_ALAPI + "dog"
         payload = {
@@ -1413,31 +3428,31 @@ class Apilot(PluginBase):
         headers = {"Content-Type": "application/json"}
         try:
             logger.info(f"[Apilot] Making dog diary request to {url}")
-            dog_diary_data = self.make_request(url, method='POST', headers=headers, json_data=payload)
-            logger.info(f"[Apilot] Dog diary API response: {dog_diary_data}")
+            dog_diary_data = await self.make_request(url, method='POST', headers=headers, json_data=payload)
+            self.log_policy.payload("dog_diary", "Dog diary API response", dog_diary_data)
 
             if isinstance(dog_diary_data, dict) and dog_diary_data.get('code') == 200:
                 data = dog_diary_data.get('data', {})
                 if not isinstance(data, dict):
                     logger.error(f"[Apilot] Dog diary data is not a dictionary: {data}")
-                    return "舔狗日记获取失败，请稍后再试"
+                    return False, "舔狗日记获取失败，请稍后再试"
 
                 content = data.get('content', '未知')
                 format_output = (
                     "【（づ￣3￣）づ╭❤️～舔狗日记】  \n  "
                     f"  🐶{content}"
                 )
-                return format_output
+                return True, format_output
             else:
                 error_msg = "舔狗日记获取失败，请稍后再试"
                 if isinstance(dog_diary_data, dict) and "error" in dog_diary_data:
                     error_msg += f"（{dog_diary_data['error']}）"
                 logger.error(f"[Apilot] Dog diary API error: {dog_diary_data}")
-                return error_msg
+                return False, error_msg
         except Exception as e:
             logger.error(f"[Apilot] Exception in get_dog_diary: {str(e)}")
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
-            return f"获取舔狗日记时出错: {str(e)}"
+            return False, f"获取舔狗日记时出错: {str(e)}"
 
     def is_valid_url(self, url):
         """Check if a string is a valid URL"""
@@ -1449,6 +3464,68 @@ class Apilot(PluginBase):
         except:
             return False
 
+    def _today_start(self):
+        """Return the timestamp of local midnight today"""
+        return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+    def _daily_not_before(self, name):
+        """Return the timestamp a cached copy of a daily asset must be fetched after to be served as is"""
+        if name not in self.prefetch_times:
+            return self._today_start()
+        # 与预取使用同一刷新时间，定时刷新前下载的旧图不会被当作新图直接返回
+        return self._daily_media_boundary(name, datetime.now()).timestamp()
+
+    async def _fetch_image(self, url, headers, timeout=15, not_before=None, require_image=True, stale_fallback=False):
+        """Download an image through the on-disk media cache
+
+        A cached copy fetched at or after not_before is served without contacting
+        the upstream; otherwise the request is revalidated with ETag/Last-Modified.
+        Returns a tuple of (image bytes or None, content type, HTTP status).
+        """
+        entry = self.media_cache.lookup(url) if self.media_cache else None
+        if entry is not None and not_before is not None and entry["fetched_at"] >= not_before:
+            data = await self.media_cache.read(url)
+            if data is not None:
+                logger.info(f"[Apilot] Serving cached image for {url}, size: {len(data)} bytes")
+                return data, entry["content_type"], 200
+
+        request_headers = dict(headers)
+        if entry is not None:
+            if entry.get("etag"):
+                request_headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                request_headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            async with self._open("GET", url, headers=request_headers, timeout=timeout) as response:
+                content_type = response.headers.get('Content-Type', '')
+                if response.status == 304 and entry is not None:
+                    data = await self.media_cache.read(url)
+                    if data is not None:
+                        self.media_cache.touch(url)
+                        logger.info(f"[Apilot] Image not modified, serving cached copy for {url}")
+                        return data, entry["content_type"], 200
+                elif response.status == 200 and (not require_image or 'image' in content_type):
+                    data = await response.read()
+                    if self.media_cache:
+                        await self.media_cache.put(
+                            url, data, content_type,
+                            response.headers.get("ETag"), response.headers.get("Last-Modified")
+                        )
+                    return data, content_type, 200
+                status = response.status
+        except Exception:
+            if not (stale_fallback and entry is not None):
+                raise
+            content_type, status = "", None
+
+        if stale_fallback and entry is not None:
+            data = await self.media_cache.read(url)
+            if data is not None:
+                logger.warning(f"[Apilot] Upstream failed for {url}, serving cached copy")
+                return data, entry["content_type"], 200
+        return None, content_type, status
+
     async def get_morning_news(self, alapi_token, text_enabled=False):
         """Get morning news, either as text or image - using original DOW plugin's approach"""
         logger.info(f"[Apilot] Getting morning news, text_enabled={text_enabled}")
@@ -1461,8 +3538,8 @@ class Apilot(PluginBase):
                 headers = {"Content-Type": "application/json"}
                 try:
                     logger.info(f"[Apilot] Making morning news text request to ALAPI: {url}")
-                    news_data = self.make_request(url, method="POST", headers=headers, json_data=payload)
-                    logger.info(f"[Apilot] ALAPI morning news text response: {news_data}")
+                    news_data = await self.make_request(url, method="POST", headers=headers, json_data=payload)
+                    self.log_policy.payload("morning_news", "ALAPI morning news text response", news_data)
 
                     if isinstance(news_data, dict) and news_data.get('code') == 200:
                         data = news_data.get('data', {})
@@ -1509,20 +3586,19 @@ class Apilot(PluginBase):
 
                 logger.info(f"[Apilot] Trying backup API for text news: {url}")
 
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers, timeout=15) as response:
-                        if response.status == 200:
-                            try:
-                                data = await response.json()
-                                if data.get('code') == 200 and 'data' in data:
-                                    news_list = data['data'].get('news', [])
-                                    if news_list:
-                                        result = f"☕ 今日早报\n\n"
-                                        for idx, news in enumerate(news_list, 1):
-                                            result += f"{idx}. {news}\n"
-                                        return result
-                            except Exception as json_error:
-                                logger.error(f"[Apilot] Failed to parse backup API response: {json_error}")
+                async with self._open("GET", url, headers=headers, timeout=15) as response:
+                    if response.status == 200:
+                        try:
+                            data = await response.json()
+                            if data.get('code') == 200 and 'data' in data:
+                                news_list = data['data'].get('news', [])
+                                if news_list:
+                                    result = f"☕ 今日早报\n\n"
+                                    for idx, news in enumerate(news_list, 1):
+                                        result += f"{idx}. {news}\n"
+                                    return result
+                        except Exception as json_error:
+                            logger.error(f"[Apilot] Failed to parse backup API response: {json_error}")
 
                 # 如果所有尝试都失败，返回错误消息
                 return "早报文本获取失败，请稍后再试"
@@ -1532,93 +3608,18 @@ class Apilot(PluginBase):
                 return f"获取早报时出错: {str(e)}"
         else:
             # 获取图片版早报
-            # 首选ALAPI，如果有token的话
+            # 首选ALAPI（如果有token的话），其余为备用API源
+            sources = []
             if alapi_token:
-                try:
-                    logger.info(f"[Apilot] Trying ALAPI for morning news image")
-                    url = BASE_URL_ALAPI + "zaobao"
-                    params = {"token": alapi_token, "format": "json"}
+                sources.append(("ALAPI", functools.partial(self._morning_news_from_alapi, alapi_token)))
+            for api_url in self.morning_news_backup_sources:
+                sources.append((api_url, functools.partial(self._morning_news_from_backup, api_url)))
 
-                    news_data = self.make_request(url, params=params)
-                    logger.info(f"[Apilot] ALAPI morning news response: {news_data}")
-
-                    if isinstance(news_data, dict) and news_data.get('code') == 200:
-                        data = news_data.get('data', {})
-                        if isinstance(data, dict) and 'image' in data:
-                            img_url = data['image']
-                            logger.info(f"[Apilot] Got image URL from ALAPI: {img_url}")
-
-                            # 下载图片
-                            headers = {
-                                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                                "Accept": "image/webp, image/apng, image/*",
-                                "Referer": "https://api.alapi.cn/"
-                            }
-
-                            async with aiohttp.ClientSession() as session:
-                                async with session.get(img_url, headers=headers, timeout=15) as response:
-                                    if response.status == 200:
-                                        img_data = await response.read()
-                                        logger.info(f"[Apilot] Successfully downloaded morning news image from ALAPI, size: {len(img_data)} bytes")
-                                        return img_data
-                except Exception as alapi_error:
-                    logger.error(f"[Apilot] Failed to get morning news from ALAPI: {str(alapi_error)}")
-                    # 继续尝试备用API
-
-            # 如果ALAPI失败或没有token，尝试备用API
             try:
-                # 尝试使用多个API源获取早报图片
-                backup_apis = [
-                    "https://api.03c3.cn/api/zb",
-                    "https://api.vvhan.com/api/60s",
-                    "https://api.pearktrue.cn/api/60s/image"
-                ]
-
-                logger.info(f"[Apilot] Trying backup APIs for morning news image")
-
-                for api_url in backup_apis:
-                    try:
-                        logger.info(f"[Apilot] Trying API: {api_url}")
-                        headers = {
-                            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                            "Accept": "application/json, image/webp, image/apng, image/*"
-                        }
-
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(api_url, headers=headers, timeout=15) as response:
-                                if response.status == 200:
-                                    # 检查是否返回JSON数据
-                                    content_type = response.headers.get('Content-Type', '')
-                                    if 'application/json' in content_type:
-                                        data = await response.json()
-                                        if "api/zb" in api_url and 'data' in data and 'imageurl' in data['data']:
-                                            img_url = data['data']['imageurl']
-                                            logger.info(f"[Apilot] Got image URL from {api_url}: {img_url}")
-
-                                            # 下载图片
-                                            async with session.get(img_url, headers=headers, timeout=15) as img_response:
-                                                if img_response.status == 200:
-                                                    img_data = await img_response.read()
-                                                    logger.info(f"[Apilot] Successfully downloaded morning news image from {img_url}, size: {len(img_data)} bytes")
-                                                    return img_data
-                                        elif "api/60s" in api_url and 'imgUrl' in data:
-                                            img_url = data['imgUrl']
-                                            logger.info(f"[Apilot] Got image URL from {api_url}: {img_url}")
-
-                                            # 下载图片
-                                            async with session.get(img_url, headers=headers, timeout=15) as img_response:
-                                                if img_response.status == 200:
-                                                    img_data = await img_response.read()
-                                                    logger.info(f"[Apilot] Successfully downloaded morning news image from {img_url}, size: {len(img_data)} bytes")
-                                                    return img_data
-                                    # 如果是直接返回图片
-                                    elif 'image' in content_type:
-                                        img_data = await response.read()
-                                        logger.info(f"[Apilot] Successfully downloaded morning news image directly from {api_url}, size: {len(img_data)} bytes")
-                                        return img_data
-                    except Exception as api_error:
-                        logger.error(f"[Apilot] Failed to get morning news from {api_url}: {str(api_error)}")
-                        continue
+                hedge_delay = self.morning_news_hedge_delay if self.morning_news_hedge_enable else None
+                img_data = await self._race_sources("morning news image", sources, hedge_delay)
+                if img_data is not None:
+                    return img_data
 
                 # 如果所有尝试都失败，返回错误消息
                 logger.error(f"[Apilot] All attempts to get morning news image failed")
@@ -1628,6 +3629,110 @@ class Apilot(PluginBase):
                 logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
                 return f"获取早报时出错: {str(e)}"
 
+    async def _race_sources(self, label, sources, hedge_delay):
+        """Return the first non-None result of (name, coroutine function) sources, cancelling the rest
+
+        Sources are started in order. The next one is started as soon as a running
+        source fails, or when none has produced a result within hedge_delay seconds
+        (0 starts them all at once, None tries them strictly one after another).
+        """
+        queue = list(sources)
+        pending = set()
+        names = {}
+        try:
+            while queue or pending:
+                if queue:
+                    name, factory = queue.pop(0)
+                    logger.info(f"[Apilot] Trying {label} source: {name}")
+                    task = asyncio.ensure_future(factory())
+                    names[task] = name
+                    pending.add(task)
+                done, pending = await asyncio.wait(
+                    pending, timeout=hedge_delay if queue else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        logger.error(f"[Apilot] Failed to get {label} from {names[task]}: {str(e)}")
+                        continue
+                    if result is not None:
+                        logger.info(f"[Apilot] Got {label} from {names[task]}, {len(pending)} other source(s) cancelled")
+                        return result
+            return None
+        finally:
+            # 取消仍在进行的请求
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _morning_news_from_alapi(self, alapi_token):
+        """Fetch today's morning news image through ALAPI, or None"""
+        url = BASE_URL_ALAPI + "zaobao"
+        params = {"token": alapi_token, "format": "json"}
+
+        news_data = await self.make_request(url, params=params)
+        self.log_policy.payload("morning_news", "ALAPI morning news response", news_data)
+
+        if isinstance(news_data, dict) and news_data.get('code') == 200:
+            data = news_data.get('data', {})
+            if isinstance(data, dict) and 'image' in data:
+                img_url = data['image']
+                logger.info(f"[Apilot] Got image URL from ALAPI: {img_url}")
+
+                # 下载图片
+                headers = {
+                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+                    "Accept": "image/webp, image/apng, image/*",
+                    "Referer": "https://api.alapi.cn/"
+                }
+
+                img_data, _, _ = await self._fetch_image(
+                    img_url, headers, timeout=15, not_before=self._daily_not_before("morning_news"), require_image=False
+                )
+                if img_data is not None:
+                    logger.info(f"[Apilot] Successfully downloaded morning news image from ALAPI, size: {len(img_data)} bytes")
+                    return img_data
+        return None
+
+    async def _morning_news_from_backup(self, api_url):
+        """Fetch today's morning news image from one backup API, or None"""
+        headers = {
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+            "Accept": "application/json, image/webp, image/apng, image/*"
+        }
+
+        img_url = None
+        async with self._open("GET", api_url, headers=headers, timeout=15) as response:
+            if response.status != 200:
+                return None
+            # 检查是否返回JSON数据
+            content_type = response.headers.get('Content-Type', '')
+            if 'application/json' in content_type:
+                data = await response.json()
+                if "api/zb" in api_url and 'data' in data and 'imageurl' in data['data']:
+                    img_url = data['data']['imageurl']
+                elif "api/60s" in api_url and 'imgUrl' in data:
+                    img_url = data['imgUrl']
+            # 如果是直接返回图片
+            elif 'image' in content_type:
+                img_data = await response.read()
+                logger.info(f"[Apilot] Successfully downloaded morning news image directly from {api_url}, size: {len(img_data)} bytes")
+                return img_data
+
+        if img_url is None:
+            return None
+        logger.info(f"[Apilot] Got image URL from {api_url}: {img_url}")
+
+        # 下载图片
+        img_data, _, _ = await self._fetch_image(
+            img_url, headers, timeout=15, not_before=self._daily_not_before("morning_news"), require_image=False
+        )
+        if img_data is not None:
+            logger.info(f"[Apilot] Successfully downloaded morning news image from {img_url}, size: {len(img_data)} bytes")
+        return img_data
+
     async def get_moyu_calendar(self):
         """Get moyu (slacking off) calendar - using same approach as morning news"""
         logger.info("[Apilot] Getting moyu calendar using same approach as morning news")
@@ -1642,22 +3747,21 @@ class Apilot(PluginBase):
                 "Referer": "https://api.vvhan.com/"
             }
 
-            # 使用与早报相同的方式下载图片
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers, timeout=15) as response:
-                    if response.status == 200:
-                        # 检查是否是图片内容
-                        content_type = response.headers.get('Content-Type', '')
-                        if 'image' in content_type:
-                            img_data = await response.read()
-                            logger.info(f"[Apilot] Successfully downloaded moyu calendar, size: {len(img_data)} bytes, content-type: {content_type}")
-                            return img_data
-                        else:
-                            logger.error(f"[Apilot] Moyu calendar response is not an image: {content_type}")
-                            return f"摸鱼日历返回的不是图片: {content_type}"
-                    else:
-                        logger.error(f"[Apilot] Failed to download moyu calendar, status code: {response.status}")
-                        return "摸鱼日历获取失败，请稍后再试"
+            # 使用与早报相同的方式下载图片，最近一次定时刷新后已缓存的日历直接从磁盘读取
+            img_data, content_type, status = await self._fetch_image(
+                url, headers, timeout=15, not_before=self._daily_not_before("moyu_calendar")
+            )
+            if status == 200:
+                # 检查是否是图片内容
+                if img_data is not None:
+                    logger.info(f"[Apilot] Successfully downloaded moyu calendar, size: {len(img_data)} bytes, content-type: {content_type}")
+                    return img_data
+                else:
+                    logger.error(f"[Apilot] Moyu calendar response is not an image: {content_type}")
+                    return f"摸鱼日历返回的不是图片: {content_type}"
+            else:
+                logger.error(f"[Apilot] Failed to download moyu calendar, status code: {status}")
+                return "摸鱼日历获取失败，请稍后再试"
         except Exception as e:
             logger.error(f"[Apilot] Exception in get_moyu_calendar: {str(e)}")
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
@@ -1679,25 +3783,24 @@ class Apilot(PluginBase):
                 }
 
                 # 使用异步HTTP客户端
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers, timeout=30) as response:  # 视频可能较大，增加超时时间
-                        if response.status == 200:
-                            # 检查是否是视频内容
-                            content_type = response.headers.get('Content-Type', '')
-                            if 'video' in content_type or 'mp4' in content_type:
-                                video_data = await response.read()
-                                logger.info(f"[Apilot] Successfully downloaded moyu calendar video, size: {len(video_data)} bytes")
-                                # 返回视频字节
-                                return video_data
-                            else:
-                                logger.error(f"[Apilot] Moyu calendar video response is not a video: {content_type}")
-                                # 如果不是视频，返回URL
-                                return url
+                async with self._open("GET", url, headers=headers, timeout=30) as response:  # 视频可能较大，增加超时时间
+                    if response.status == 200:
+                        # 检查是否是视频内容
+                        content_type = response.headers.get('Content-Type', '')
+                        if 'video' in content_type or 'mp4' in content_type:
+                            video_data = await response.read()
+                            logger.info(f"[Apilot] Successfully downloaded moyu calendar video, size: {len(video_data)} bytes")
+                            # 返回视频字节
+                            return video_data
                         else:
-                            logger.error(f"[Apilot] Failed to download moyu calendar video, status code: {response.status}")
-                            # 如果下载失败，返回URL
-                            logger.info(f"[Apilot] Falling back to returning URL: {url}")
+                            logger.error(f"[Apilot] Moyu calendar video response is not a video: {content_type}")
+                            # 如果不是视频，返回URL
                             return url
+                    else:
+                        logger.error(f"[Apilot] Failed to download moyu calendar video, status code: {response.status}")
+                        # 如果下载失败，返回URL
+                        logger.info(f"[Apilot] Falling back to returning URL: {url}")
+                        return url
             except Exception as download_error:
                 logger.error(f"[Apilot] Failed to download moyu calendar video: {download_error}")
                 # 如果下载失败，返回URL
@@ -1716,8 +3819,8 @@ class Apilot(PluginBase):
         headers = {'Content-Type': "application/x-www-form-urlencoded"}
         try:
             logger.info(f"[Apilot] Making celebrity gossip request to {url}")
-            bagua_info = self.make_request(url, method="POST", headers=headers, data=payload)
-            logger.info(f"[Apilot] Celebrity gossip API response: {bagua_info}")
+            bagua_info = await self.make_request(url, method="POST", headers=headers, data=payload)
+            self.log_policy.payload("bagua", "Celebrity gossip API response", bagua_info)
 
             # 验证请求是否成功
             if isinstance(bagua_info, dict) and bagua_info.get('code') == 200:
@@ -1732,33 +3835,32 @@ class Apilot(PluginBase):
                             'Referer': 'https://dayu.qqsuu.cn/'
                         }
 
-                        # 使用异步HTTP客户端
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(bagua_pic_url, headers=headers, timeout=10) as response:
-                                if response.status == 200:
-                                    # 检查是否是图片内容
-                                    content_type = response.headers.get('Content-Type', '')
-                                    if 'image' in content_type:
-                                        image_data = await response.read()
-                                        logger.info(f"[Apilot] Successfully downloaded celebrity gossip image, size: {len(image_data)} bytes")
-                                        # 返回图片字节
-                                        return image_data
-                                    else:
-                                        logger.error(f"[Apilot] Celebrity gossip response is not an image: {content_type}")
-                                        # 如果不是图片，返回URL
-                                        return bagua_pic_url
-                                else:
-                                    logger.error(f"[Apilot] Failed to download celebrity gossip image, status code: {response.status}")
-                                    # 如果下载失败，返回URL
-                                    logger.info(f"[Apilot] Falling back to returning URL: {bagua_pic_url}")
-                                    return bagua_pic_url
+                        # 使用异步HTTP客户端，最近一次定时刷新后已缓存的图片直接从磁盘读取
+                        image_data, content_type, status = await self._fetch_image(
+                            bagua_pic_url, headers, timeout=10, not_before=self._daily_not_before("bagua")
+                        )
+                        if status == 200:
+                            # 检查是否是图片内容
+                            if image_data is not None:
+                                logger.info(f"[Apilot] Successfully downloaded celebrity gossip image, size: {len(image_data)} bytes")
+                                # 返回图片字节
+                                return image_data
+                            else:
+                                logger.error(f"[Apilot] Celebrity gossip response is not an image: {content_type}")
+                                # 如果不是图片，返回URL
+                                return bagua_pic_url
+                        else:
+                            logger.error(f"[Apilot] Failed to download celebrity gossip image, status code: {status}")
+                            # 如果下载失败，返回URL
+                            logger.info(f"[Apilot] Falling back to returning URL: {bagua_pic_url}")
+                            return bagua_pic_url
                     except Exception as download_error:
                         logger.error(f"[Apilot] Failed to download celebrity gossip image: {download_error}")
                         # 如果下载失败，返回URL
                         logger.info(f"[Apilot] Falling back to returning URL: {bagua_pic_url}")
                         return bagua_pic_url
                 else:
-                    return "周末不更新，请微博吃瓜"
+                    return BAGUA_WEEKEND_NOTICE
             else:
                 logger.error(f"[Apilot] Celebrity gossip API error: {bagua_info}")
                 return "暂无明星八卦，吃瓜莫急"
@@ -1767,7 +3869,7 @@ class Apilot(PluginBase):
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
             return f"获取明星八卦时出错: {str(e)}"
 
-    def get_hot_trends(self, hot_trends_type):
+    async def get_hot_trends(self, hot_trends_type):
         """Get hot trends"""
         logger.info(f"[Apilot] Getting hot trends for type: {hot_trends_type}")
 
@@ -1798,8 +3900,8 @@ class Apilot(PluginBase):
             headers = {"Content-Type": "application/json"}
             try:
                 logger.info(f"[Apilot] Making hot trends request to {url}")
-                hot_trends_data = self.make_request(url, method="POST", headers=headers, json_data=payload)
-                logger.info(f"[Apilot] Hot trends API response: {hot_trends_data}")
+                hot_trends_data = await self.make_request(url, method="POST", headers=headers, json_data=payload)
+                self.log_policy.payload("hot_trends", "Hot trends API response", hot_trends_data)
 
                 if isinstance(hot_trends_data, dict) and hot_trends_data.get('code') == 200:
                     data = hot_trends_data.get('data', {})
@@ -1847,7 +3949,7 @@ class Apilot(PluginBase):
             )
             return final_output
 
-    def get_today_on_history(self, alapi_token, month="", day=""):
+    async def get_today_on_history(self, alapi_token, month="", day=""):
         """Get historical events that happened on this day"""
         logger.info(f"[Apilot] Getting today on history for month={month}, day={day}")
         url = BASE_URL_ALAPI + "eventHistory"
@@ -1859,8 +3961,8 @@ class Apilot(PluginBase):
         headers = {"Content-Type": "application/json"}
         try:
             logger.info(f"[Apilot] Making today on history request to {url}")
-            history_event_data = self.make_request(url, method="POST", headers=headers, json_data=payload)
-            logger.info(f"[Apilot] Today on history API response: {history_event_data}")
+            history_event_data = await self.make_request(url, method="POST", headers=headers, json_data=payload)
+            self.log_policy.payload("history", "Today on history API response", history_event_data)
 
             if isinstance(history_event_data, dict) and history_event_data.get('code') == 200:
                 current_date = ""
@@ -1927,6 +4029,200 @@ class Apilot(PluginBase):
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
             return f"获取历史上的今天时出错: {str(e)}"
 
+    def _daily_media_boundary(self, name, now):
+        """Return the most recent scheduled refresh time for a daily asset"""
+        hour, minute = self.prefetch_times[name]
+        boundary = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if boundary > now:
+            boundary -= timedelta(days=1)
+        return boundary
+
+    def _get_fresh_daily_media(self, name):
+        """Return the prefetched result for a daily asset if fetched since its last scheduled refresh"""
+        entry = self.daily_media.get(name)
+        if entry is None:
+            return None
+        fetched_at, media = entry
+        now = datetime.now()
+        if fetched_at < self._daily_media_boundary(name, now):
+            return None
+        # 周末提示只在当天有效，周一零点后重新请求
+        if not isinstance(media, bytes) and fetched_at.date() != now.date():
+            return None
+        return media
+
+    async def _get_daily_media(self, name):
+        """Get a daily asset, serving the prefetched copy when it is still fresh"""
+        media = self._get_fresh_daily_media(name)
+        if isinstance(media, bytes):
+            logger.info(f"[Apilot] Serving prefetched {name}, size: {len(media)} bytes")
+            return media
+        if media is not None:
+            logger.info(f"[Apilot] Serving prefetched {name} notice: {media}")
+            return media
+
+        fetchers = {
+            "morning_news": lambda: self.get_morning_news(self.alapi_token, self.morning_news_text_enabled),
+            "moyu_calendar": self.get_moyu_calendar,
+            "bagua": self.get_mx_bagua
+        }
+        result = await self.single_flight.do(name, fetchers[name])
+        # Only image bytes and the weekend gossip notice are held; other text, URLs and
+        # error messages are fetched again next time
+        weekend_notice = name == "bagua" and result == BAGUA_WEEKEND_NOTICE and datetime.now().weekday() >= 5
+        if isinstance(result, bytes) or weekend_notice:
+            self.daily_media[name] = (datetime.now(), result)
+        return result
+
+    async def _prefetch_daily_media_loop(self):
+        """Keep daily assets fetched, retrying failed ones until they succeed"""
+        while True:
+            pending = False
+            for name in self.prefetch_times:
+                if self._get_fresh_daily_media(name) is not None:
+                    continue
+                try:
+                    result = await self._get_daily_media(name)
+                except Exception as e:
+                    logger.error(f"[Apilot] Exception while prefetching {name}: {str(e)}")
+                    result = None
+                if isinstance(result, bytes):
+                    logger.info(f"[Apilot] Prefetched {name}, size: {len(result)} bytes")
+                elif self._get_fresh_daily_media(name) is not None:
+                    logger.info(f"[Apilot] No {name} update today: {result}")
+                else:
+                    logger.warning(f"[Apilot] Prefetch of {name} failed, retrying in {self.prefetch_retry_interval}s")
+                    pending = True
+
+            # Sleep until the next scheduled refresh, or the next retry if something failed
+            now = datetime.now()
+            delay = min(
+                (self._daily_media_boundary(name, now) + timedelta(days=1) - now).total_seconds()
+                for name in self.prefetch_times
+            )
+            if pending:
+                delay = min(delay, self.prefetch_retry_interval)
+            await asyncio.sleep(max(delay, 1))
+
+    async def _get_buffered_text(self, feature, from_wxid):
+        """Serve a random text item from the feature's buffer, fetching it live when the buffer is empty"""
+        buffer = self.text_buffers.get(feature)
+        text = buffer.take(from_wxid) if buffer is not None else None
+        if text is not None:
+            logger.info(f"[Apilot] Serving buffered {feature}")
+            return text
+
+        fetch = asyncio.ensure_future(self._fetch_text(feature))
+        if self.quote_corpus is not None and self.quote_corpus.count(feature):
+            # 接口失败（熔断、额度用尽）或超过 fallback_after 秒未返回时改用本地语录；
+            # 未完成的请求在后台继续，成功后仍会写入语录库
+            self._pending_fetches.add(fetch)
+            fetch.add_done_callback(self._pending_fetches.discard)
+            done, _ = await asyncio.wait({fetch}, timeout=self.quote_fallback_after)
+            if done:
+                ok, text = fetch.result()
+                if ok:
+                    return text
+            quote = await self.quote_corpus.pick(feature, avoid=buffer.served(from_wxid) if buffer is not None else ())
+            if quote is not None:
+                logger.info(f"[Apilot] Serving {feature} from the local quote corpus")
+                if buffer is not None:
+                    buffer.remember(from_wxid, quote)
+                return quote
+        _, text = await fetch
+        return text
+
+    async def _fetch_text(self, feature):
+        """Fetch one random text item, recording successful items in the quote corpus"""
+        try:
+            ok, text = await getattr(self, TEXT_BUFFER_FEATURES[feature])(self.alapi_token)
+        except Exception as e:
+            logger.error(f"[Apilot] Exception while fetching {feature}: {str(e)}")
+            return False, "出错啦，稍后再试"
+        if ok and self.quote_corpus is not None:
+            try:
+                await self.quote_corpus.add(feature, text)
+            except Exception as e:
+                logger.error(f"[Apilot] Failed to store {feature} in the quote corpus: {str(e)}")
+        return ok, text
+
+    async def _fetch_text_for_buffer(self, feature):
+        """Fetch one item for a refill, waiting for the shared refill QPS budget first"""
+        delay = self.text_refill_limiter.reserve("")
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return await self._fetch_text(feature)
+
+    async def _refill_text_buffer_loop(self, feature):
+        """Top up a text buffer in concurrent batches whenever it drops below its refill mark"""
+        buffer = self.text_buffers[feature]
+        while True:
+            # 先清除信号再检查，检查之后的取用会唤醒下面的等待
+            buffer.clear_low()
+            if not buffer.needs_refill():
+                await buffer.wait_low()
+                continue
+            # 低于补充线后一直补到缓冲区满
+            while len(buffer) < buffer.size:
+                count = min(self.text_buffer_batch, buffer.size - len(buffer))
+                results = await asyncio.gather(*(self._fetch_text_for_buffer(feature) for _ in range(count)))
+                if not sum(buffer.add(text) for ok, text in results if ok):
+                    # 全部失败或都是重复内容，稍后再试，避免持续消耗额度
+                    logger.warning(f"[Apilot] Refilling {feature} added nothing, retrying in {self.text_buffer_retry_interval}s")
+                    await asyncio.sleep(self.text_buffer_retry_interval)
+                    break
+
+    async def _refill_video_pool_loop(self):
+        """Keep every pooled video category topped up, one download at a time"""
+        pool = self.video_pool
+        # category -> monotonic time before which a failed category is not retried
+        retry_at = {}
+        while True:
+            # 先清除信号再检查，检查之后被取走的视频会唤醒下面的等待
+            pool.clear_demand()
+            now = time.monotonic()
+            category = pool.next_category(exclude={name for name, until in retry_at.items() if until > now})
+            if category is None:
+                # 缓冲区已满，或剩下的分类都在等待重试
+                waits = [until - now for until in retry_at.values() if until > now]
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(pool.wait_for_demand(), timeout=min(waits) if waits else None)
+                continue
+
+            try:
+                result = await self._get_video_with_cover(getattr(self, f"{category}_api_url"), category)
+            except Exception as e:
+                logger.error(f"[Apilot] Exception while pre-warming {category} video: {str(e)}")
+                result = None
+            if not isinstance(result, dict):
+                logger.warning(f"[Apilot] Pre-warming {category} video failed, retrying in {self.video_pool_retry_interval}s")
+                retry_at[category] = time.monotonic() + self.video_pool_retry_interval
+                continue
+            if not pool.put(category, result):
+                # 超出缓冲区总大小上限，丢弃这个视频并按获取失败处理：等有视频被取走或重试时间到了再补充。
+                # 缓冲区为空时不会再有视频被取走，只等取走信号会永远等下去
+                result["video"].close()
+                if result.get("cover"):
+                    result["cover"].close()
+                logger.warning(f"[Apilot] Pre-warmed {category} video does not fit the pool, retrying in {self.video_pool_retry_interval}s")
+                retry_at[category] = time.monotonic() + self.video_pool_retry_interval
+                continue
+            retry_at.pop(category, None)
+            logger.info(f"[Apilot] Pre-warmed {category} video, pool: {pool.stats()['per_category']}")
+
+    def _start_background_task(self, coro):
+        """Start a background task owned by the plugin lifecycle"""
+        task = asyncio.create_task(coro)
+        self._background_tasks.append(task)
+        return task
+
+    async def _stop_background_tasks(self):
+        """Cancel all background tasks and wait for them to finish"""
+        tasks, self._background_tasks = self._background_tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
     def handle_error(self, error, default_message="出错啦，稍后再试"):
         """Handle errors and return a user-friendly message"""
         if isinstance(error, dict) and "error" in error:
@@ -1943,6 +4239,25 @@ class Apilot(PluginBase):
         """Called when the plugin is enabled"""
         await super().on_enable(bot)
         self.enabled = True  # Ensure the system property is set
+        await self._get_session()
+        if self.enable and self.prefetch_enabled:
+            self._start_background_task(self._prefetch_daily_media_loop())
+        if self.enable and self.city_index is not None and self.alapi_token:
+            self._start_background_task(self._refresh_city_index_loop())
+        if self.enable and self.video_pool is not None:
+            self._start_background_task(self._refill_video_pool_loop())
+        if self.enable and self.alapi_token:
+            for feature in self.text_buffers:
+                self._start_background_task(self._refill_text_buffer_loop(feature))
+        if self.enable and self.metrics_http_enable and self.metrics_runner is None:
+            await self._start_metrics_server()
+        if self.enable and self.log_file and self.log_sink_id is None:
+            # 插件专用日志文件，写入在后台线程中完成，不阻塞事件循环
+            self.log_sink_id = logger.add(
+                os.path.join(os.path.dirname(__file__), self.log_file),
+                level=self.log_file_level, enqueue=True, rotation="10 MB", retention=3,
+                filter=lambda record: record["name"] == __name__
+            )
         logger.info("[Apilot] Plugin enabled - system state: enabled={}, config state: enable={}".format(
             self.enabled, self.enable))
 
@@ -1950,6 +4265,18 @@ class Apilot(PluginBase):
         """Called when the plugin is disabled"""
         await super().on_disable()
         self.enabled = False  # Update the system property
+        await self._stop_background_tasks()
+        await self._stop_metrics_server()
+        await self._close_session()
+        if self.log_sink_id is not None:
+            logger.remove(self.log_sink_id)
+            self.log_sink_id = None
+        if self.enable and self.media_cache is not None:
+            self.media_cache.flush()
+        if self.enable and self.video_pool is not None:
+            self.video_pool.close()
+        if self.enable and self.video_cache is not None:
+            self.video_cache.flush()
         logger.info("[Apilot] Plugin disabled")
 
     async def get_mx_bstp(self):
@@ -1964,26 +4291,23 @@ class Apilot(PluginBase):
                 'Referer': 'https://api.xlb.one/'
             }
 
-            # 使用异步HTTP客户端
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers, timeout=15) as response:
-                    if response.status == 200:
-                        # 检查是否是图片内容
-                        content_type = response.headers.get('Content-Type', '')
-                        if 'image' in content_type:
-                            img_data = await response.read()
-                            logger.info(f"[Apilot] Successfully downloaded white stockings image, size: {len(img_data)} bytes")
-                            # 返回图片字节
-                            return img_data
-                        else:
-                            logger.error(f"[Apilot] White stockings response is not an image: {content_type}")
-                            # 如果不是图片，返回URL
-                            return url
-                    else:
-                        logger.error(f"[Apilot] Failed to download white stockings image, status code: {response.status}")
-                        # 如果下载失败，返回URL
-                        logger.info(f"[Apilot] Falling back to returning URL: {url}")
-                        return url
+            # 使用异步HTTP客户端，上游失败时使用磁盘缓存中的上一张图片
+            img_data, content_type, status = await self._fetch_image(url, headers, timeout=15, stale_fallback=True)
+            if status == 200:
+                # 检查是否是图片内容
+                if img_data is not None:
+                    logger.info(f"[Apilot] Successfully downloaded white stockings image, size: {len(img_data)} bytes")
+                    # 返回图片字节
+                    return img_data
+                else:
+                    logger.error(f"[Apilot] White stockings response is not an image: {content_type}")
+                    # 如果不是图片，返回URL
+                    return url
+            else:
+                logger.error(f"[Apilot] Failed to download white stockings image, status code: {status}")
+                # 如果下载失败，返回URL
+                logger.info(f"[Apilot] Falling back to returning URL: {url}")
+                return url
         except Exception as e:
             logger.error(f"[Apilot] Exception in get_mx_bstp: {str(e)}")
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
@@ -2001,26 +4325,23 @@ class Apilot(PluginBase):
                 'Referer': 'https://api.xlb.one/'
             }
 
-            # 使用异步HTTP客户端
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers, timeout=15) as response:
-                    if response.status == 200:
-                        # 检查是否是图片内容
-                        content_type = response.headers.get('Content-Type', '')
-                        if 'image' in content_type:
-                            img_data = await response.read()
-                            logger.info(f"[Apilot] Successfully downloaded black stockings image, size: {len(img_data)} bytes")
-                            # 返回图片字节
-                            return img_data
-                        else:
-                            logger.error(f"[Apilot] Black stockings response is not an image: {content_type}")
-                            # 如果不是图片，返回URL
-                            return url
-                    else:
-                        logger.error(f"[Apilot] Failed to download black stockings image, status code: {response.status}")
-                        # 如果下载失败，返回URL
-                        logger.info(f"[Apilot] Falling back to returning URL: {url}")
-                        return url
+            # 使用异步HTTP客户端，上游失败时使用磁盘缓存中的上一张图片
+            img_data, content_type, status = await self._fetch_image(url, headers, timeout=15, stale_fallback=True)
+            if status == 200:
+                # 检查是否是图片内容
+                if img_data is not None:
+                    logger.info(f"[Apilot] Successfully downloaded black stockings image, size: {len(img_data)} bytes")
+                    # 返回图片字节
+                    return img_data
+                else:
+                    logger.error(f"[Apilot] Black stockings response is not an image: {content_type}")
+                    # 如果不是图片，返回URL
+                    return url
+            else:
+                logger.error(f"[Apilot] Failed to download black stockings image, status code: {status}")
+                # 如果下载失败，返回URL
+                logger.info(f"[Apilot] Falling back to returning URL: {url}")
+                return url
         except Exception as e:
             logger.error(f"[Apilot] Exception in get_mx_hstp: {str(e)}")
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
@@ -2038,228 +4359,221 @@ class Apilot(PluginBase):
             payload = "format=json"
             headers = {'Content-Type': "application/x-www-form-urlencoded"}
 
-            # 使用requests库发送POST请求获取JSON数据
-            response = requests.post(url, headers=headers, data=payload)
+            # 异步发送POST请求获取JSON数据
+            async with self._open("POST", url, headers=headers, data=payload) as response:
+                status = response.status
+                body = await response.read() if status == 200 else b""
 
-            if response.status_code == 200:
+            if status == 200:
                 try:
                     # 尝试解析JSON响应
-                    video_info = response.json()
-
-                    if isinstance(video_info, dict) and video_info.get('code') == 200:
-                        # 从JSON响应中提取视频URL
-                        video_url = video_info.get('data')
-
-                        if video_url and self.is_valid_url(video_url):
-                            logger.info(f"[Apilot] Successfully got {video_type} video URL: {video_url}")
-
-                            # 下载视频内容
-                            headers = {
-                                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-                                'Accept': 'video/mp4, video/*',
-                                'Referer': referer
-                            }
-
-                            # 使用aiohttp下载视频
-                            async with aiohttp.ClientSession() as session:
-                                async with session.get(video_url, headers=headers, timeout=30) as video_response:
-                                    if video_response.status == 200:
-                                        # 检查是否是视频内容
-                                        content_type = video_response.headers.get('Content-Type', '')
-                                        if 'video' in content_type or 'mp4' in content_type:
-                                            video_data = await video_response.read()
-                                            logger.info(f"[Apilot] Successfully downloaded {video_type} video, size: {len(video_data)} bytes")
-
-                                            # 创建临时文件保存视频
-                                            temp_dir = Path("temp")
-                                            temp_dir.mkdir(exist_ok=True)
-                                            timestamp = int(time.time())
-                                            video_path = temp_dir / f"{video_type}_{timestamp}.mp4"
-
-                                            with open(video_path, 'wb') as f:
-                                                f.write(video_data)
-
-                                            # 提取视频首帧作为封面
-                                            cover_data = None
-                                            try:
-                                                # 使用ffmpeg提取第一帧，与VideoSender保持一致
-                                                temp_dir = "temp_thumbnails"  # 创建临时文件夹
-                                                os.makedirs(temp_dir, exist_ok=True)
-                                                thumbnail_path = os.path.join(temp_dir, f"temp_thumbnail_{int(time.time())}.jpg")
-
-                                                # 执行ffmpeg命令提取第一帧
-                                                process = subprocess.run([
-                                                    "ffmpeg",
-                                                    "-i", str(video_path),
-                                                    "-ss", "00:00:01",  # 从视频的第 1 秒开始提取，与VideoDemand保持一致
-                                                    "-vframes", "1",
-                                                    thumbnail_path,
-                                                    "-y"  # 如果文件存在，覆盖
-                                                ], check=False, capture_output=True)
-
-                                                if process.returncode != 0:
-                                                    logger.error(f"[Apilot] ffmpeg 执行失败: {process.stderr.decode()}")
-                                                    cover_data = None
-                                                else:
-                                                    # 读取生成的缩略图
-                                                    if os.path.exists(thumbnail_path):
-                                                        with open(thumbnail_path, "rb") as image_file:
-                                                            image_data = image_file.read()
-                                                            image_base64 = base64.b64encode(image_data).decode("utf-8")
-                                                            cover_data = image_base64
-                                                            logger.info(f"[Apilot] Successfully extracted video cover, base64 size: {len(cover_data)} characters")
-                                                    else:
-                                                        logger.error(f"[Apilot] 缩略图文件不存在: {thumbnail_path}")
-                                                        cover_data = None
-                                            except Exception as cover_error:
-                                                logger.error(f"[Apilot] Exception in extracting video cover: {str(cover_error)}")
-                                                cover_data = None
-                                            finally:
-                                                # 清理临时文件
-                                                if 'temp_dir' in locals() and os.path.exists(temp_dir):
-                                                    try:
-                                                        shutil.rmtree(temp_dir, ignore_errors=True)  # 递归删除临时文件夹
-                                                    except Exception as cleanup_error:
-                                                        logger.error(f"[Apilot] 清理缩略图临时文件失败: {cleanup_error}")
-
-                                            # 清理视频临时文件
-                                            try:
-                                                if os.path.exists(str(video_path)):
-                                                    os.remove(str(video_path))
-                                            except Exception as cleanup_error:
-                                                logger.error(f"[Apilot] Failed to clean up video file: {str(cleanup_error)}")
-
-                                            # 将视频数据也转换为base64编码的字符串
-                                            video_base64 = base64.b64encode(video_data).decode("utf-8")
-                                            logger.info(f"[Apilot] Video converted to base64, size: {len(video_base64)} characters")
-
-                                            # 返回视频和封面的base64字符串
-                                            return {"video": video_base64, "cover": cover_data}
-                                        else:
-                                            logger.error(f"[Apilot] {video_type} video response is not a video: {content_type}")
-                                            # 如果不是视频，返回URL
-                                            return video_url
-                                    else:
-                                        logger.error(f"[Apilot] Failed to download {video_type} video, status code: {video_response.status}")
-                                        # 如果下载失败，返回URL
-                                        logger.info(f"[Apilot] Falling back to returning URL: {video_url}")
-                                        return video_url
-                        else:
-                            logger.error(f"[Apilot] Invalid video URL: {video_url}")
-                            return f"获取{video_type}视频失败，请稍后再试"
-                    else:
-                        logger.error(f"[Apilot] Invalid JSON response: {video_info}")
-                        return f"获取{video_type}视频失败，请稍后再试"
+                    video_info = json.loads(body)
                 except ValueError:
                     # 如果响应不是JSON，尝试直接下载视频
                     logger.error(f"[Apilot] Response is not JSON, trying to download video directly")
-                    return await self._download_video_directly(url, video_type, referer)
+                    # 接口地址每次返回不同的视频，不能按URL缓存
+                    return await self._download_video_directly(url, video_type, referer, cache_by_url=False)
+
+                if isinstance(video_info, dict) and video_info.get('code') == 200:
+                    # 从JSON响应中提取视频URL
+                    video_url = video_info.get('data')
+
+                    if video_url and self.is_valid_url(video_url):
+                        logger.info(f"[Apilot] Successfully got {video_type} video URL: {video_url}")
+                        return await self._download_video_directly(video_url, video_type, referer)
+                    else:
+                        logger.error(f"[Apilot] Invalid video URL: {video_url}")
+                        return f"获取{video_type}视频失败，请稍后再试"
+                else:
+                    logger.error(f"[Apilot] Invalid JSON response: {video_info}")
+                    return f"获取{video_type}视频失败，请稍后再试"
             else:
-                logger.error(f"[Apilot] Failed to get {video_type} video info, status code: {response.status_code}")
+                logger.error(f"[Apilot] Failed to get {video_type} video info, status code: {status}")
                 return f"获取{video_type}视频失败，请稍后再试"
         except Exception as e:
             logger.error(f"[Apilot] Exception in get_{video_type}: {str(e)}")
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
             return f"获取{video_type}视频时出错: {str(e)}"
 
-    async def _download_video_directly(self, url, video_type, referer="https://api.yujn.cn/"):
-        """Directly download video without JSON parsing"""
+    async def _download_video_directly(self, url, video_type, referer="https://api.yujn.cn/", cache_by_url=True):
+        """Directly download video without JSON parsing
+
+        With the derivative cache enabled, a clip URL seen before is served without
+        downloading, and downloaded content seen before skips cover extraction and encoding.
+        """
         try:
+            if self.video_cache is not None and cache_by_url:
+                cached = await self.video_cache.lookup_url(url)
+                if cached is not None:
+                    logger.info(f"[Apilot] Serving {video_type} video from the derivative cache by URL")
+                    return cached
+
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
                 'Accept': 'video/mp4, video/*',
                 'Referer': referer
             }
 
-            # 使用aiohttp
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers, timeout=30) as response:  # 视频可能较大，增加超时时间
-                    if response.status == 200:
-                        # 检查是否是视频内容
-                        content_type = response.headers.get('Content-Type', '')
-                        if 'video' in content_type or 'mp4' in content_type:
-                            video_data = await response.read()
-                            logger.info(f"[Apilot] Successfully downloaded {video_type} video directly, size: {len(video_data)} bytes")
-
-                            # 创建临时文件保存视频
-                            temp_dir = Path("temp")
-                            temp_dir.mkdir(exist_ok=True)
-                            timestamp = int(time.time())
-                            video_path = temp_dir / f"{video_type}_{timestamp}.mp4"
-
-                            with open(video_path, 'wb') as f:
-                                f.write(video_data)
-
-                            # 提取视频首帧作为封面
-                            cover_data = None
+            # 使用aiohttp流式下载视频
+            async with self._open("GET", url, headers=headers, timeout=30) as response:  # 视频可能较大，增加超时时间
+                if response.status == 200:
+                    # 检查是否是视频内容
+                    content_type = response.headers.get('Content-Type', '')
+                    if 'video' in content_type or 'mp4' in content_type:
+                        # 边下载边把视频开头送入ffmpeg提取封面，下载完成时封面通常也已就绪
+                        hasher = hashlib.sha256()
+                        async with self._cover_pipe() as pipe:
+                            video_path = await self._stream_video_to_file(response, video_type, pipe, hasher)
+                            if video_path is None:
+                                return f"{video_type}视频文件过大（超过{self.video_max_size_mb}MB），已取消下载"
+                            digest = hasher.hexdigest()
                             try:
-                                # 使用ffmpeg提取第一帧，与VideoSender保持一致
-                                temp_dir = "temp_thumbnails"  # 创建临时文件夹
-                                os.makedirs(temp_dir, exist_ok=True)
-                                thumbnail_path = os.path.join(temp_dir, f"temp_thumbnail_{int(time.time())}.jpg")
-
-                                # 执行ffmpeg命令提取第一帧
-                                process = subprocess.run([
-                                    "ffmpeg",
-                                    "-i", str(video_path),
-                                    "-ss", "00:00:01",  # 从视频的第 1 秒开始提取，与VideoDemand保持一致
-                                    "-vframes", "1",
-                                    thumbnail_path,
-                                    "-y"  # 如果文件存在，覆盖
-                                ], check=False, capture_output=True)
-
-                                if process.returncode != 0:
-                                    logger.error(f"[Apilot] ffmpeg 执行失败: {process.stderr.decode()}")
-                                    cover_data = None
-                                else:
-                                    # 读取生成的缩略图
-                                    if os.path.exists(thumbnail_path):
-                                        with open(thumbnail_path, "rb") as image_file:
-                                            image_data = image_file.read()
-                                            image_base64 = base64.b64encode(image_data).decode("utf-8")
-                                            cover_data = image_base64
-                                            logger.info(f"[Apilot] Successfully extracted video cover, base64 size: {len(cover_data)} characters")
-                                    else:
-                                        logger.error(f"[Apilot] 缩略图文件不存在: {thumbnail_path}")
-                                        cover_data = None
-                            except Exception as cover_error:
-                                logger.error(f"[Apilot] Exception in extracting video cover: {str(cover_error)}")
+                                cached = None
+                                if self.video_cache is not None:
+                                    # 内容相同的视频直接使用缓存的封面和编码结果，管道中的ffmpeg随即结束
+                                    cached = await self.video_cache.lookup_hash(digest, url if cache_by_url else None)
                                 cover_data = None
-                            finally:
-                                # 清理临时文件
-                                if 'temp_dir' in locals() and os.path.exists(temp_dir):
-                                    try:
-                                        shutil.rmtree(temp_dir, ignore_errors=True)  # 递归删除临时文件夹
-                                    except Exception as cleanup_error:
-                                        logger.error(f"[Apilot] 清理缩略图临时文件失败: {cleanup_error}")
-
-                            # 清理视频临时文件
-                            try:
-                                if os.path.exists(str(video_path)):
-                                    os.remove(str(video_path))
-                            except Exception as cleanup_error:
-                                logger.error(f"[Apilot] Failed to clean up video file: {str(cleanup_error)}")
-
-                            # 将视频数据也转换为base64编码的字符串
-                            video_base64 = base64.b64encode(video_data).decode("utf-8")
-                            logger.info(f"[Apilot] Video converted to base64, size: {len(video_base64)} characters")
-
-                            # 返回视频和封面的base64字符串
-                            return {"video": video_base64, "cover": cover_data}
-                        else:
-                            logger.error(f"[Apilot] {video_type} video response is not a video: {content_type}")
-                            # 如果不是视频，返回URL
-                            return url
+                                if cached is None and pipe is not None:
+                                    cover_data = await pipe.result(self.ffmpeg_timeout)
+                            except BaseException:
+                                video_path.unlink(missing_ok=True)
+                                raise
+                            if cached is not None:
+                                logger.info(f"[Apilot] Serving {video_type} video from the derivative cache by content hash")
+                                video_path.unlink(missing_ok=True)
+                                return cached
                     else:
-                        logger.error(f"[Apilot] Failed to download {video_type} video, status code: {response.status}")
-                        # 如果下载失败，返回URL
-                        logger.info(f"[Apilot] Falling back to returning URL: {url}")
+                        logger.error(f"[Apilot] {video_type} video response is not a video: {content_type}")
+                        # 如果不是视频，返回URL
                         return url
+                else:
+                    logger.error(f"[Apilot] Failed to download {video_type} video, status code: {response.status}")
+                    # 如果下载失败，返回URL
+                    logger.info(f"[Apilot] Falling back to returning URL: {url}")
+                    return url
+
+            # 视频保留在临时文件中，由句柄在发送时再编码，发送后删除
+            video = MediaHandle.from_file(video_path, owned=True)
+            try:
+                if cover_data is None:
+                    # 管道方式不可用或失败（例如 moov 位于文件末尾），改为从完整文件提取封面
+                    cover_data = await self._extract_video_cover(video_path)
+                if self.video_cache is not None:
+                    # 保存编码后的视频和封面，同一视频再次出现时跳过ffmpeg和编码
+                    try:
+                        cached = await self.video_cache.put(url if cache_by_url else None, digest, video_path, cover_data)
+                    except Exception as e:
+                        logger.error(f"[Apilot] Failed to store {video_type} video in the derivative cache: {str(e)}")
+                        cached = None
+                    if cached is not None:
+                        video.close()
+                        return cached
+            except BaseException:
+                video.close()
+                raise
+            cover = MediaHandle.from_bytes(cover_data) if cover_data else None
+            return {"video": video, "cover": cover}
         except Exception as e:
             logger.error(f"[Apilot] Exception in _download_video_directly for {video_type}: {str(e)}")
             logger.error(f"[Apilot] Exception traceback: {traceback.format_exc()}")
             return f"获取{video_type}视频时出错: {str(e)}"
 
+    @contextlib.asynccontextmanager
+    async def _cover_pipe(self):
+        """Yield a CoverPipe for one download, or None when piping is disabled or no pipe slot is free"""
+        if not self.cover_pipe_bytes or self.cover_pipe_semaphore.locked():
+            # 没有空闲的管道名额时不让下载等待，下载完成后再从文件提取封面
+            yield None
+            return
+        # 管道中的ffmpeg要等整个下载结束才释放，使用单独的名额，下载慢时不会占用从文件提取封面的名额
+        async with self.cover_pipe_semaphore:
+            try:
+                pipe = await CoverPipe.start(self.cover_pipe_bytes)
+            except Exception as e:
+                logger.error(f"[Apilot] Failed to start ffmpeg for piped cover extraction: {str(e)}")
+                pipe = None
+            try:
+                yield pipe
+            finally:
+                if pipe is not None:
+                    await pipe.close()
+
+    async def _stream_video_to_file(self, response, video_type, cover_pipe=None, hasher=None):
+        """Stream a video response to a temp file in chunks, teeing the start into cover_pipe and all of it into hasher
+
+        Returns None if the video exceeds the size cap.
+        """
+        max_bytes = self.video_max_size_mb * 1024 * 1024
+        if response.content_length is not None and response.content_length > max_bytes:
+            logger.error(f"[Apilot] {video_type} video too large: Content-Length {response.content_length} bytes")
+            return None
+
+        # 创建临时文件保存视频
+        # 放在插件目录下，与 cache/ 一样不依赖启动时的工作目录
+        temp_dir = Path(os.path.dirname(__file__)) / "temp"
+        temp_dir.mkdir(exist_ok=True)
+        video_path = temp_dir / f"{video_type}_{int(time.time())}_{uuid.uuid4().hex[:8]}.mp4"
+
+        size = 0
+        try:
+            with open(video_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(self.video_chunk_size):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        logger.error(f"[Apilot] {video_type} video exceeded {max_bytes} bytes while downloading, aborting")
+                        break
+                    f.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                    if cover_pipe is not None:
+                        await cover_pipe.feed(chunk)
+        except BaseException:
+            video_path.unlink(missing_ok=True)
+            raise
+
+        if size > max_bytes:
+            video_path.unlink(missing_ok=True)
+            return None
+        logger.info(f"[Apilot] Successfully downloaded {video_type} video, size: {size} bytes")
+        return video_path
+
+    async def _extract_video_cover(self, video_path):
+        """Extract the first frame of a downloaded video file as JPEG bytes, or None on failure"""
+        try:
+            # 限制同时运行的ffmpeg进程数，避免突发请求时占满主机资源
+            async with self.ffmpeg_semaphore:
+                # 使用ffmpeg提取第一帧，与VideoSender保持一致；封面直接从stdout读取，不写临时文件
+                process = await asyncio.create_subprocess_exec(
+                    "ffmpeg",
+                    "-loglevel", "error",
+                    "-i", str(video_path),
+                    "-ss", "00:00:01",  # 从视频的第 1 秒开始提取，与VideoDemand保持一致
+                    "-vframes", "1",
+                    "-f", "image2", "-c:v", "mjpeg",
+                    "pipe:1",
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE
+                )
+                try:
+                    cover_data, stderr = await asyncio.wait_for(process.communicate(), timeout=self.ffmpeg_timeout)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    # 超时或任务被取消时结束ffmpeg进程，避免残留
+                    process.kill()
+                    await process.wait()
+                    raise
+
+            if process.returncode != 0 or not cover_data:
+                logger.error(f"[Apilot] ffmpeg 执行失败: {stderr.decode(errors='replace')}")
+                return None
+            logger.info(f"[Apilot] Successfully extracted video cover, size: {len(cover_data)} bytes")
+            return cover_data
+        except asyncio.TimeoutError:
+            logger.error(f"[Apilot] ffmpeg timed out after {self.ffmpeg_timeout}s, process killed")
+            return None
+        except Exception as cover_error:
+            logger.error(f"[Apilot] Exception in extracting video cover: {str(cover_error)}")
+            return None
+
     async def get_xjjsp(self):
         """Get beautiful girl videos with cover image"""
         return await self._get_video_with_cover(self.xjjsp_api_url, "xjjsp")